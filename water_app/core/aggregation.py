@@ -0,0 +1,258 @@
+import numpy as np
+import pandas as pd
+
+from core.sketches import approximate_quantiles, merge_sketches, sketch_quantiles
+from core.timestamps import time_epoch
+
+NS_PER_HOUR = 3600 * 10 ** 9
+NS_PER_DAY = 24 * NS_PER_HOUR
+# 1 января 1970 года - четверг (понедельник = 0)
+EPOCH_DAY_OF_WEEK = 3
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+# Квантили общей статистики потребления: медиана, пик (95%), первый и третий квартили
+QUANTILES = [0.5, 0.95, 0.25, 0.75]
+
+
+def hour_and_weekday(epoch):
+    """Час суток и день недели (0 - понедельник) по времени в нс UTC, без колонок datetime"""
+    hours = (epoch // NS_PER_HOUR % 24).astype(np.int8)
+    weekdays = ((epoch // NS_PER_DAY + EPOCH_DAY_OF_WEEK) % 7).astype(np.int8)
+    return hours, weekdays
+
+
+def _native(value, integer):
+    """Значение статистики как число Python (целое для целочисленных показаний)"""
+    if value is None or np.isnan(value):
+        return np.nan
+    return int(round(value)) if integer else float(value)
+
+
+def _meter_codes(meters):
+    """Коды счетчиков строк (-1 - пустой ID) и ID счетчиков в порядке группировки pandas"""
+    if isinstance(meters.dtype, pd.CategoricalDtype):
+        return meters.cat.codes.to_numpy(), meters.cat.categories
+    codes, meter_ids = pd.factorize(meters, sort=True)
+    return codes, meter_ids
+
+
+def _group_extremes(codes, minimums, maximums, size):
+    """Минимум и максимум по группам codes (0..size-1) через сортировку и reduceat; NaN пропускаются"""
+    minimum = np.full(size, np.nan)
+    maximum = np.full(size, np.nan)
+    if len(codes):
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        minimum[sorted_codes[starts]] = np.fmin.reduceat(minimums[order], starts)
+        maximum[sorted_codes[starts]] = np.fmax.reduceat(maximums[order], starts)
+    return minimum, maximum
+
+
+def group_moments(groups, size, counts, sums, m2):
+    """Количество, сумма и центральная сумма квадратов групп 0..size-1 из частичных статистик.
+
+    Частичные статистики (ячейки, выборки) объединяются по формуле Чана:
+    к сумме их центральных сумм квадратов m2 добавляются квадраты отклонений
+    их средних от среднего группы. В отличие от суммы квадратов точность
+    не теряется при больших показаниях (например, накопительных).
+    """
+    group_counts = np.bincount(groups, weights=counts, minlength=size)
+    group_sums = np.bincount(groups, weights=sums, minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviations = np.where(counts > 0, sums / counts - (group_sums / group_counts)[groups], 0)
+    group_m2 = np.bincount(groups, weights=m2 + counts * deviations ** 2, minlength=size)
+    return group_counts, group_sums, group_m2
+
+
+def total_m2(counts, sums, m2):
+    """Центральная сумма квадратов объединения частичных статистик (см. group_moments)"""
+    counts = np.atleast_1d(np.asarray(counts, dtype='float64'))
+    groups = np.zeros(len(counts), dtype=np.int64)
+    return group_moments(groups, 1, counts, np.atleast_1d(np.asarray(sums, dtype='float64')),
+                         np.atleast_1d(np.asarray(m2, dtype='float64')))[2][0]
+
+
+def _std(m2, count):
+    """Стандартное отклонение (ddof=1) по центральной сумме квадратов и количеству; NaN для групп из одного значения"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = m2 / (count - 1)
+    return np.where(count > 1, np.sqrt(np.maximum(variance, 0)), np.nan)
+
+
+def aggregate_flow(df, mask):
+    """Статистика потребления строк mask за один групповой проход.
+
+    Каждая строка - ячейка (счетчик, час, день недели) с одним показанием;
+    разрезы считает aggregate_cells. Пропуски Value не учитываются, как
+    в агрегатах pandas. Возвращает None, если строк нет.
+    """
+    rows = np.flatnonzero(mask)
+    if not len(rows):
+        return None
+
+    raw_values = df['Value'].to_numpy()[rows]
+    values = raw_values.astype('float64')
+    valid = ~np.isnan(values)
+
+    codes, meter_ids = _meter_codes(df['ManagedObjectid'])
+    hours, weekdays = hour_and_weekday(time_epoch(df)[rows])
+    return aggregate_cells(
+        codes[rows], meter_ids, hours, weekdays,
+        {
+            'rows': np.ones(len(rows), dtype=np.int64),
+            'count': valid.astype(np.int64),
+            'sum': np.where(valid, values, 0),
+            'm2': np.zeros(len(rows)),
+            'min': values,
+            'max': values,
+            'zeros': (values == 0).astype(np.int64),
+        },
+        integer=np.issubdtype(raw_values.dtype, np.integer),
+        quantile_values=lambda: values[valid],
+    )
+
+
+def aggregate_cells(codes, meter_ids, hours, weekdays, stats, integer=False, quantile_values=None,
+                    quantile_sketch=None):
+    """Статистика потребления по ячейкам (счетчик, час, день недели).
+
+    codes - коды счетчиков в meter_ids (-1 - пустой ID), stats - массивы
+    rows/count/sum/m2/min/max/zeros для каждой ячейки (отдельное показание
+    или готовый агрегат сводной таблицы; m2 - центральная сумма квадратов).
+    Сумма и количество собираются bincount в куб (счетчик, час, день недели),
+    а разрезы по счетчикам, часам и дням недели получаются суммами по осям;
+    m2 объединяется по формуле Чана (group_moments).
+    quantile_values() возвращает показания для квантилей общей статистики,
+    quantile_sketch() - скетч (ключи, количества, ошибка) для приближенных квантилей.
+    """
+    meters = len(meter_ids)
+    # Строки без ID счетчика попадают в отдельную группу: они входят в паттерны, но не в статистику счетчиков
+    codes = np.where(codes < 0, meters, codes)
+    cells = (codes.astype(np.int64) * 24 + hours) * 7 + weekdays
+    shape = (meters + 1, 24, 7)
+    size = int(np.prod(shape))
+
+    present = np.bincount(cells, weights=stats['rows'], minlength=size).reshape(shape)
+    counts = np.bincount(cells, weights=stats['count'], minlength=size).reshape(shape)
+    sums = np.bincount(cells, weights=stats['sum'], minlength=size).reshape(shape)
+    # Центральные суммы квадратов ячеек куба, затем счетчиков
+    cube_m2 = group_moments(cells, size, stats['count'], stats['sum'], stats['m2'])[2]
+    meter_of_cell = np.arange(size) // (24 * 7)
+    meter_m2 = group_moments(meter_of_cell, meters + 1, counts.ravel(), sums.ravel(), cube_m2)[2]
+
+    def pattern(axes):
+        group_counts = counts.sum(axis=axes)
+        group_sums = sums.sum(axis=axes)
+        seen = np.flatnonzero(present.sum(axis=axes))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = group_sums / group_counts
+        return {int(group): float(means[group]) for group in seen}
+
+    meter_counts = counts.sum(axis=(1, 2))[:meters]
+    meter_sums = sums.sum(axis=(1, 2))[:meters]
+    minimum, maximum = _group_extremes(codes, stats['min'], stats['max'], meters + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        meter_means = meter_sums / meter_counts
+    meter_stds = _std(meter_m2[:meters], meter_counts)
+
+    meter_stats = {}
+    for code in np.flatnonzero(present.sum(axis=(1, 2))[:meters]):
+        meter_stats[meter_ids[code]] = {
+            'sum': _native(meter_sums[code], integer),
+            'mean': float(meter_means[code]),
+            'max': _native(maximum[code], integer),
+            'min': _native(minimum[code], integer),
+            'std': float(meter_stds[code]),
+            'count': int(meter_counts[code]),
+        }
+
+    daily = pattern((0, 1))
+    count = int(counts.sum())
+    total = float(sums.sum())
+    return {
+        'rows': int(present.sum()),
+        'quantile_values': quantile_values,
+        'quantile_sketch': quantile_sketch,
+        'integer': integer,
+        'count': count,
+        'total': _native(total, integer),
+        'm2': float(total_m2(counts.sum(axis=(1, 2)), sums.sum(axis=(1, 2)), meter_m2)),
+        'mean': total / count if count else np.nan,
+        'max': _native(np.nanmax(maximum), integer) if count else np.nan,
+        'min': _native(np.nanmin(minimum), integer) if count else np.nan,
+        'hourly_pattern': pattern((0, 2)),
+        'daily_pattern': daily,
+        'daily_pattern_named': {DAY_NAMES[day]: mean for day, mean in
+                                sorted(daily.items(), key=lambda item: DAY_NAMES[item[0]])},
+        'meter_stats': meter_stats,
+        'zero_readings': int(stats['zeros'].sum()),
+    }
+
+
+def label_mask(cells, field, value):
+    """Маска ячеек сводной таблицы, у которых значение ключа field равно value"""
+    codes = [code for code, label in enumerate(cells['labels'][field]) if label == value]
+    return np.isin(cells[field], codes)
+
+
+def rollup_flow(cells, mask, meter_ids, integer=False, quantile_values=None, quantile_sketch=None):
+    """Статистика потребления по ячейкам сводной таблицы mask (см. aggregate_cells).
+
+    meter_ids - ID счетчиков выборки в порядке группировки; счетчики ячеек
+    сопоставляются с ними по строковому значению. Возвращает None, если ячеек нет.
+    """
+    if not mask.any():
+        return None
+
+    positions = {str(meter_id): code for code, meter_id in enumerate(meter_ids)}
+    lookup = np.array([positions.get(label, -1) for label in cells['labels']['meter']], dtype=np.int64)
+    hours, weekdays = hour_and_weekday(cells['bucket'][mask] * NS_PER_HOUR)
+    return aggregate_cells(
+        lookup[cells['meter'][mask]], meter_ids, hours, weekdays,
+        {field: cells[field][mask] for field in ['rows', 'count', 'sum', 'm2', 'min', 'max', 'zeros']},
+        integer=integer,
+        quantile_values=quantile_values,
+        quantile_sketch=quantile_sketch,
+    )
+
+
+def combined_stats(*flows):
+    """Общая статистика потребления по нескольким результатам aggregate_flow (один вызов np.quantile).
+
+    В режиме приближенных квантилей, если у всех результатов есть скетчи,
+    квантили считаются по объединенному скетчу без чтения показаний.
+    """
+    flows = [flow for flow in flows if flow is not None]
+    if not flows:
+        return {}
+
+    integer = all(flow['integer'] for flow in flows)
+    rows = sum(flow['rows'] for flow in flows)
+    count = sum(flow['count'] for flow in flows)
+    total = sum(flow['total'] for flow in flows)
+    m2 = total_m2([flow['count'] for flow in flows], [flow['total'] for flow in flows],
+                  [flow['m2'] for flow in flows])
+    zero_readings = sum(flow['zero_readings'] for flow in flows)
+
+    if count and approximate_quantiles() and all(flow['quantile_sketch'] is not None for flow in flows):
+        flow_sketches = [flow['quantile_sketch']() for flow in flows]
+        keys, counts = merge_sketches(*flow_sketches)
+        median, peak, q1, q3 = sketch_quantiles(keys, counts, QUANTILES, flow_sketches[0][2], integer)
+    elif count:
+        values = np.concatenate([flow['quantile_values']() for flow in flows])
+        median, peak, q1, q3 = np.quantile(values, QUANTILES)
+    else:
+        median, peak, q1, q3 = [np.nan] * len(QUANTILES)
+    return {
+        'total': _native(total, integer),
+        'average': total / count if count else np.nan,
+        'median': float(median),
+        'min': _native(np.nanmin([flow['min'] for flow in flows]), integer) if count else np.nan,
+        'max': _native(np.nanmax([flow['max'] for flow in flows]), integer) if count else np.nan,
+        'peak': float(peak),
+        'std_dev': float(_std(m2, np.float64(count))),
+        'q1': float(q1),
+        'q3': float(q3),
+        'zero_readings': zero_readings,
+        'zero_percentage': zero_readings / rows * 100,
+    }
@@ -1,8 +1,181 @@
+import numpy as np
 import pandas as pd
 from scipy import stats
 import core
 from core import prediction
-from core.anomaly_detection import detect_anomalies, format_anomalies
+from core.aggregation import NS_PER_HOUR, aggregate_flow, combined_stats, label_mask, rollup_flow
+from core.data_processing import rollup_for, sketch_for
+from core.sketches import sketch_quantiles
+from core.metadata import meter_attribute
+from core.report_context import create_context, get_artifact, register_artifact, run_sections
+from core.report_writer import emit, write
+from core.anomaly_detection import format_anomalies
+from core.timestamps import valid_time
+
+
+def _value_counts(series):
+    """Количество строк по значениям (без пустых категорий)"""
+    counts = series.value_counts()
+    return counts[counts > 0].to_dict()
+
+
+def _rollup_cells(df, level='hour'):
+    """Ячейки сводной таблицы уровня level для выборки df (или None).
+
+    Нужны категориальные колонки счетчика и метаданных: порядок групп
+    и распределений совпадает с порядком их категорий.
+    """
+    columns = [col for col in ['ManagedObjectid', 'meter_type', 'suburb', 'usage_type'] if col in df.columns]
+    if not all(isinstance(df[col].dtype, pd.CategoricalDtype) for col in columns):
+        return None
+    return rollup_for(df, level)
+
+
+def _class_values(df, mask):
+    """Функция, возвращающая показания строк mask без пропусков (для квантилей)"""
+    def values():
+        selected = df['Value'].to_numpy()[mask].astype('float64')
+        return selected[~np.isnan(selected)]
+    return values
+
+
+def _class_sketch(sketch, column, value):
+    """Функция, возвращающая скетч квантилей класса (ключи, количества, ошибка)"""
+    def class_sketch():
+        mask = label_mask(sketch, column, value)
+        return sketch['key'][mask], sketch['count'][mask], sketch['error']
+    return class_sketch
+
+
+def _class_flows(df, cells=None, sketch=None):
+    """Статистика потребления классов P1 и /10266/1: по сводной таблице cells или по строкам df.
+
+    sketch - скетчи квантилей выборки (для приближенных квантилей).
+    """
+    classes = [('Series', 'P1'), ('typeM', '/10266/1')]
+    flows = []
+    for column, value in classes:
+        if column not in df.columns:
+            flows.append(None)
+        elif cells is not None:
+            integer = np.issubdtype(df['Value'].dtype, np.integer)
+            meter_ids = df['ManagedObjectid'].cat.categories
+            values = _class_values(df, (df[column] == value).to_numpy())
+            class_sketch = _class_sketch(sketch, column, value) if sketch is not None else None
+            flows.append(rollup_flow(cells, label_mask(cells, column, value), meter_ids, integer, values,
+                                     class_sketch))
+        else:
+            flows.append(aggregate_flow(df, (df[column] == value).to_numpy()))
+    return flows
+
+
+def _row_common_stats(df, common_stats):
+    """Заполняет количество счетчиков, показаний, период и распределения по строкам df"""
+    common_stats['total_meters'] = df['ManagedObjectid'].nunique()
+    common_stats['data_points_count'] = len(df)
+    common_stats['first_date'] = df['time'].min().strftime('%Y-%m-%d')
+    common_stats['last_date'] = df['time'].max().strftime('%Y-%m-%d')
+
+    if 'meter_type' in df.columns:
+        common_stats['meter_types_distribution'] = df.groupby('meter_type', observed=True)[
+            'ManagedObjectid'].nunique().to_dict()
+        common_stats['readings_distribution'] = _value_counts(df['meter_type'])
+        common_stats['meter_readings_count'] = df.groupby(
+            ['meter_type', 'ManagedObjectid'], observed=True).size().groupby('meter_type', observed=True).mean().to_dict()
+
+    if 'suburb' in df.columns:
+        common_stats['suburb_distribution'] = _value_counts(df['suburb'])
+
+    if 'usage_type' in df.columns:
+        common_stats['usage_type_distribution'] = _value_counts(df['usage_type'])
+
+
+def _rollup_common_stats(df, cells, common_stats):
+    """Заполняет количество счетчиков, показаний, период и распределения по сводной таблице"""
+    meter_rows = pd.Series(np.bincount(cells['meter'], weights=cells['rows'],
+                                       minlength=len(cells['labels']['meter'])).astype(np.int64),
+                           index=cells['labels']['meter'])
+    meter_rows = meter_rows[(meter_rows > 0) & (meter_rows.index != 'nan')]
+
+    common_stats['total_meters'] = len(meter_rows)
+    common_stats['data_points_count'] = int(cells['rows'].sum())
+    first, last = cells['bucket'].min() * NS_PER_HOUR, cells['bucket'].max() * NS_PER_HOUR
+    common_stats['first_date'] = pd.Timestamp(first, tz='UTC').strftime('%Y-%m-%d')
+    common_stats['last_date'] = pd.Timestamp(last, tz='UTC').strftime('%Y-%m-%d')
+
+    def rows_by(name):
+        """Количество строк по значениям атрибута счетчика в порядке категорий колонки df"""
+        values = pd.Series(meter_attribute(meter_rows.index, name), index=meter_rows.index)
+        counts = meter_rows.groupby(values, observed=True).sum()
+        return counts.reindex(df[name].cat.categories, fill_value=0), values
+
+    if 'meter_type' in df.columns:
+        counts, meter_types = rows_by('meter_type')
+        per_type = meter_rows.groupby(meter_types, observed=True)
+        common_stats['meter_types_distribution'] = per_type.size().to_dict()
+        common_stats['readings_distribution'] = _sorted_counts(counts)
+        common_stats['meter_readings_count'] = per_type.mean().to_dict()
+
+    if 'suburb' in df.columns:
+        common_stats['suburb_distribution'] = _sorted_counts(rows_by('suburb')[0])
+
+    if 'usage_type' in df.columns:
+        common_stats['usage_type_distribution'] = _sorted_counts(rows_by('usage_type')[0])
+
+
+def _sorted_counts(counts):
+    """Количество строк по значениям в порядке value_counts (без пустых значений)"""
+    counts = counts.sort_values(ascending=False)
+    return counts[counts > 0].to_dict()
+
+
+def _flow_patterns(flow):
+    """Паттерны и статистика по счетчикам из результата aggregate_flow"""
+    return {key: flow[key] for key in ['hourly_pattern', 'daily_pattern', 'daily_pattern_named', 'meter_stats']}
+
+
+def _suburb_stats(df):
+    """Статистика показаний P1 по районам (sum, mean, median, max, min, count).
+
+    В режиме приближенных квантилей статистика собирается по суточным
+    ячейкам сводной таблицы, а медиана - по скетчам, без чтения показаний.
+    """
+    cells = _rollup_cells(df, 'day')
+    sketch = sketch_for(df) if cells is not None else None
+    if sketch is None:
+        return df[df['Series'] == 'P1'].groupby('suburb', observed=True)['Value'].agg(
+            ['sum', 'mean', 'median', 'max', 'min', 'count'])
+
+    def cell_suburbs(level_cells):
+        """Район каждой ячейки в категориях колонки suburb выборки"""
+        suburbs = pd.Series(meter_attribute(level_cells['labels']['meter'], 'suburb'), dtype=object)
+        return pd.Categorical(suburbs.to_numpy()[level_cells['meter']], categories=df['suburb'].cat.categories)
+
+    mask = label_mask(cells, 'Series', 'P1')
+    frame = pd.DataFrame({'suburb': cell_suburbs(cells)[mask],
+                          **{field: cells[field][mask] for field in ['rows', 'count', 'sum', 'min', 'max']}})
+    groups = frame.groupby('suburb', observed=True).agg(
+        rows=('rows', 'sum'), count=('count', 'sum'), sum=('sum', 'sum'), min=('min', 'min'), max=('max', 'max'))
+    groups = groups[groups['rows'] > 0]
+
+    sketch_mask = label_mask(sketch, 'Series', 'P1')
+    sketch_suburbs = cell_suburbs(sketch)[sketch_mask]
+    keys, counts = sketch['key'][sketch_mask], sketch['count'][sketch_mask]
+    integer = np.issubdtype(df['Value'].dtype, np.integer)
+    medians = [sketch_quantiles(keys[sketch_suburbs == suburb], counts[sketch_suburbs == suburb], [0.5],
+                                sketch['error'], integer)[0] for suburb in groups.index]
+
+    value_type = df['Value'].dtype.type if integer else np.float64
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = groups['sum'] / groups['count']
+    return pd.DataFrame({
+        'sum': groups['sum'].astype(value_type),
+        'mean': means,
+        'median': medians,
+        'max': groups['max'],
+        'min': groups['min'],
+        'count': groups['count'].astype(np.int64),
+    }, index=groups.index)
 
 
 def analyze_consumption(df):
@@ -36,8 +209,8 @@ def analyze_consumption(df):
         return analysis
 
     try:
-        df['time'] = pd.to_datetime(df['time'], errors='coerce')
-        df = df.dropna(subset=['time'])
+        # Время уже разобрано при загрузке; отбрасываются только строки без времени
+        df = valid_time(df)
         if df.empty:
             print("Предупреждение: Нет корректных данных времени")
             return analysis
@@ -45,222 +218,191 @@ def analyze_consumption(df):
         print(f"Ошибка преобразования времени: {e}")
         return analysis
 
+    # Если выборка складывается из ячеек сводной таблицы, статистика считается по ним
+    cells = _rollup_cells(df)
+
     # Заполняем common_stats
-    analysis['common_stats']['total_meters'] = df['ManagedObjectid'].nunique()
-    analysis['common_stats']['data_points_count'] = len(df)
-    analysis['common_stats']['first_date'] = df['time'].min().strftime('%Y-%m-%d')
-    analysis['common_stats']['last_date'] = df['time'].max().strftime('%Y-%m-%d')
+    if cells is not None:
+        _rollup_common_stats(df, cells, analysis['common_stats'])
+    else:
+        _row_common_stats(df, analysis['common_stats'])
 
-    # Добавляем расширенную статистику по расходам
+    # Статистика по классам счетчиков: один групповой проход на класс
+    p1_flow = mtype_flow = None
     if 'Value' in df.columns:
-        # Для P1 счетчиков
-        p1_data = df[df['Series'] == 'P1'].copy() if 'Series' in df.columns else pd.DataFrame()
-        # Для 10266/1 счетчиков
-        mtype_data = df[df['typeM'] == '/10266/1'].copy() if 'typeM' in df.columns else pd.DataFrame()
-
-        # Объединенные данные для общей статистики
-        combined_flow = pd.concat([p1_data, mtype_data])
-
-        if not combined_flow.empty:
-            analysis['common_stats']['consumption_stats'] = {
-                'total': combined_flow['Value'].sum(),
-                'average': combined_flow['Value'].mean(),
-                'median': combined_flow['Value'].median(),
-                'min': combined_flow['Value'].min(),
-                'max': combined_flow['Value'].max(),
-                'peak': combined_flow['Value'].quantile(0.95),
-                'std_dev': combined_flow['Value'].std(),
-                'q1': combined_flow['Value'].quantile(0.25),
-                'q3': combined_flow['Value'].quantile(0.75),
-                'zero_readings': int((combined_flow['Value'] == 0).sum()),
-                'zero_percentage': (combined_flow['Value'] == 0).mean() * 100
-            }
-
-    # Остальная статистика
-    if 'meter_type' in df.columns:
-        analysis['common_stats']['meter_types_distribution'] = df.groupby('meter_type')[
-            'ManagedObjectid'].nunique().to_dict()
-        analysis['common_stats']['readings_distribution'] = df['meter_type'].value_counts().to_dict()
-        analysis['common_stats']['meter_readings_count'] = df.groupby('meter_type')[
-            'ManagedObjectid'].value_counts().groupby('meter_type').mean().to_dict()
-
-    if 'suburb' in df.columns:
-        analysis['common_stats']['suburb_distribution'] = df['suburb'].value_counts().to_dict()
+        sketch = sketch_for(df) if cells is not None else None
+        p1_flow, mtype_flow = _class_flows(df, cells, sketch)
 
-    if 'usage_type' in df.columns:
-        analysis['common_stats']['usage_type_distribution'] = df['usage_type'].value_counts().to_dict()
+        # Общая статистика по строкам обоих классов (строка обоих классов учитывается дважды)
+        consumption_stats = combined_stats(p1_flow, mtype_flow)
+        if consumption_stats:
+            analysis['common_stats']['consumption_stats'] = consumption_stats
 
     # Анализ для P1 счетчиков
-    if 'Series' in df.columns:
-        p1_data = df[df['Series'] == 'P1'].copy()
-        if not p1_data.empty:
-            p1_data['hour'] = p1_data['time'].dt.hour
-            p1_data['day_of_week'] = p1_data['time'].dt.dayofweek
-            p1_data['day_name'] = p1_data['time'].dt.day_name()  # Добавляем названия дней
-
-            analysis['p1_meters']['flow_stats'] = {
-                'total_consumption': p1_data['Value'].sum(),
-                'avg_consumption': p1_data['Value'].mean(),
-                'max_consumption': p1_data['Value'].max(),
-                'min_consumption': p1_data['Value'].min(),
-                'hourly_pattern': p1_data.groupby('hour')['Value'].mean().to_dict(),
-                'daily_pattern': p1_data.groupby('day_of_week')['Value'].mean().to_dict(),
-                'daily_pattern_named': p1_data.groupby('day_name')['Value'].mean().to_dict(),
-                'meter_stats': p1_data.groupby('ManagedObjectid')['Value'].agg(
-                    ['sum', 'mean', 'max', 'min', 'std', 'count']
-                ).to_dict('index')
-            }
+    if p1_flow is not None:
+        analysis['p1_meters']['flow_stats'] = {
+            'total_consumption': p1_flow['total'],
+            'avg_consumption': p1_flow['mean'],
+            'max_consumption': p1_flow['max'],
+            'min_consumption': p1_flow['min'],
+            **_flow_patterns(p1_flow)
+        }
 
     # Анализ для 10266/1 счетчиков
-    if 'typeM' in df.columns:
-        mtype_data = df[df['typeM'] == '/10266/1'].copy()
-        if not mtype_data.empty:
-            mtype_data['hour'] = mtype_data['time'].dt.hour
-            mtype_data['day_of_week'] = mtype_data['time'].dt.dayofweek
-            mtype_data['day_name'] = mtype_data['time'].dt.day_name()  # Добавляем названия дней
-
-            analysis['mtype_10266_1']['flow_stats'] = {
-                'total_consumption': mtype_data['Value'].sum(),
-                'avg_consumption': mtype_data['Value'].mean(),
-                'hourly_pattern': mtype_data.groupby('hour')['Value'].mean().to_dict(),
-                'daily_pattern': mtype_data.groupby('day_of_week')['Value'].mean().to_dict(),
-                'daily_pattern_named': mtype_data.groupby('day_name')['Value'].mean().to_dict(),
-                'meter_stats': mtype_data.groupby('ManagedObjectid')['Value'].agg(
-                    ['sum', 'mean', 'max', 'min', 'std', 'count']
-                ).to_dict('index')
-            }
+    if mtype_flow is not None:
+        analysis['mtype_10266_1']['flow_stats'] = {
+            'total_consumption': mtype_flow['total'],
+            'avg_consumption': mtype_flow['mean'],
+            **_flow_patterns(mtype_flow)
+        }
 
     return analysis
 
 
-def perform_analysis(df, modes=None):
-    """Функция для выполнения анализа с учетом двух типов счетчиков"""
+register_artifact('consumption', analyze_consumption)
+
+
+def perform_analysis(df, modes=None, context=None, writer=None):
+    """Функция для выполнения анализа с учетом двух типов счетчиков.
+
+    context - контекст отчета: анализ, аномалии и прогноз берутся из него
+    и вычисляются не больше одного раза на отчет. Если передан писатель
+    отчета writer, разделы передаются ему по мере готовности и функция
+    возвращает None, иначе возвращается текст отчета.
+    """
     if df is None or df.empty:
-        return "Нет данных для анализа\n"
+        return emit(writer, "Нет данных для анализа\n")
+
+    context = context or create_context(df)
 
-    analysis = analyze_consumption(df)
-    output = ""
+    # Разделы выбранных режимов считаются параллельно (см. run_sections); анализ потребления - общий для 1, 2 и 5
 
     # 1. Общая статистика
-    if 1 in modes:
-        output += "\n=== ОБЩАЯ СТАТИСТИКА ===\n"
-        output += f"Всего счетчиков: {analysis['common_stats']['total_meters']}\n"
-        output += f"Всего показаний: {analysis['common_stats']['data_points_count']}\n"
-        output += f"Период данных: с {analysis['common_stats']['first_date']} по {analysis['common_stats']['last_date']}\n"
+    def section_1(out):
+        analysis = get_artifact(context, 'consumption')
+        write(out, "\n=== ОБЩАЯ СТАТИСТИКА ===\n")
+        write(out, f"Всего счетчиков: {analysis['common_stats']['total_meters']}\n")
+        write(out, f"Всего показаний: {analysis['common_stats']['data_points_count']}\n")
+        write(out, f"Период данных: с {analysis['common_stats']['first_date']} по {analysis['common_stats']['last_date']}\n")
 
         if 'consumption_stats' in analysis['common_stats']:
             stats = analysis['common_stats']['consumption_stats']
-            output += "\nОбщая статистика потребления:\n"
-            output += f"  Общий расход: {stats['total']:,.2f} л\n"
-            output += f"  Средний расход: {stats['average']:,.2f} л/интервал\n"
-            output += f"  Медианный расход: {stats['median']:,.2f} л/интервал\n"
-            output += f"  Минимальный расход: {stats['min']:,.2f} л\n"
-            output += f"  Максимальный расход: {stats['max']:,.2f} л\n"
-            output += f"  Пиковый расход (95-й перцентиль): {stats['peak']:,.2f} л\n"
-            output += f"  Стандартное отклонение: {stats['std_dev']:,.2f} л\n"
+            write(out, "\nОбщая статистика потребления:\n")
+            write(out, f"  Общий расход: {stats['total']:,.2f} л\n")
+            write(out, f"  Средний расход: {stats['average']:,.2f} л/интервал\n")
+            write(out, f"  Медианный расход: {stats['median']:,.2f} л/интервал\n")
+            write(out, f"  Минимальный расход: {stats['min']:,.2f} л\n")
+            write(out, f"  Максимальный расход: {stats['max']:,.2f} л\n")
+            write(out, f"  Пиковый расход (95-й перцентиль): {stats['peak']:,.2f} л\n")
+            write(out, f"  Стандартное отклонение: {stats['std_dev']:,.2f} л\n")
 
         if analysis['common_stats']['meter_types_distribution']:
-            output += "\nРаспределение счетчиков по типам:\n"
+            write(out, "\nРаспределение счетчиков по типам:\n")
             for meter_type, count in analysis['common_stats']['meter_types_distribution'].items():
-                output += f"  {meter_type}: {count} счетчиков\n"
+                write(out, f"  {meter_type}: {count} счетчиков\n")
 
     # 2. Статистика по счетчикам
-    if 2 in modes:
-        output += "\n=== СТАТИСТИКА ПО СЧЕТЧИКАМ ===\n"
+    def section_2(out):
+        analysis = get_artifact(context, 'consumption')
+        write(out, "\n=== СТАТИСТИКА ПО СЧЕТЧИКАМ ===\n")
 
         # P1 счетчики
         if 'p1_meters' in analysis and 'flow_stats' in analysis['p1_meters']:
             stats = analysis['p1_meters']['flow_stats']
-            output += "\n[Тип: P1 (интервалы 15 минут)]\n"
-            output += f"Общий расход: {stats['total_consumption']:,.2f} л\n"
-            output += f"Средний расход: {stats['avg_consumption']:,.2f} л/интервал\n"
+            write(out, "\n[Тип: P1 (интервалы 15 минут)]\n")
+            write(out, f"Общий расход: {stats['total_consumption']:,.2f} л\n")
+            write(out, f"Средний расход: {stats['avg_consumption']:,.2f} л/интервал\n")
 
             if 'meter_stats' in stats:
-                output += "\nДетали по счетчикам:\n"
+                write(out, "\nДетали по счетчикам:\n")
                 for meter_id, meter_stats in sorted(stats['meter_stats'].items()):
-                    output += f"\nСчетчик {meter_id}:\n"
-                    output += f"  Суммарный расход: {meter_stats['sum']:,.2f} л\n"
-                    output += f"  Средний расход: {meter_stats['mean']:,.2f} ± {meter_stats['std']:,.2f} л\n"
-                    output += f"  Максимальный расход: {meter_stats['max']:,.2f} л\n"
-                    output += f"  Минимальный расход: {meter_stats['min']:,.2f} л\n"
-                    output += f"  Количество показаний: {meter_stats['count']}\n"
+                    write(out, f"\nСчетчик {meter_id}:\n")
+                    write(out, f"  Суммарный расход: {meter_stats['sum']:,.2f} л\n")
+                    write(out, f"  Средний расход: {meter_stats['mean']:,.2f} ± {meter_stats['std']:,.2f} л\n")
+                    write(out, f"  Максимальный расход: {meter_stats['max']:,.2f} л\n")
+                    write(out, f"  Минимальный расход: {meter_stats['min']:,.2f} л\n")
+                    write(out, f"  Количество показаний: {meter_stats['count']}\n")
 
         # 10266/1 счетчики
         if 'mtype_10266_1' in analysis and 'flow_stats' in analysis['mtype_10266_1']:
             stats = analysis['mtype_10266_1']['flow_stats']
-            output += "\n[Тип: 10266/1 (интервалы 30 минут)]\n"
-            output += f"Общий расход: {stats['total_consumption']:,.2f} л\n"
-            output += f"Средний расход: {stats['avg_consumption']:,.2f} л/интервал\n"
+            write(out, "\n[Тип: 10266/1 (интервалы 30 минут)]\n")
+            write(out, f"Общий расход: {stats['total_consumption']:,.2f} л\n")
+            write(out, f"Средний расход: {stats['avg_consumption']:,.2f} л/интервал\n")
 
             if 'meter_stats' in stats:
-                output += "\nДетали по счетчикам:\n"
+                write(out, "\nДетали по счетчикам:\n")
                 for meter_id, meter_stats in sorted(stats['meter_stats'].items()):
-                    output += f"\nСчетчик {meter_id}:\n"
-                    output += f"  Суммарный расход: {meter_stats['sum']:,.2f} л\n"
-                    output += f"  Средний расход: {meter_stats['mean']:,.2f} ± {meter_stats['std']:,.2f} л\n"
-                    output += f"  Максимальный расход: {meter_stats['max']:,.2f} л\n"
-                    output += f"  Минимальный расход: {meter_stats['min']:,.2f} л\n"
-                    output += f"  Количество показаний: {meter_stats['count']}\n"
+                    write(out, f"\nСчетчик {meter_id}:\n")
+                    write(out, f"  Суммарный расход: {meter_stats['sum']:,.2f} л\n")
+                    write(out, f"  Средний расход: {meter_stats['mean']:,.2f} ± {meter_stats['std']:,.2f} л\n")
+                    write(out, f"  Максимальный расход: {meter_stats['max']:,.2f} л\n")
+                    write(out, f"  Минимальный расход: {meter_stats['min']:,.2f} л\n")
+                    write(out, f"  Количество показаний: {meter_stats['count']}\n")
 
     # Остальные режимы (3-6) остаются без изменений
     # 3. Статистика по районам
-    if 3 in modes:
-        output += "\n=== СТАТИСТИКА ПО РАЙОНАМ ===\n"
+    def section_3(out):
+        write(out, "\n=== СТАТИСТИКА ПО РАЙОНАМ ===\n")
         if 'suburb' in df.columns:
-            suburb_stats = df[df['Series'] == 'P1'].groupby('suburb')['Value'].agg(
-                ['sum', 'mean', 'median', 'max', 'min', 'count'])
+            suburb_stats = _suburb_stats(df)
             for suburb, stats in suburb_stats.sort_values('sum', ascending=False).head(10).iterrows():
-                output += f"\nРайон {suburb}:\n"
-                output += f"  Суммарный расход: {stats['sum']:,.2f} л\n"
-                output += f"  Средний расход: {stats['mean']:,.2f} л\n"
-                output += f"  Медианный расход: {stats['median']:,.2f} л\n"
-                output += f"  Максимальный расход: {stats['max']:,.2f} л\n"
-                output += f"  Минимальный расход: {stats['min']:,.2f} л\n"
-                output += f"  Количество показаний: {stats['count']}\n"
+                write(out, f"\nРайон {suburb}:\n")
+                write(out, f"  Суммарный расход: {stats['sum']:,.2f} л\n")
+                write(out, f"  Средний расход: {stats['mean']:,.2f} л\n")
+                write(out, f"  Медианный расход: {stats['median']:,.2f} л\n")
+                write(out, f"  Максимальный расход: {stats['max']:,.2f} л\n")
+                write(out, f"  Минимальный расход: {stats['min']:,.2f} л\n")
+                write(out, f"  Количество показаний: {stats['count']}\n")
         else:
-            output += "Данные по районам отсутствуют\n"
+            write(out, "Данные по районам отсутствуют\n")
 
     # 4. Аномалии
-    if 4 in modes:
+    def section_4(out):
         try:
-            anomalies = detect_anomalies(df)
-            output += format_anomalies(anomalies)
+            anomalies = get_artifact(context, 'anomalies')
         except Exception as e:
-            output += f"\nОшибка при обнаружении аномалий: {str(e)}\n"
+            write(out, f"\nОшибка при обнаружении аномалий: {str(e)}\n")
+            return
+        # Аномалии передаются писателю по одной
+        format_anomalies(anomalies, out)
 
-    if 5 in modes:
-        output += "\n=== СУТОЧНЫЕ И НЕДЕЛЬНЫЕ ПАТТЕРНЫ ПОТРЕБЛЕНИЯ ===\n"
+    def section_5(out):
+        analysis = get_artifact(context, 'consumption')
+        write(out, "\n=== СУТОЧНЫЕ И НЕДЕЛЬНЫЕ ПАТТЕРНЫ ПОТРЕБЛЕНИЯ ===\n")
 
         # Паттерны для P1
         if 'p1_meters' in analysis and 'flow_stats' in analysis['p1_meters']:
             p1_stats = analysis['p1_meters']['flow_stats']
 
-            output += "\n[Тип: P1 - Часовые паттерны]\n"
+            write(out, "\n[Тип: P1 - Часовые паттерны]\n")
             for hour, val in sorted(p1_stats['hourly_pattern'].items()):
-                output += f"  {hour:02}:00 - {val:.2f} л\n"
+                write(out, f"  {hour:02}:00 - {val:.2f} л\n")
 
-            output += "\n[Тип: P1 - По дням недели]\n"
+            write(out, "\n[Тип: P1 - По дням недели]\n")
             for day, val in p1_stats['daily_pattern_named'].items():
-                output += f"  {day[:3]}: {val:.2f} л\n"  # Сокращаем названия дней (Mon, Tue...)
+                write(out, f"  {day[:3]}: {val:.2f} л\n")  # Сокращаем названия дней (Mon, Tue...)
 
         # Паттерны для 10266/1
         if 'mtype_10266_1' in analysis and 'flow_stats' in analysis['mtype_10266_1']:
             mtype_stats = analysis['mtype_10266_1']['flow_stats']
 
-            output += "\n[Тип: 10266/1 - Часовые паттерны]\n"
+            write(out, "\n[Тип: 10266/1 - Часовые паттерны]\n")
             for hour, val in sorted(mtype_stats['hourly_pattern'].items()):
-                output += f"  {hour:02}:00 - {val:.2f} л\n"
+                write(out, f"  {hour:02}:00 - {val:.2f} л\n")
 
-            output += "\n[Тип: 10266/1 - По дням недели]\n"
+            write(out, "\n[Тип: 10266/1 - По дням недели]\n")
             for day, val in mtype_stats['daily_pattern_named'].items():
-                output += f"  {day[:3]}: {val:.2f} л\n"
+                write(out, f"  {day[:3]}: {val:.2f} л\n")
 
     # 6. Прогнозирование потребления
-    if 6 in modes:
-        predictions = core.prediction.predict_consumption(df, forecast_hours=24)
+    def section_6(out):
+        predictions = get_artifact(context, 'predictions')
         if not predictions.empty:
-            formatted_predictions = core.prediction.format_predictions(predictions)
-            output += "\nПРОГНОЗ ПОТРЕБЛЕНИЯ:\n" + formatted_predictions + "\n"
-            print(formatted_predictions)
+            # Прогнозы передаются писателю по счетчику
+            write(out, "\nПРОГНОЗ ПОТРЕБЛЕНИЯ:\n")
+            core.prediction.format_predictions(predictions, out)
+            write(out, "\n")
 
-    return output
\ No newline at end of file
+    return run_sections({1: section_1, 2: section_2, 3: section_3, 4: section_4, 5: section_5, 6: section_6}, modes,
+                        writer=writer)
\ No newline at end of file
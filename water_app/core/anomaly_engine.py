@@ -0,0 +1,295 @@
+import numpy as np
+import pandas as pd
+
+from core.aggregation import NS_PER_HOUR
+from core.meter_store import meter_arrays
+from core.window_kernels import rolling_order_stats
+
+# Запас при отсеве ночных последовательностей по приближенному CV:
+# последовательности у самого порога проверяются точным расчетом
+CV_MARGIN = 1e-9
+
+
+def collect_fleet(meter_ids, lengths, time, value, tz):
+    """Ряды счетчиков (в формате meter_arrays) одним набором плоских массивов для правил.
+
+    Строки счетчика идут подряд по возрастанию времени; пропуски показаний отброшены.
+    group - номер счетчика в meter_ids, time - время (нс UTC), position - номер
+    строки в ряду счетчика, start и size - начало и длина ряда ее счетчика.
+    """
+    group = np.repeat(np.arange(len(meter_ids)), lengths)
+
+    valid = ~np.isnan(value)
+    group, time, value = group[valid], time[valid], value[valid]
+    sizes = np.bincount(group, minlength=len(meter_ids))
+    starts = np.cumsum(sizes) - sizes
+    return {
+        'meter_ids': meter_ids,
+        'tz': tz,
+        'group': group,
+        'time': time,
+        'value': value,
+        'position': np.arange(len(group)) - starts[group],
+        'start': starts[group],
+        'size': sizes[group],
+    }
+
+
+def _previous(values, first, fill):
+    """Предыдущее значение в ряду счетчика (fill для первой строки ряда)"""
+    shifted = np.empty_like(values)
+    shifted[1:] = values[:-1]
+    shifted[first] = fill
+    return shifted
+
+
+def _next(values, last, fill):
+    """Следующее значение в ряду счетчика (fill для последней строки ряда)"""
+    shifted = np.empty_like(values)
+    shifted[:-1] = values[1:]
+    shifted[last] = fill
+    return shifted
+
+
+def _search(times, lo, hi, targets, side='left'):
+    """Позиции вставки targets в отрезки times[lo:hi] (как np.searchsorted) векторным двоичным поиском"""
+    lo, hi = lo.copy(), hi.copy()
+    last = len(times) - 1
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+        middle = (lo + hi) // 2
+        middle_times = times[np.minimum(middle, last)]
+        right = active & ((middle_times <= targets) if side == 'right' else (middle_times < targets))
+        lo = np.where(right, middle + 1, lo)
+        hi = np.where(active & ~right, middle, hi)
+
+
+def _time_range(fleet, rows, before, after):
+    """Границы [lo, hi) строк ряда с временем от time - before до time + after включительно"""
+    start = fleet['start'][rows]
+    stop = start + fleet['size'][rows]
+    times = fleet['time'][rows]
+    lo = _search(fleet['time'], start, stop, times - before, side='left')
+    hi = _search(fleet['time'], start, stop, times + after, side='right')
+    return lo, hi
+
+
+def _ranges(lo, hi):
+    """Строки всех отрезков [lo, hi) подряд и номер отрезка каждой строки"""
+    lengths = hi - lo
+    owner = np.repeat(np.arange(len(lo)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    return owner, np.arange(lengths.sum()) - offsets[owner] + lo[owner]
+
+
+def _range_max(values, lo, hi):
+    """Максимум values по каждому непустому отрезку [lo, hi)"""
+    if not len(lo):
+        return np.empty(0)
+    _, rows = _ranges(lo, hi)
+    return np.maximum.reduceat(values[rows], np.cumsum(hi - lo) - (hi - lo))
+
+
+def _range_count_above(values, lo, hi, thresholds):
+    """Количество значений отрезка [lo, hi), больших порога этого отрезка"""
+    owner, rows = _ranges(lo, hi)
+    above = values[rows] > thresholds[owner]
+    return np.bincount(owner, weights=above, minlength=len(lo)).astype(np.int64)
+
+
+def _extreme_values(fleet, params):
+    """Строки экстремальных значений: начало превышения порога со значительным падением за 3 часа"""
+    value = fleet['value']
+    first = fleet['position'] == 0
+    extreme = value > params['extreme_threshold']
+    extreme &= ~_previous(extreme, first, False)
+    rows = np.flatnonzero(extreme & (fleet['size'] > 10))
+
+    _, hi = _time_range(fleet, rows, 0, 3 * NS_PER_HOUR)
+    after = value[hi - 1]
+    keep = ~((hi - rows > 1) & (value[rows] - after < value[rows] * 0.5))
+    return rows[keep]
+
+
+def _z_scores(fleet, params):
+    """Изолированные статистические аномалии: строки и медиана/MAD в них"""
+    window = params['window']
+    rows = np.flatnonzero(fleet['size'] >= window)
+    empty = rows[:0], np.empty(0), np.empty(0)
+    if not len(rows):
+        return empty
+
+    value = fleet['value'][rows]
+    positions = fleet['position'][rows]
+    first = positions == 0
+    last = positions == fleet['size'][rows] - 1
+
+    # Медиана и 99.5% перцентиль - из одной сортировки окон
+    median, roll_upper = rolling_order_stats(value, positions, window, [('median', 24), (0.995, window)])
+    mad, = rolling_order_stats(np.abs(value - median), positions, window, [('median', 24)])
+    mad = np.where(mad < 0.1, 0.1, mad)
+    modified_z = 0.6745 * (value - median) / mad
+    high_z = modified_z > params['z_threshold'] * 1.5
+
+    high_percentile = value > roll_upper * 1.5
+
+    prev_median = _previous(rolling_order_stats(value, positions, 24, [('median', 24)])[0], first, np.nan)
+    diff = value - _previous(value, first, np.nan)
+    sudden_jump = (value > prev_median * 3) & (diff > prev_median * 2)
+
+    anomaly = high_z & high_percentile & sudden_jump
+    # Центрированное окно из 3 точек: на краях ряда окно неполное (NaN), и NaN считается выполнением условия
+    anomaly = (anomaly & _previous(anomaly, first, False) & _next(anomaly, last, False)) | first | last
+    anomaly &= ~_previous(anomaly, first, False)
+    anomaly &= ~_next(anomaly, last, False)
+
+    candidates = np.flatnonzero(anomaly)
+    if not len(candidates):
+        return empty
+    candidate_rows = rows[candidates]
+    candidate_median = median[candidates]
+
+    lo, hi = _time_range(fleet, candidate_rows, 6 * NS_PER_HOUR, 6 * NS_PER_HOUR)
+    keep = hi - lo >= 5
+    lo, hi = _time_range(fleet, candidate_rows, NS_PER_HOUR, NS_PER_HOUR)
+    keep &= _range_count_above(fleet['value'], lo, hi, candidate_median) <= 3
+    return candidate_rows[keep], candidate_median[keep], mad[candidates][keep]
+
+
+def run_stats(values):
+    """Среднее и стандартное отклонение (ddof=1) последовательности теми же операциями, что и в pandas"""
+    mean = values.sum() / len(values)
+    return mean, np.sqrt(((mean - values) ** 2).sum() / (len(values) - 1))
+
+
+def _night_leaks(fleet, params):
+    """Ночные протечки: (первая строка, последняя строка, средний расход, CV) стабильных последовательностей"""
+    value = fleet['value']
+    hours = fleet['time'] // NS_PER_HOUR % 24
+    night = (np.isin(hours, list(params['night_hours'])) &
+             (value > params['min_night_flow']) & (value < params['max_flow'] * 0.7))
+    rows = np.flatnonzero(night)
+    if not len(rows):
+        return []
+
+    # Ночные показания идут подряд внутри каждого счетчика; новая последовательность
+    # начинается на первом ночном показании счетчика или на резком изменении расхода
+    night_value = value[rows]
+    group = fleet['group'][rows]
+    new_meter = np.r_[True, group[1:] != group[:-1]]
+    prev_value = _previous(night_value, new_meter, np.nan)
+    change = np.abs(night_value - prev_value)
+    with np.errstate(invalid='ignore'):
+        breaks = (change > params['min_night_flow'] * 0.5) | (change / prev_value > 0.3)
+    run_starts = np.flatnonzero(new_meter | breaks)
+    run_stops = np.r_[run_starts[1:], len(rows)]
+    lengths = run_stops - run_starts
+
+    long_runs = lengths >= params['min_duration'] * 2
+    run_starts, run_stops, lengths = run_starts[long_runs], run_stops[long_runs], lengths[long_runs]
+    if not len(run_starts):
+        return []
+
+    # Приближенный CV отсеивает явно нестабильные последовательности одним проходом
+    run = np.repeat(np.arange(len(run_starts)), lengths)
+    run_rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(run_starts, lengths)
+    run_values = night_value[run_rows]
+    means = np.bincount(run, weights=run_values) / lengths
+    variances = np.bincount(run, weights=(run_values - means[run]) ** 2) / (lengths - 1)
+    stable = np.sqrt(variances) / means <= 0.2 * (1 + CV_MARGIN)
+
+    # До начала и после конца последовательности (6 часов) расход должен быть низким
+    first_rows = rows[run_starts]
+    last_rows = rows[run_stops - 1]
+    lo, _ = _time_range(fleet, first_rows, 6 * NS_PER_HOUR, 0)
+    _, hi = _time_range(fleet, last_rows, 0, 6 * NS_PER_HOUR)
+    limit = params['max_flow'] * 0.8
+    calm = ((_range_max(value, lo, first_rows + 1) <= limit) &
+            (_range_max(value, last_rows, hi) <= limit))
+
+    leaks = []
+    for run_index in np.flatnonzero(stable & calm):
+        avg_flow, std = run_stats(night_value[run_starts[run_index]:run_stops[run_index]])
+        cv = std / avg_flow
+        if cv > 0.2:
+            continue
+        leaks.append((first_rows[run_index], last_rows[run_index], avg_flow, cv))
+    return leaks
+
+
+def detect_fleet_anomalies(data, params, meter_type, series=None, type_m=None):
+    """Аномалии всех счетчиков data одним векторным проходом по плоским массивам рядов.
+
+    Правила и результат те же, что у _process_meter_data в core.anomaly_detection:
+    скользящие медианы и перцентили считаются ядрами core.window_kernels по всем
+    счетчикам сразу, а окна вокруг кандидатов (3, 6 и 1 час) - двоичным поиском границ
+    в рядах счетчиков вместо срезов по меткам времени.
+    """
+    try:
+        arrays = meter_arrays(data, series, type_m)
+    except Exception as e:
+        print(f"Ошибка обработки {meter_type}: {str(e)}")
+        return []
+    return fleet_anomalies(*arrays, params, meter_type)
+
+
+def fleet_anomalies(meter_ids, lengths, time, value, tz, params, meter_type):
+    """Аномалии рядов счетчиков, переданных массивами в формате meter_arrays (см. detect_fleet_anomalies)"""
+    results = []
+    try:
+        fleet = collect_fleet(meter_ids, lengths, time, value, tz)
+        if not len(fleet['value']):
+            return results
+        meter_ids = fleet['meter_ids']
+        group = fleet['group']
+        value = fleet['value']
+
+        def timestamp(row):
+            return pd.Timestamp(int(fleet['time'][row]), tz=fleet['tz'])
+
+        records = []
+        for row in _extreme_values(fleet, params):
+            val = float(value[row])
+            records.append((group[row], 0, row, {
+                'meter_id': str(meter_ids[group[row]]),
+                'time': timestamp(row),
+                'value': val,
+                'anomaly_type': 'extreme_value',
+                'description': f"Экстремальное значение: {val:.2f} л (порог: {params['extreme_threshold']} л)",
+                'meter_type': meter_type
+            }))
+
+        for row, median, mad in zip(*_z_scores(fleet, params)):
+            val = float(value[row])
+            records.append((group[row], 1, row, {
+                'meter_id': str(meter_ids[group[row]]),
+                'time': timestamp(row),
+                'value': val,
+                'anomaly_type': 'z_score',
+                'description': f"Стат. аномалия: {val:.2f} л (медиана: {float(median):.2f}, MAD: {float(mad):.2f})",
+                'meter_type': meter_type
+            }))
+
+        for first_row, last_row, avg_flow, cv in _night_leaks(fleet, params):
+            start, end = timestamp(first_row), timestamp(last_row)
+            duration = (end - start).total_seconds() / 3600
+            records.append((group[first_row], 2, first_row, {
+                'meter_id': str(meter_ids[group[first_row]]),
+                'time': start,
+                'end_time': end,
+                'value': avg_flow,
+                'anomaly_type': 'night_leak',
+                'description': f"Ночная протечка: {duration:.2f} ч, средний расход: {avg_flow:.2f} л (CV: {cv:.2f})",
+                'meter_type': meter_type
+            }))
+
+        # Порядок как при обходе по счетчикам: счетчик, правило, время
+        records.sort(key=lambda record: record[:3])
+        results = [record[3] for record in records]
+
+    except Exception as e:
+        print(f"Ошибка обработки {meter_type}: {str(e)}")
+
+    return results
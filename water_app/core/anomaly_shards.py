@@ -0,0 +1,79 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Частей на процесс: мелкие части выравнивают нагрузку, если ряды счетчиков разной длины
+SHARDS_PER_WORKER = 4
+
+
+def shard_bounds(lengths, shards):
+    """Границы частей (lo, hi) по счетчикам: непрерывные диапазоны с примерно равным числом строк"""
+    meters = len(lengths)
+    cumulative = np.cumsum(lengths)
+    if not meters or not cumulative[-1]:
+        return [(0, meters)] if meters else []
+    targets = cumulative[-1] * np.arange(1, shards) / shards
+    cuts = np.unique(np.r_[0, np.searchsorted(cumulative, targets, side='left') + 1, meters])
+    cuts = cuts[cuts <= meters]
+    return [(int(lo), int(hi)) for lo, hi in zip(cuts[:-1], cuts[1:])]
+
+
+def _share(array, blocks):
+    """Копирует массив в новый блок разделяемой памяти; возвращает (имя блока, тип)"""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(block)
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+    return block.name, array.dtype.str
+
+
+def _attach(spec, start, stop):
+    """Копия строк start:stop массива из блока разделяемой памяти"""
+    name, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        itemsize = np.dtype(dtype).itemsize
+        return np.ndarray(stop - start, dtype, buffer=block.buf, offset=start * itemsize).copy()
+    finally:
+        block.close()
+
+
+def _run_shard(task, specs, start, stop, meter_ids, lengths, tz, args):
+    """Задача процесса-исполнителя: читает строки своей части из разделяемой памяти и обрабатывает их task"""
+    time, value = (_attach(spec, start, stop) for spec in specs)
+    return task(meter_ids, lengths, time, value, tz, *args)
+
+
+def map_shards(task, jobs, workers):
+    """Обрабатывает ряды счетчиков по частям в пуле процессов.
+
+    jobs - список (meter_ids, lengths, time, value, tz, args) в формате
+    meter_arrays; task(meter_ids, lengths, time, value, tz, *args) - функция
+    уровня модуля, возвращающая список результатов по рядам части. Время
+    и показания копируются в разделяемую память один раз на задание, а
+    процессы читают из нее только строки своей части; по каналу процессов
+    передаются лишь ID счетчиков и длины рядов. Результаты частей
+    объединяются в порядке счетчиков, независимо от порядка завершения.
+    Возвращает список результатов для каждого задания.
+    """
+    blocks = []
+    try:
+        # spawn безопаснее fork для процесса с потоками Tk
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            job_futures = []
+            for meter_ids, lengths, time, value, tz, args in jobs:
+                specs = [_share(np.ascontiguousarray(time, dtype=np.int64), blocks),
+                         _share(np.ascontiguousarray(value, dtype='float64'), blocks)]
+                offsets = np.r_[0, np.cumsum(lengths)]
+                job_futures.append([
+                    executor.submit(_run_shard, task, specs, int(offsets[lo]), int(offsets[hi]),
+                                    list(meter_ids[lo:hi]), lengths[lo:hi], tz, args)
+                    for lo, hi in shard_bounds(lengths, workers * SHARDS_PER_WORKER)
+                ])
+            return [[item for future in futures for item in future.result()] for futures in job_futures]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
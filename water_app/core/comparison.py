@@ -1,13 +1,107 @@
+import numpy as np
 import pandas as pd
 from scipy import stats
 
+from core.aggregation import NS_PER_HOUR, hour_and_weekday, label_mask, total_m2
+from core.data_processing import rollup_for, sketch_for
+from core.report_context import run_sections
+from core.report_writer import emit, write
+from core.sketches import merge_sketches, sketch_quantiles
+
+
+# Классы счетчиков расхода: (колонка, значение)
+FLOW_CLASSES = [('Series', 'P1'), ('typeM', '/10266/1')]
+
+
+def _cell_totals(cells, mask):
+    """Строки, показания, сумма, центральная сумма квадратов, минимум, максимум и нули по ячейкам сводной таблицы"""
+    totals = {field: cells[field][mask].sum() for field in ['rows', 'count', 'sum', 'zeros']}
+    totals['m2'] = total_m2(cells['count'][mask], cells['sum'][mask], cells['m2'][mask]) if totals['count'] else 0.0
+    totals['min'] = np.nanmin(cells['min'][mask]) if totals['count'] else np.nan
+    totals['max'] = np.nanmax(cells['max'][mask]) if totals['count'] else np.nan
+    return totals
+
+
+def _rollup_median(df, classes, sketch=None):
+    """Медиана показаний классов счетчиков: по скетчам sketch или по показаниям строк df"""
+    if sketch is not None:
+        masks = [label_mask(sketch, column, value) for column, value in classes]
+        keys, counts = merge_sketches(*[(sketch['key'][mask], sketch['count'][mask]) for mask in masks])
+        integer = np.issubdtype(df['Value'].dtype, np.integer)
+        return np.float64(sketch_quantiles(keys, counts, [0.5], sketch['error'], integer)[0])
+
+    values = np.concatenate([df['Value'].to_numpy()[(df[column] == value).to_numpy()] for column, value in classes])
+    values = values[~pd.isna(values)]
+    return np.float64(np.median(values)) if len(values) else np.float64(np.nan)
+
+
+def _rollup_stats(df, cells, classes, sketch=None):
+    """Статистика показаний классов счетчиков по сводной таблице (типы значений - как у агрегатов pandas).
+
+    Медиана считается по скетчам sketch (режим приближенных квантилей) или по показаниям строк df.
+    """
+    totals = None
+    for column, value in classes:
+        class_totals = _cell_totals(cells, label_mask(cells, column, value))
+        if totals is None:
+            totals = class_totals
+        else:
+            # Строка, входящая в оба класса, учитывается дважды, как при объединении выборок
+            totals['m2'] = total_m2([totals['count'], class_totals['count']], [totals['sum'], class_totals['sum']],
+                                    [totals['m2'], class_totals['m2']])
+            for field in ['rows', 'count', 'sum', 'zeros']:
+                totals[field] += class_totals[field]
+            totals['min'] = np.fmin(totals['min'], class_totals['min'])
+            totals['max'] = np.fmax(totals['max'], class_totals['max'])
+
+    value_type = df['Value'].dtype.type
+    count = totals['count']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = totals['m2'] / (count - 1)
+    return {
+        'rows': int(totals['rows']),
+        'count': int(count),
+        'total': value_type(totals['sum']),
+        'mean': np.float64(totals['sum'] / count) if count else np.float64(np.nan),
+        'median': _rollup_median(df, classes, sketch),
+        'min': value_type(totals['min']) if count else np.float64(np.nan),
+        'max': value_type(totals['max']) if count else np.float64(np.nan),
+        'std': np.float64(np.sqrt(max(variance, 0))) if count > 1 else np.float64(np.nan),
+        'zero_readings': np.int64(totals['zeros']),
+    }
+
+
+def _rollup_patterns(cells, mask):
+    """Средний расход по часам суток и дням недели по часовым ячейкам сводной таблицы (None - ячеек нет)"""
+    if not mask.any():
+        return None
+
+    hours, weekdays = hour_and_weekday(cells['bucket'][mask] * NS_PER_HOUR)
+    patterns = {}
+    for name, groups, size in [('hourly', hours, 24), ('daily', weekdays, 7)]:
+        rows = np.bincount(groups, weights=cells['rows'][mask], minlength=size)
+        counts = np.bincount(groups, weights=cells['count'][mask], minlength=size)
+        sums = np.bincount(groups, weights=cells['sum'][mask], minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / counts
+        patterns[name] = {int(group): float(means[group]) for group in np.flatnonzero(rows)}
+    return patterns
+
 
 def compare_basic_consumption_stats(df1, df2):
     """1. Сравнение основных статистик потребления"""
-    output = "\n=== 1. Сравнение основных статистик потребления ===\n"
+    output = ["\n=== 1. Сравнение основных статистик потребления ===\n"]
 
     def get_consumption_stats(df, df_name):
         stats = {}
+        cells = rollup_for(df, 'day')
+        if cells is not None:
+            totals = _rollup_stats(df, cells, FLOW_CLASSES, sketch_for(df))
+            if totals['rows']:
+                stats = {key: totals[key] for key in ['total', 'mean', 'median', 'min', 'max', 'std']}
+                stats.update(count=totals['rows'], zero_readings=totals['zero_readings'])
+            return stats
+
         # Анализ для P1 счетчиков
         p1_data = df[df['Series'] == 'P1'].copy() if 'Series' in df.columns else pd.DataFrame()
         # Анализ для 10266/1 счетчиков
@@ -32,33 +126,40 @@ def compare_basic_consumption_stats(df1, df2):
     stats1 = get_consumption_stats(df1, "Первый датафрейм")
     stats2 = get_consumption_stats(df2, "Второй датафрейм")
 
-    output += "\nПервый датафрейм:\n"
+    output.append("\nПервый датафрейм:\n")
     for k, v in stats1.items():
-        output += f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n"
+        output.append(f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n")
 
-    output += "\nВторой датафрейм:\n"
+    output.append("\nВторой датафрейм:\n")
     for k, v in stats2.items():
-        output += f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n"
+        output.append(f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n")
 
     # Сравнение
     if stats1 and stats2:
-        output += "\nСравнение:\n"
-        output += f"Разница общего расхода: {stats1['total'] - stats2['total']:.2f} л\n"
-        output += f"Разница среднего расхода: {stats1['mean'] - stats2['mean']:.2f} л\n"
+        output.append("\nСравнение:\n")
+        output.append(f"Разница общего расхода: {stats1['total'] - stats2['total']:.2f} л\n")
+        output.append(f"Разница среднего расхода: {stats1['mean'] - stats2['mean']:.2f} л\n")
         if stats1['mean'] != 0:
-            output += f"Относительная разница среднего: {(stats1['mean'] - stats2['mean']) / stats1['mean'] * 100:.1f}%\n"
+            output.append(f"Относительная разница среднего: {(stats1['mean'] - stats2['mean']) / stats1['mean'] * 100:.1f}%\n")
 
-    return output
+    return "".join(output)
 
 
 def compare_meter_types_consumption(df1, df2):
     """2. Сравнение потребления по типам счетчиков"""
-    output = "\n=== 2. Сравнение потребления по типам счетчиков ===\n"
+    output = ["\n=== 2. Сравнение потребления по типам счетчиков ===\n"]
 
     def analyze_meter_type(df, type_col, type_val, df_name):
         if type_col not in df.columns:
             return None
 
+        cells = rollup_for(df, 'day')
+        if cells is not None:
+            totals = _rollup_stats(df, cells, [(type_col, type_val)], sketch_for(df))
+            if not totals['rows']:
+                return None
+            return {'count': totals['rows'], **{key: totals[key] for key in ['mean', 'median', 'total', 'max', 'min']}}
+
         data = df[df[type_col] == type_val].copy()
         if data.empty:
             return None
@@ -84,52 +185,56 @@ def compare_meter_types_consumption(df1, df2):
 
     # Вывод результатов
     if p1_stats1:
-        output += "\nПервый датафрейм - P1 счетчики:\n"
+        output.append("\nПервый датафрейм - P1 счетчики:\n")
         for k, v in p1_stats1.items():
-            output += f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n"
+            output.append(f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n")
 
     if mtype_stats1:
-        output += "\nПервый датафрейм - 10266/1 счетчики:\n"
+        output.append("\nПервый датафрейм - 10266/1 счетчики:\n")
         for k, v in mtype_stats1.items():
-            output += f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n"
+            output.append(f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n")
 
     if p1_stats2:
-        output += "\nВторой датафрейм - P1 счетчики:\n"
+        output.append("\nВторой датафрейм - P1 счетчики:\n")
         for k, v in p1_stats2.items():
-            output += f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n"
+            output.append(f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n")
 
     if mtype_stats2:
-        output += "\nВторой датафрейм - 10266/1 счетчики:\n"
+        output.append("\nВторой датафрейм - 10266/1 счетчики:\n")
         for k, v in mtype_stats2.items():
-            output += f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n"
+            output.append(f"{k}: {v:.2f}\n" if isinstance(v, (float, int)) else f"{k}: {v}\n")
 
     # Сравнение P1
     if p1_stats1 and p1_stats2:
-        output += "\nСравнение P1 счетчиков:\n"
+        output.append("\nСравнение P1 счетчиков:\n")
         diff = p1_stats1['mean'] - p1_stats2['mean']
-        output += f"Разница среднего расхода: {diff:.2f} л\n"
+        output.append(f"Разница среднего расхода: {diff:.2f} л\n")
         if p1_stats1['mean'] != 0:
-            output += f"Относительная разница: {diff / p1_stats1['mean'] * 100:.1f}%\n"
+            output.append(f"Относительная разница: {diff / p1_stats1['mean'] * 100:.1f}%\n")
 
     # Сравнение 10266/1
     if mtype_stats1 and mtype_stats2:
-        output += "\nСравнение 10266/1 счетчиков:\n"
+        output.append("\nСравнение 10266/1 счетчиков:\n")
         diff = mtype_stats1['mean'] - mtype_stats2['mean']
-        output += f"Разница среднего расхода: {diff:.2f} л\n"
+        output.append(f"Разница среднего расхода: {diff:.2f} л\n")
         if mtype_stats1['mean'] != 0:
-            output += f"Относительная разница: {diff / mtype_stats1['mean'] * 100:.1f}%\n"
+            output.append(f"Относительная разница: {diff / mtype_stats1['mean'] * 100:.1f}%\n")
 
-    return output
+    return "".join(output)
 
 
 def compare_temporal_patterns(df1, df2):
     """3. Сравнение временных паттернов потребления"""
-    output = "\n=== 3. Сравнение временных паттернов потребления ===\n"
+    output = ["\n=== 3. Сравнение временных паттернов потребления ===\n"]
 
     def get_temporal_stats(df, type_col, type_val, df_name):
         if type_col not in df.columns or 'time' not in df.columns:
             return None
 
+        cells = rollup_for(df, 'hour')
+        if cells is not None:
+            return _rollup_patterns(cells, label_mask(cells, type_col, type_val))
+
         data = df[df[type_col] == type_val].copy()
         if data.empty:
             return None
@@ -150,31 +255,45 @@ def compare_temporal_patterns(df1, df2):
 
     # Сравнение P1 счетчиков
     if p1_temp1 and p1_temp2:
-        output += "\nСравнение часовых паттернов P1:\n"
+        output.append("\nСравнение часовых паттернов P1:\n")
         for hour in range(24):
             val1 = p1_temp1['hourly'].get(hour, 0)
             val2 = p1_temp2['hourly'].get(hour, 0)
-            output += f"{hour:02}:00 - {val1:.2f} vs {val2:.2f} л\n"
+            output.append(f"{hour:02}:00 - {val1:.2f} vs {val2:.2f} л\n")
 
     # Сравнение 10266/1 счетчиков
     if mtype_temp1 and mtype_temp2:
-        output += "\nСравнение часовых паттернов 10266/1:\n"
+        output.append("\nСравнение часовых паттернов 10266/1:\n")
         for hour in range(24):
             val1 = mtype_temp1['hourly'].get(hour, 0)
             val2 = mtype_temp2['hourly'].get(hour, 0)
-            output += f"{hour:02}:00 - {val1:.2f} vs {val2:.2f} л\n"
+            output.append(f"{hour:02}:00 - {val1:.2f} vs {val2:.2f} л\n")
 
-    return output
+    return "".join(output)
 
 
 def perform_statistical_tests(df1, df2):
     """4. Статистические тесты для сравнения потребления"""
-    output = "\n=== 4. Статистические тесты для сравнения потребления ===\n"
+    output = ["\n=== 4. Статистические тесты для сравнения потребления ===\n"]
 
     def prepare_data(df, type_col, type_val):
+        """Количество, среднее и стандартное отклонение показаний класса (None - нет колонки)"""
         if type_col not in df.columns:
             return None
-        return df[df[type_col] == type_val]['Value'].dropna().values
+
+        # По сводной таблице моменты считаются без чтения показаний
+        cells = rollup_for(df, 'day')
+        if cells is not None:
+            totals = _cell_totals(cells, label_mask(cells, type_col, type_val))
+            count, total, m2 = int(totals['count']), totals['sum'], totals['m2']
+        else:
+            values = df[df[type_col] == type_val]['Value'].dropna().values.astype('float64')
+            count, total = len(values), values.sum()
+            m2 = ((values - total / count) ** 2).sum() if count else 0.0
+
+        if count < 2:
+            return count, np.nan, np.nan
+        return count, total / count, np.sqrt(max(m2 / (count - 1), 0))
 
     # Подготовка данных для P1
     p1_data1 = prepare_data(df1, 'Series', 'P1')
@@ -186,45 +305,49 @@ def perform_statistical_tests(df1, df2):
 
     # Тесты для P1
     if p1_data1 is not None and p1_data2 is not None:
-        if len(p1_data1) > 1 and len(p1_data2) > 1:
-            _, p_val = stats.ttest_ind(p1_data1, p1_data2, equal_var=False)
-            output += f"\nP1 счетчики - t-тест:\n"
-            output += f"p-value: {p_val:.4f} {'(значимо)' if p_val < 0.05 else '(не значимо)'}\n"
+        if p1_data1[0] > 1 and p1_data2[0] > 1:
+            p_val = welch_test(p1_data1, p1_data2)
+            output.append(f"\nP1 счетчики - t-тест:\n")
+            output.append(f"p-value: {p_val:.4f} {'(значимо)' if p_val < 0.05 else '(не значимо)'}\n")
 
     # Тесты для 10266/1
     if mtype_data1 is not None and mtype_data2 is not None:
-        if len(mtype_data1) > 1 and len(mtype_data2) > 1:
-            _, p_val = stats.ttest_ind(mtype_data1, mtype_data2, equal_var=False)
-            output += f"\n10266/1 счетчики - t-тест:\n"
-            output += f"p-value: {p_val:.4f} {'(значимо)' if p_val < 0.05 else '(не значимо)'}\n"
+        if mtype_data1[0] > 1 and mtype_data2[0] > 1:
+            p_val = welch_test(mtype_data1, mtype_data2)
+            output.append(f"\n10266/1 счетчики - t-тест:\n")
+            output.append(f"p-value: {p_val:.4f} {'(значимо)' if p_val < 0.05 else '(не значимо)'}\n")
 
-    return output
+    return "".join(output)
 
 
-def perform_comparison(df1, modes, df2):
-    """Основная функция сравнения двух датафреймов по потреблению воды"""
-    if df1 is None or df2 is None:
-        return "Ошибка: Один или оба датафрейма отсутствуют"
+def welch_test(sample1, sample2):
+    """p-value t-теста Уэлча по (количество, среднее, отклонение) двух выборок"""
+    (count1, mean1, std1), (count2, mean2, std2) = sample1, sample2
+    return stats.ttest_ind_from_stats(mean1, std1, count1, mean2, std2, count2, equal_var=False).pvalue
 
-    if not modes:
-        return "Ошибка: Не выбраны режимы сравнения"
-
-    output = "=== СРАВНЕНИЕ ПОТРЕБЛЕНИЯ ВОДЫ ===\n"
-
-    # 1. Основные статистики потребления
-    if 1 in modes:
-        output += compare_basic_consumption_stats(df1, df2)
 
-    # 2. Сравнение по типам счетчиков
-    if 2 in modes:
-        output += compare_meter_types_consumption(df1, df2)
+def perform_comparison(df1, modes, df2, writer=None):
+    """Основная функция сравнения двух датафреймов по потреблению воды.
 
-    # 3. Временные паттерны
-    if 3 in modes:
-        output += compare_temporal_patterns(df1, df2)
-
-    # 4. Статистические тесты
-    if 4 in modes:
-        output += perform_statistical_tests(df1, df2)
+    Если передан писатель отчета writer, разделы передаются ему по мере
+    готовности и функция возвращает None, иначе возвращается текст отчета.
+    """
+    if df1 is None or df2 is None:
+        return emit(writer, "Ошибка: Один или оба датафрейма отсутствуют")
 
-    return output
\ No newline at end of file
+    if not modes:
+        return emit(writer, "Ошибка: Не выбраны режимы сравнения")
+
+    header = "=== СРАВНЕНИЕ ПОТРЕБЛЕНИЯ ВОДЫ ===\n"
+
+    # Разделы выбранных режимов считаются параллельно (см. run_sections)
+    sections = {
+        1: lambda out: write(out, compare_basic_consumption_stats(df1, df2)),  # 1. Основные статистики потребления
+        2: lambda out: write(out, compare_meter_types_consumption(df1, df2)),  # 2. Сравнение по типам счетчиков
+        3: lambda out: write(out, compare_temporal_patterns(df1, df2)),  # 3. Временные паттерны
+        4: lambda out: write(out, perform_statistical_tests(df1, df2)),  # 4. Статистические тесты
+    }
+    if writer is not None:
+        emit(writer, header)
+        return run_sections(sections, modes, writer=writer)
+    return header + run_sections(sections, modes)
\ No newline at end of file
@@ -1,19 +1,64 @@
+import csv
+import glob
+import multiprocessing
+import os
+import shutil
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 
-def load_data(file_path):
-    """Загружает данные из CSV-файла с автоматическим определением разделителя"""
+from core import metadata, meter_store, online_detection, rollups, sketches, storage
+from core.aggregation import NS_PER_HOUR
+from core.timestamps import infer_time_format, is_utc, normalize_time, time_epoch, utc_time
+
+# Ограничение памяти для потоковой загрузки показаний (в мегабайтах)
+STREAMING_MEMORY_LIMIT_MB = 512
+# Во сколько раз разобранный и объединенный блок больше оценки по образцу
+STREAMING_OVERHEAD = 3
+
+# Типы строковых колонок показаний (одинаковые для всех файлов и блоков)
+READINGS_DTYPES = {'typeM': str, 'Series': str, 'Unit': str}
+
+METER_DATA_FILE = 'dataset/combined_data.csv'
+LOCATION_DATA_FILE = 'dataset/managedobject_details.csv'
+
+# Состояние ленивого режима: источник показаний, поток подготовки кэша и его результат
+_lazy_state = {'meter_source': None, 'thread': None, 'cache_ready': False, 'data': None}
+
+# Индексы строк загруженных датафреймов: id(df) -> (weakref на df, {имя индекса: индекс})
+_row_indexes = {}
+
+# Колонки с повторяющимися значениями, которые хранятся как категории (словарь + коды)
+CATEGORICAL_COLUMNS = ['ManagedObjectid', 'Series', 'typeM', 'Unit', 'suburb', 'meter_type', 'usage_type']
+# Колонки фильтров, для значений которых строятся битовые индексы строк
+BITMAP_COLUMNS = ['suburb', 'usage_type', 'meter_type', 'typeM']
+
+
+def detect_delimiter(file_path):
+    """Определяет разделитель CSV-файла по первым 2 КБ"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        sample = f.read(2048)
+    return ',' if ',' in sample else ';' if ';' in sample else '\t'
+
+
+def load_data(file_path, time_format=None, dtype=None):
+    """Загружает данные из CSV-файла с автоматическим определением разделителя.
+
+    Время разбирается один раз (в UTC); формат времени сохраняется в df.attrs['time_format'].
+    """
     try:
         # Автоматическое определение разделителя
-        with open(file_path, 'r', encoding='utf-8') as f:
-            sample = f.read(2048)
-            delimiter = ',' if ',' in sample else ';' if ';' in sample else '\t'
+        delimiter = detect_delimiter(file_path)
 
-        df = pd.read_csv(file_path, sep=delimiter, low_memory=False)
+        df = pd.read_csv(file_path, sep=delimiter, low_memory=False, dtype=dtype)
 
         # Преобразование времени
         if 'time' in df.columns:
-            df['time'] = pd.to_datetime(df['time'], errors='coerce', utc=True)
+            df.attrs['time_format'] = normalize_time(df, time_format)
 
         print(f"Загружено {len(df)} строк из {file_path}")
         return df
@@ -23,52 +68,612 @@ def load_data(file_path):
         return None
 
 
+def detect_time_format(file_path, sample_rows=1000):
+    """Определяет формат времени файла показаний по первым строкам"""
+    sample = pd.read_csv(file_path, sep=detect_delimiter(file_path), nrows=sample_rows, dtype=READINGS_DTYPES)
+    return infer_time_format(sample['time']) if 'time' in sample.columns else None
+
+
+def estimate_chunk_size(file_path, memory_limit_mb=STREAMING_MEMORY_LIMIT_MB, sample_rows=1000):
+    """Подбирает размер блока (в строках) так, чтобы блок укладывался в лимит памяти"""
+    sample = pd.read_csv(file_path, sep=detect_delimiter(file_path), nrows=sample_rows)
+    if sample.empty:
+        return sample_rows
+
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+    chunk_size = int(memory_limit_mb * 1024 * 1024 / (bytes_per_row * STREAMING_OVERHEAD))
+    return max(chunk_size, sample_rows)
+
+
+def _coerce_readings(chunk, time_format=None):
+    """Приводит типы колонок показаний: время UTC, числовые Value и ID счетчика.
+
+    Формат времени (известный или определенный по блоку) сохраняется в chunk.attrs['time_format'].
+    """
+    if 'time' in chunk.columns:
+        time_format = normalize_time(chunk, time_format)
+    if 'Value' in chunk.columns:
+        chunk['Value'] = pd.to_numeric(chunk['Value'], errors='coerce')
+
+    # Строки без корректного ID счетчика нельзя связать с метаданными
+    chunk['ManagedObjectid'] = pd.to_numeric(chunk['ManagedObjectid'], errors='coerce')
+    chunk = chunk.dropna(subset=['ManagedObjectid'])
+    chunk['ManagedObjectid'] = chunk['ManagedObjectid'].astype('int64')
+    chunk.attrs['time_format'] = time_format
+    return chunk
+
+
+def stream_data(file_path, memory_limit_mb=STREAMING_MEMORY_LIMIT_MB, time_format=None):
+    """Потоково читает показания блоками и приводит типы колонок.
+
+    Генератор: исходный CSV целиком в память не загружается, одновременно
+    обрабатывается только один блок размером не больше memory_limit_mb.
+    Формат времени определяется по первому блоку и используется для остальных.
+    """
+    chunk_size = estimate_chunk_size(file_path, memory_limit_mb)
+    print(f"Потоковая загрузка {file_path} блоками по {chunk_size} строк")
+
+    reader = pd.read_csv(
+        file_path,
+        sep=detect_delimiter(file_path),
+        chunksize=chunk_size,
+        dtype=READINGS_DTYPES
+    )
+
+    total = 0
+    for chunk in reader:
+        chunk = _coerce_readings(chunk, time_format)
+        time_format = chunk.attrs['time_format']
+        total += len(chunk)
+        yield chunk
+
+    print(f"Загружено {total} строк из {file_path}")
+
+
+def resolve_sources(meter_source):
+    """Возвращает список CSV-файлов показаний: файл, каталог (все *.csv) или glob-шаблон"""
+    if os.path.isdir(meter_source):
+        return sorted(glob.glob(os.path.join(meter_source, '*.csv')))
+    if glob.has_magic(meter_source):
+        return sorted(glob.glob(meter_source))
+    return [meter_source]
+
+
+def _parse_readings_file(file_path, nrows=None, time_format=None):
+    """Читает один файл показаний и приводит типы колонок"""
+    chunk = pd.read_csv(file_path, sep=detect_delimiter(file_path), dtype=READINGS_DTYPES, nrows=nrows)
+    return _coerce_readings(chunk, time_format)
+
+
+def _parse_readings_tail(file_path, offset, time_format=None):
+    """Читает из файла показаний только строки, дописанные после смещения offset (в байтах)"""
+    delimiter = detect_delimiter(file_path)
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        columns = next(csv.reader([f.readline()], delimiter=delimiter))
+
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        chunk = pd.read_csv(f, sep=delimiter, header=None, names=columns, dtype=READINGS_DTYPES)
+
+    return _coerce_readings(chunk, time_format)
+
+
+def _source_details(df, time_format=None):
+    """Сведения о загруженном файле для манифеста: формат времени"""
+    return {'time_format': df.attrs.get('time_format', time_format) if df is not None else time_format}
+
+
+def _ingest_file(file_path, part_dir, part_name, schema, time_format=None):
+    """Задача процесса-исполнителя: разбирает файл и пишет его частью кэша Parquet.
+
+    Возвращает количество строк и сведения о файле для манифеста.
+    """
+    chunk = _parse_readings_file(file_path, time_format=time_format)
+    return storage.write_part(chunk, part_dir, part_name, schema), _source_details(chunk)
+
+
+def ingest_files(meter_files, workers=None, time_formats=None):
+    """Параллельно разбирает файлы показаний в пуле процессов.
+
+    Если доступен pyarrow, каждый процесс сам пишет свою часть кэша, и основной
+    процесс только читает готовое колоночное хранилище. Иначе процессы
+    возвращают датафреймы, которые объединяются одним pd.concat.
+    time_formats - известные форматы времени файлов (из манифеста прошлой сборки).
+    Файлы, которые не удалось разобрать, пропускаются с сообщением об ошибке.
+    Возвращает количество строк и сведения о файлах (с кэшем)
+    или объединенный датафрейм.
+    """
+    time_formats = time_formats or {}
+    workers = min(workers or os.cpu_count() or 1, len(meter_files))
+    print(f"Параллельная загрузка {len(meter_files)} файлов в {workers} процессах")
+
+    # spawn безопаснее fork для процесса с потоками Tk
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        if storage.is_available():
+            schema = _sample_schema(meter_files)
+            tmp_dir = storage.new_readings_dir()
+            try:
+                futures = [
+                    executor.submit(_ingest_file, file_path, tmp_dir, f'part-{i:05d}.parquet', schema,
+                                    time_formats.get(file_path))
+                    for i, file_path in enumerate(meter_files)
+                ]
+                results = _collect_results(meter_files, futures)
+                storage.commit_readings_dir(tmp_dir)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            rows = sum(part_rows for part_rows, _ in results.values())
+            details = {file_path: file_details for file_path, (_, file_details) in results.items()}
+            print(f"Загружено {rows} строк из {len(results)} файлов")
+            return rows, details
+
+        futures = [executor.submit(_parse_readings_file, file_path, None, time_formats.get(file_path))
+                   for file_path in meter_files]
+        frames = list(_collect_results(meter_files, futures).values())
+
+    combined = pd.concat(frames, ignore_index=True, copy=False) if frames else pd.DataFrame()
+    print(f"Загружено {len(combined)} строк из {len(frames)} файлов")
+    return combined
+
+
+def _sample_schema(meter_files, sample_rows=1000):
+    """Общая схема частей кэша по началу первого файла, который удалось разобрать"""
+    for file_path in meter_files:
+        try:
+            return storage.readings_schema(_parse_readings_file(file_path, nrows=sample_rows))
+        except Exception as e:
+            print(f"Ошибка при загрузке {file_path}: {str(e)}")
+    return None
+
+
+def _collect_results(meter_files, futures):
+    """Результаты задач по файлам {файл: результат}; файлы, которые не удалось разобрать, пропускаются"""
+    results = {}
+    for file_path, future in zip(meter_files, futures):
+        try:
+            results[file_path] = future.result()
+        except Exception as e:
+            print(f"Ошибка при загрузке {file_path}: {str(e)}")
+    return results
+
+
 def merge_datasets(meter_data, location_data):
-    """Объединяет данные показаний счетчиков с метаданными"""
+    """Объединяет данные показаний счетчиков с метаданными.
+
+    Метаданные подставляются через реестр (векторный поиск по ID счетчика)
+    вместо pd.merge: строки показаний не дублируются и сохраняют порядок.
+    """
     if meter_data is None:
         return None
 
     try:
-        # Автоматическое определение ID колонок
-        meter_id_col = 'ManagedObjectid'
-        loc_id_col = 'managedObjects_id' if 'managedObjects_id' in location_data.columns else 'ManagedObjectid'
-
-        merged = pd.merge(
-            meter_data,
-            location_data,
-            left_on=meter_id_col,
-            right_on=loc_id_col,
-            how='left'
-        )
-
-        # Стандартизация названий колонок
-        if 'Suburb' in merged.columns:
-            merged.rename(columns={'Suburb': 'suburb'}, inplace=True)
-        if 'Meter Type' in merged.columns:
-            merged.rename(columns={'Meter Type': 'meter_type'}, inplace=True)
-        if 'Usage Type' in merged.columns:
-            merged.rename(columns={'Usage Type': 'usage_type'}, inplace=True)
-
-        return merged
+        return metadata.attach_metadata(meter_data, metadata.build_registry(location_data))
 
     except Exception as e:
         print(f"Ошибка при объединении данных: {e}")
         return meter_data
 
-def initialization_data():
-    METER_DATA_FILE = 'dataset/combined_data.csv'
-    LOCATION_DATA_FILE = 'dataset/managedobject_details.csv'
+def compact_dataset(df, columns=None):
+    """Сжимает объединенный датафрейм: категории вместо строк и узкий тип для Value.
 
-    # 1. Загрузка данных
-    print("Загрузка данных...")
-    meter_data = load_data(METER_DATA_FILE)
-    location_data = load_data(LOCATION_DATA_FILE)
+    Повторяющиеся колонки переводятся в категории (словарь значений + целочисленные
+    коды). Value сужается до целого типа, если все показания целые; дробные
+    показания остаются float64, так как float32 теряет точность в суммах.
+    """
+    if df is None or df.empty:
+        return df
+
+    memory_before = df.memory_usage(deep=True).sum()
+
+    for col in columns or CATEGORICAL_COLUMNS:
+        if col not in df.columns:
+            continue
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+        elif not df[col].cat.categories.is_monotonic_increasing:
+            # Из кэша категории приходят в порядке появления; сортируем их,
+            # чтобы группировки выдавали тот же порядок, что и для строк
+            df[col] = df[col].cat.reorder_categories(df[col].cat.categories.sort_values())
+
+    if 'Value' in df.columns and pd.api.types.is_numeric_dtype(df['Value']):
+        values = df['Value']
+        if values.notna().all() and (values % 1 == 0).all():
+            df['Value'] = pd.to_numeric(values, downcast='integer')
+
+    memory_after = df.memory_usage(deep=True).sum()
+    saved = memory_before - memory_after
+    print(f"Сжатие данных: {memory_before / 2 ** 20:.1f} МБ -> {memory_after / 2 ** 20:.1f} МБ "
+          f"(экономия {saved / 2 ** 20:.1f} МБ, {saved / memory_before * 100 if memory_before else 0:.0f}%)")
+    df.attrs['memory_saved'] = int(saved)
+
+    return df
+
+
+def remove_unused_categories(df):
+    """Удаляет из категориальных колонок значения, которых нет в выборке"""
+    if df is None:
+        return df
+
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.remove_unused_categories()
+    return df
+
+
+def _category_mask(series, predicate):
+    """Строит булеву маску по предикату.
+
+    Для категориальной колонки предикат вычисляется один раз для каждой
+    категории, а маска строк получается выборкой по целочисленным кодам.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = pd.Series(series.cat.categories)
+        matches = np.append(np.asarray(predicate(categories), dtype=bool), False)  # код -1 (NaN) -> False
+        return pd.Series(matches[series.cat.codes.to_numpy()], index=series.index)
+
+    return pd.Series(np.asarray(predicate(series), dtype=bool), index=series.index)
+
+
+def isin_mask(series, values, normalize=None):
+    """Маска строк, значения которых (после нормализации) входят в values"""
+    if normalize is None:
+        return _category_mask(series, lambda s: s.isin(values))
+    return _category_mask(series, lambda s: normalize(s).isin(values))
+
+
+def startswith_mask(series, prefix):
+    """Маска строк, строковые значения которых начинаются с prefix"""
+    return _category_mask(series, lambda s: s.astype(str).str.startswith(prefix))
+
+
+def _recent_readings():
+    """Показания серий онлайн-детектора за последние месяцы кэша (история для заполнения его окон)"""
+    return storage.read_readings(columns=['ManagedObjectid', 'typeM', 'Series', 'time', 'Value'],
+                                 categorical=CATEGORICAL_COLUMNS, start=storage.recent_start(),
+                                 values={'Series': ['P1', '1']})
+
+
+def update_cached(plan, manifest):
+    """Дозагружает в кэш новые файлы и дописанные части файлов показаний.
+
+    Каждый новый фрагмент разбирается отдельно и дописывается новой частью
+    кэша, поэтому время обновления пропорционально объему новых данных.
+    Части становятся видимыми только вместе с записью manifest (сигнатуры
+    и форматы времени обновленных файлов); при ошибке они удаляются, и кэш
+    остается прежним. Для дописанных файлов используется уже известный формат времени.
+    Файлы, которые не удалось разобрать, пропускаются и в manifest не попадают.
+    Новые показания проверяет онлайн-детектор аномалий (core.online_detection).
+    Возвращает количество добавленных строк.
+    """
+    if not plan['new'] and not plan['appended']:
+        storage.write_manifest(manifest)
+        return 0
+
+    time_formats = storage.time_formats(manifest)
+    updated = {}
+    details = {}
+    alerts = []
+    rows = 0
+
+    # Сводные таблицы, построенные по текущему кэшу, дополняются агрегатами новых строк
+    rollup = rollups.open_rollup()
+    if rollup is not None and rollup['signature'] != storage.cache_signature(manifest):
+        rollup = None
+    # Онлайн-детектор проверяет только новые показания, продолжая с состояния по текущему кэшу
+    detector = online_detection.sync_detector(storage.cache_signature(manifest), _recent_readings)
+
+    # Части, оставшиеся от прерванного обновления, манифест не учитывает
+    storage.discard_staged()
+    try:
+        # Новые файлы читаются целиком, дописанные - с известного смещения
+        tasks = [(file_path, None) for file_path in plan['new']] + list(plan['appended'].items())
+        for file_path, offset in tasks:
+            try:
+                if offset is None:
+                    chunk = _parse_readings_file(file_path)
+                else:
+                    chunk = _parse_readings_tail(file_path, offset, time_formats.get(file_path))
+            except Exception as e:
+                # Файл не попадает в манифест и будет прочитан снова при следующем обновлении
+                print(f"Ошибка при загрузке {file_path}: {str(e)}")
+                continue
+
+            rows += storage.stage_part(chunk)
+            if rollup is not None:
+                rollup = rollups.merge_rollups(rollup, rollups.build_rollup(chunk))
+            alerts.append(online_detection.consume(detector, chunk))
+            updated[file_path] = file_path
+            details[file_path] = _source_details(chunk)
+            if offset is None:
+                print(f"Новый файл {file_path}: добавлено {len(chunk)} строк")
+            else:
+                print(f"Файл {file_path} дописан: добавлено {len(chunk)} строк")
+
+        storage.update_manifest(manifest, updated, rows, details)
+        storage.commit_staged(manifest)
+    except Exception:
+        storage.discard_staged()
+        raise
+
+    for found in alerts:
+        online_detection.report_alerts(found)
+    if rollup is not None:
+        rollup['signature'] = storage.cache_signature(manifest)
+        rollups.save_rollup(rollup)
+    detector['signature'] = storage.cache_signature(manifest)
+    online_detection.save_detector(detector)
+    return rows
+
+
+def _prepare_loaded(readings, registry, build_store=True, partial=False):
+    """Сжимает загруженные показания, подставляет метаданные и открывает хранилище серий.
+
+    Для полного набора показаний (partial=False) открываются сводные таблицы;
+    они сохраняются рядом с кэшем, если данные загружены из него (build_store).
+    Тогда же онлайн-детектор заполняется историей показаний, если его
+    контрольная точка построена не по этому кэшу.
+    """
+    combined_data = compact_dataset(readings)
+    combined_data = metadata.attach_metadata(combined_data, registry)
+    # Хранилище серий и сводные таблицы привязаны к содержимому кэша, из которого загружены данные
+    signature = storage.cache_signature(storage.read_manifest()) if build_store else None
+    if build_store:
+        meter_store.load_or_build(combined_data, signature=signature)
+    if not partial and combined_data is not None:
+        rollups.load_or_build(combined_data, persist=build_store, signature=signature)
+        if build_store:
+            online_detection.sync_detector(signature, lambda: combined_data)
+        combined_data.attrs['filters'] = {}
+    return combined_data
+
+
+def load_merged_data(meter_source, location_file, use_cache=True, streaming=None,
+                     memory_limit_mb=STREAMING_MEMORY_LIMIT_MB, workers=None):
+    """Загружает объединенные данные из кэша Parquet, пересобирая его при изменении CSV.
+
+    meter_source - файл показаний, каталог с CSV или glob-шаблон; несколько файлов
+    разбираются параллельно в пуле процессов. streaming=None включает потоковую
+    загрузку одного файла автоматически, если он больше лимита памяти memory_limit_mb.
+    В кэше хранятся только показания; метаданные счетчиков подставляются при
+    загрузке из реестра, поэтому изменение файла метаданных не требует пересборки кэша.
+    """
+    meter_files = resolve_sources(meter_source)
+    if not meter_files:
+        print(f"Не найдены файлы показаний: {meter_source}")
+        return None
+
+    registry = metadata.build_registry(load_data(location_file))
+    metadata.set_active_registry(registry)
+
+    sources = {file_path: file_path for file_path in meter_files}
+    manifest = storage.read_manifest() if storage.is_available() else None
+    # Форматы времени, определенные при прошлой сборке кэша
+    time_formats = storage.time_formats(manifest)
+
+    if use_cache and storage.is_available():
+        # Новые файлы и дописанные строки догружаются в кэш без повторного разбора истории
+        plan = storage.plan_update(manifest, sources)
+        if plan is not None:
+            try:
+                update_cached(plan, manifest)
+                readings = storage.read_readings(categorical=CATEGORICAL_COLUMNS)
+            except Exception as e:
+                print(f"Ошибка обновления кэша {storage.CACHE_DIR}: {e}")
+                readings = None
+
+            if readings is not None:
+                print(f"Загружено {len(readings)} строк из кэша {storage.CACHE_DIR}")
+                return _prepare_loaded(readings, registry)
+
+    # Кэш пересобирается с нуля: состояние детектора описывало прежние показания
+    online_detection.reset_detector()
+    if len(meter_files) > 1:
+        result = ingest_files(meter_files, workers, time_formats)
+        if isinstance(result, pd.DataFrame):
+            return _prepare_loaded(result, registry, build_store=False)
+
+        # В манифест попадают только разобранные файлы, остальные будут прочитаны при следующем обновлении
+        rows, details = result
+        storage.save_manifest({file_path: file_path for file_path in details}, rows, details=details)
+        return _prepare_loaded(storage.read_readings(categorical=CATEGORICAL_COLUMNS), registry)
+
+    meter_file = meter_files[0]
+    if streaming is None:
+        streaming = os.path.getsize(meter_file) > memory_limit_mb * 1024 * 1024
+
+    if streaming and storage.is_available():
+        # Блоки сразу пишутся в кэш, затем читается уже компактное колоночное хранилище
+        time_format = time_formats.get(meter_file) or detect_time_format(meter_file)
+        chunks = stream_data(meter_file, memory_limit_mb, time_format)
+        if storage.save_cached(chunks, sources):
+            readings = storage.read_readings(categorical=CATEGORICAL_COLUMNS)
+            storage.record_details({meter_file: _source_details(readings, time_format)})
+            return _prepare_loaded(readings, registry)
+        print("Не удалось выполнить потоковую загрузку, загружаем файл целиком")
+
+    meter_data = load_data(meter_file, time_formats.get(meter_file), dtype=READINGS_DTYPES)
+    if meter_data is not None:
+        # Те же типы колонок и отбор строк, что при потоковой и параллельной загрузке
+        try:
+            meter_data = _coerce_readings(meter_data, meter_data.attrs.get('time_format'))
+        except Exception as e:
+            print(f"Ошибка при загрузке {meter_file}: {str(e)}")
+            meter_data = None
+    meter_data = compact_dataset(meter_data)
+    cached = use_cache and meter_data is not None and storage.save_cached(
+        meter_data, sources, details={meter_file: _source_details(meter_data)})
+    if cached:
+        print(f"Кэш данных сохранен в {storage.CACHE_DIR}")
+
+    return _prepare_loaded(meter_data, registry, build_store=cached)
+
+
+def ensure_cache(meter_source, workers=None, memory_limit_mb=STREAMING_MEMORY_LIMIT_MB):
+    """Приводит кэш Parquet в соответствие с файлами показаний, не загружая их в память.
+
+    Возвращает True, если кэш готов к чтению.
+    """
+    meter_files = resolve_sources(meter_source)
+    if not meter_files or not storage.is_available():
+        return False
+
+    sources = {file_path: file_path for file_path in meter_files}
+    manifest = storage.read_manifest()
+    plan = storage.plan_update(manifest, sources)
+    if plan is not None:
+        try:
+            update_cached(plan, manifest)
+            return True
+        except Exception as e:
+            print(f"Ошибка обновления кэша {storage.CACHE_DIR}: {e}")
+
+    # Кэш пересобирается с нуля: детектор заново заполняется историей нового кэша
+    online_detection.reset_detector()
+    time_formats = storage.time_formats(manifest)
+    if len(meter_files) > 1:
+        rows, details = ingest_files(meter_files, workers, time_formats)
+        storage.save_manifest({file_path: file_path for file_path in details}, rows, details=details)
+        online_detection.sync_detector(storage.cache_signature(storage.read_manifest()), _recent_readings)
+        return True
+
+    # Один файл записывается в кэш потоково, блоками в пределах лимита памяти
+    meter_file = meter_files[0]
+    time_format = time_formats.get(meter_file) or detect_time_format(meter_file)
+    if not storage.save_cached(stream_data(meter_file, memory_limit_mb, time_format), sources):
+        return False
+    storage.record_details({meter_file: {'time_format': time_format}})
+    online_detection.sync_detector(storage.cache_signature(storage.read_manifest()), _recent_readings)
+    return True
+
+
+def build_time_partitions(df):
+    """Разбивает строки датафрейма по месяцам (UTC).
+
+    Возвращает номера строк, упорядоченные по месяцу (внутри месяца - в исходном
+    порядке), границы месяцев в этом массиве и начало каждого месяца (нс UTC).
+    Строки без времени в разбиение не попадают.
+    """
+    months = time_epoch(df).view('datetime64[ns]').astype('datetime64[M]')
+    positions = np.flatnonzero(~np.isnat(months))
+    positions = positions[np.argsort(months[positions], kind='stable')]
+
+    sorted_months = months[positions]
+    starts = np.flatnonzero(np.r_[True, sorted_months[1:] != sorted_months[:-1]]) if len(positions) else np.array([], dtype=int)
+    return {
+        'rows': len(df),
+        'positions': positions,
+        'offsets': np.append(starts, len(positions)),
+        'months': sorted_months[starts].astype('datetime64[ns]').view('i8'),
+    }
+
+
+def build_meter_index(df):
+    """Упорядочивает строки по (счетчик, время).
+
+    Возвращает перестановку строк, время строк в этом порядке (нс UTC),
+    смещения начала строк каждого счетчика и код каждого счетчика (по строке ID).
+    Внутри счетчика строки без времени идут первыми.
+    """
+    meters = df['ManagedObjectid']
+    if not isinstance(meters.dtype, pd.CategoricalDtype):
+        meters = meters.astype('category')
+    codes = meters.cat.codes.to_numpy()
+    times = time_epoch(df)
+
+    positions = np.lexsort((times, codes))
+    offsets = np.searchsorted(codes[positions], np.arange(len(meters.cat.categories) + 1))
+    return {
+        'rows': len(df),
+        'positions': positions,
+        'times': times[positions],
+        'offsets': offsets,
+        'codes': {str(meter): code for code, meter in enumerate(meters.cat.categories)},
+    }
+
+
+def build_value_bitmaps(df):
+    """Строит битовые индексы строк для каждого значения категориальных колонок BITMAP_COLUMNS.
+
+    Для каждой категории хранится упакованная маска строк (бит на строку):
+    выбор нескольких значений - OR масок, фильтры по нескольким колонкам - AND.
+    """
+    columns = {}
+    for column in BITMAP_COLUMNS:
+        if column not in df.columns or not isinstance(df[column].dtype, pd.CategoricalDtype):
+            continue
+        codes = df[column].cat.codes.to_numpy()
+        categories = df[column].cat.categories
+        bitmaps = np.empty((len(categories), (len(df) + 7) // 8), dtype=np.uint8)
+        for code in range(len(categories)):
+            bitmaps[code] = np.packbits(codes == code)
+        columns[column] = {'categories': categories, 'bitmaps': bitmaps}
+    return {'rows': len(df), 'columns': columns}
+
+
+def _register_index(df, name, index):
+    """Сохраняет индекс строк датафрейма в реестре (запись удаляется вместе с датафреймом)"""
+    key = id(df)
+    entry = _row_indexes.get(key)
+    if entry is None or entry[0]() is not df:
+        entry = (weakref.ref(df, lambda _, key=key: _row_indexes.pop(key, None)), {})
+        _row_indexes[key] = entry
+    entry[1][name] = index
+    return index
+
+
+def _get_index(df, name):
+    """Возвращает индекс строк, построенный для этого датафрейма (или None)"""
+    entry = _row_indexes.get(id(df))
+    if entry is None or entry[0]() is not df:
+        return None
+    index = entry[1].get(name)
+    if index is None or index['rows'] != len(df):
+        return None
+    return index
+
+
+def register_indexes(df):
+    """Строит индексы строк загруженного датафрейма для быстрой фильтрации"""
+    if df is None or df.empty or 'time' not in df.columns or not is_utc(df['time']):
+        return
+    register_time_partitions(df)
+    if 'ManagedObjectid' in df.columns:
+        _register_index(df, 'meters', build_meter_index(df))
+    _register_index(df, 'values', build_value_bitmaps(df))
+
+
+def register_time_partitions(df):
+    """Строит разбиение по месяцам для датафрейма, чтобы фильтр по датам просматривал только нужные месяцы"""
+    if df is None or df.empty or 'time' not in df.columns or not is_utc(df['time']):
+        return None
+    return _register_index(df, 'months', build_time_partitions(df))
 
-    # 2. Объединение данных
-    combined_data = merge_datasets(meter_data, location_data)
+
+def get_time_partitions(df):
+    """Возвращает разбиение по месяцам, построенное для этого датафрейма (или None)"""
+    return _get_index(df, 'months')
+
+
+def get_meter_index(df):
+    """Возвращает индекс (счетчик, время), построенный для этого датафрейма (или None)"""
+    return _get_index(df, 'meters')
+
+
+def get_value_bitmaps(df):
+    """Возвращает битовые индексы значений, построенные для этого датафрейма (или None)"""
+    return _get_index(df, 'values')
+
+
+def initialization_data(meter_source=None):
+    # 1. Загрузка и объединение данных (с использованием кэша)
+    # meter_source может указывать на каталог или glob-шаблон с несколькими выгрузками
+    print("Загрузка данных...")
+    combined_data = load_merged_data(meter_source or METER_DATA_FILE, LOCATION_DATA_FILE)
     if combined_data is None:
         print("Не удалось объединить данные")
             #return
+    register_indexes(combined_data)
 
     filter_options = {
         'available_meters': combined_data[
@@ -79,47 +684,414 @@ def initialization_data():
             'typeM'].dropna().unique().tolist() if 'typeM' in combined_data.columns else [],
     }
 
-    filters = {
+    return combined_data, filter_options, default_filters()
+
+
+def default_filters():
+    """Пустой набор фильтров"""
+    return {
         'start_date': None,
         'end_date': None,
         'meter_ids': None,
         'cities': None,
         'meter_types': None,
-        'usage_types': None
+        'usage_types': None,
+        'measurement_types': None
+    }
+
+
+def initialization_options(meter_source=None):
+    """Ленивый режим: готовит варианты фильтров только по файлу метаданных.
+
+    Показания не загружаются; кэш Parquet подготавливается в фоновом потоке,
+    а нужные показания читаются функцией load_readings при построении отчета.
+    """
+    print("Загрузка метаданных счетчиков...")
+    registry = metadata.build_registry(load_data(LOCATION_DATA_FILE))
+    metadata.set_active_registry(registry)
+
+    def categories(name):
+        column = registry['columns'].get(name, {}) if registry else {}
+        return column['categories'].tolist() if 'categories' in column else []
+
+    filter_options = {
+        'available_meters': registry['ids'].tolist() if registry else [],
+        'available_cities': categories('suburb'),
+        'available_meter_types': categories('meter_type'),
     }
 
-    return combined_data, filter_options, filters
+    _lazy_state.update(meter_source=meter_source or METER_DATA_FILE, cache_ready=False, data=None)
+    _lazy_state['thread'] = threading.Thread(target=_warm_up_cache, args=(_lazy_state['meter_source'],), daemon=True)
+    _lazy_state['thread'].start()
+
+    return filter_options, default_filters()
+
+
+def _warm_up_cache(meter_source):
+    """Фоновая подготовка кэша для ленивого режима"""
+    try:
+        _lazy_state['cache_ready'] = ensure_cache(meter_source)
+    except Exception as e:
+        print(f"Ошибка подготовки кэша: {e}")
+        _lazy_state['cache_ready'] = False
+        return
+
+    if _lazy_state['cache_ready']:
+        try:
+            _open_cached_rollup()
+        except Exception as e:
+            print(f"Ошибка подготовки сводных таблиц: {e}")
+
+
+def _open_cached_rollup():
+    """Открывает сводные таблицы кэша (пересобирая их по кэшу, если они устарели) и делает активными"""
+    signature = storage.cache_signature(storage.read_manifest())
+    rollup = rollups.open_rollup()
+    if rollup is None or rollup['signature'] != signature:
+        columns = ['ManagedObjectid', 'typeM', 'Series', 'time', 'Value']
+        rollup = rollups.build_rollup(storage.read_readings(columns=columns, categorical=CATEGORICAL_COLUMNS))
+        if rollup is not None:
+            rollup['signature'] = signature
+            rollups.save_rollup(rollup)
+    rollups.set_active_rollup(rollup)
+
+
+def load_readings(filters=None):
+    """Ленивый режим: загружает показания за период из фильтров.
+
+    Из кэша читаются только показания, которые могут пройти фильтры
+    (см. scan_readings); окончательно фильтры применяет filter_data. Если кэш недоступен, данные
+    загружаются целиком один раз и используются для следующих отчетов.
+    """
+    thread = _lazy_state['thread']
+    if thread is not None:
+        thread.join()
+
+    if not _lazy_state['cache_ready']:
+        if _lazy_state['data'] is None:
+            _lazy_state['data'], _, _ = initialization_data(_lazy_state['meter_source'])
+        return _lazy_state['data']
+
+    registry = metadata.get_active_registry()
+    readings = scan_readings(filters, registry)
+    print(f"Загружено {len(readings)} строк из кэша {storage.CACHE_DIR}")
+    loaded = _prepare_loaded(readings, registry, build_store=False, partial=True)
+    loaded.attrs['filters'] = dict(filters or {})
+    return loaded
+
+
+def scan_readings(filters=None, registry=None):
+    """Читает из кэша только показания, которые могут пройти фильтры.
+
+    Период, счетчики и тип измерения передаются в чтение Parquet как условие;
+    фильтры по городу, типу счетчика и типу помещения переводятся через реестр
+    метаданных в список подходящих счетчиков. Если условие построить не удалось,
+    читаются показания за период, а фильтры применяет filter_data.
+    """
+    filters = filters or {}
+    start, end = date_bounds(filters.get('start_date'), filters.get('end_date'))
+
+    values = {}
+    try:
+        meters = _scan_meter_ids(filters, registry)
+        if meters is not None:
+            values['ManagedObjectid'] = sorted(meters)
+        if filters.get('measurement_types'):
+            normalize_value = VALUE_FILTERS['measurement_types'][3]
+            values['typeM'] = sorted({normalize_value(value) for value in filters['measurement_types']})
+    except Exception as e:
+        print(f"Не удалось построить условие чтения кэша: {e}")
+        values = {}
+
+    return storage.read_readings(categorical=CATEGORICAL_COLUMNS, start=start, end=end, values=values)
+
+
+def _scan_meter_ids(filters, registry):
+    """ID счетчиков, которые могут пройти фильтры по счетчикам и метаданным (None - любые)"""
+    meters = None
+    if filters.get('meter_ids'):
+        ids = pd.to_numeric(pd.Series([str(meter_id) for meter_id in filters['meter_ids']]), errors='coerce')
+        meters = set(ids.dropna().astype('int64'))
+
+    if registry is None:
+        return meters
+
+    for key, (column, _, normalize_column, normalize_value) in VALUE_FILTERS.items():
+        attribute = registry['columns'].get(column)
+        if not filters.get(key) or attribute is None or 'codes' not in attribute:
+            continue
+        selected = [normalize_value(value) for value in filters[key]]
+        matches = np.flatnonzero(normalize_column(pd.Series(attribute['categories'])).isin(selected))
+        ids = set(registry['ids'][np.isin(attribute['codes'], matches)])
+        meters = ids if meters is None else meters & ids
+    return meters
+
+# Фильтры по значениям колонок: ключ фильтра -> (колонка, название для сообщений,
+# нормализация колонки, нормализация выбранного значения). Колонки нормализуются
+# по словарю категорий, а не построчно (см. isin_mask).
+VALUE_FILTERS = {
+    'meter_ids': ('ManagedObjectid', 'счетчикам', lambda s: s.astype(str), lambda v: str(v)),
+    'cities': ('suburb', 'городам', lambda s: s.str.upper(), lambda v: v.strip().upper()),
+    'meter_types': ('meter_type', 'типам счетчиков', lambda s: s.str.lower(), lambda v: v.strip().lower()),
+    'usage_types': ('usage_type', 'типу использования', lambda s: s.str.lower(), lambda v: v.strip().lower()),
+    'measurement_types': ('typeM', 'типу измерения', lambda s: s.astype(str), lambda v: str(v).strip()),
+}
+
+
+def filter_rows(df, filters):
+    """Номера строк (по возрастанию), проходящих все заданные фильтры.
+
+    Возвращает None, если ни один фильтр не задан. При фильтре по счетчикам
+    и построенном индексе (счетчик, время) строки выбираются диапазонами
+    searchsorted по каждому счетчику, а остальные фильтры проверяются только
+    для выбранных строк. Фильтры по значениям категорий объединяются по битовым
+    индексам. Фильтр, который не удалось применить, пропускается.
+    """
+    positions = None
+    applied = set()
+
+    has_dates = bool(filters.get('start_date') or filters.get('end_date'))
+    if has_dates:
+        try:
+            start_date, end_date = date_bounds(filters.get('start_date'), filters.get('end_date'))
+        except Exception as e:
+            print(f"Ошибка фильтрации по дате: {e}")
+            has_dates = False
+
+    # Счетчики (и даты) - диапазонами по индексу
+    meter_index = get_meter_index(df) if filters.get('meter_ids') else None
+    if meter_index is not None:
+        bounds = (start_date, end_date) if has_dates else None
+        positions = _meter_index_positions(meter_index, filters['meter_ids'], bounds)
+        applied.update({'meter_ids', 'dates'})
+
+    # Фильтр по дате
+    if has_dates and 'dates' not in applied:
+        try:
+            positions = np.flatnonzero(_date_mask(df, filters.get('start_date'), filters.get('end_date')))
+        except Exception as e:
+            print(f"Ошибка фильтрации по дате: {e}")
+
+    # Фильтры по счетчикам, городам, типам счетчиков, типу использования и типу измерения
+    bitmaps = get_value_bitmaps(df)
+    packed = None
+    for key, (column, title, _, _) in VALUE_FILTERS.items():
+        if key in applied or not filters.get(key) or column not in df.columns:
+            continue
+        try:
+            key_bitmap = _values_bitmap(bitmaps, key, filters[key]) if bitmaps is not None else None
+            if key_bitmap is not None:
+                packed = key_bitmap if packed is None else packed & key_bitmap
+                continue
+            values_mask = _values_mask(df, key, filters[key], positions)
+        except Exception as e:
+            print(f"Ошибка фильтрации по {title}: {e}")
+            continue
+        positions = np.flatnonzero(values_mask) if positions is None else positions[values_mask]
+
+    if packed is not None:
+        values_mask = np.unpackbits(packed, count=len(df)).view(bool)
+        positions = np.flatnonzero(values_mask) if positions is None else positions[values_mask[positions]]
+
+    return positions
+
+
+def filter_counts(df, filters):
+    """Количество строк и счетчиков, проходящих фильтры (без создания выборки)"""
+    if df is None:
+        return {'rows': 0, 'meters': 0}
+
+    positions = filter_rows(df, filters)
+    if positions is None:
+        positions = np.arange(len(df))
+    if 'ManagedObjectid' not in df.columns:
+        return {'rows': len(positions), 'meters': 0}
+
+    meters = df['ManagedObjectid']
+    if isinstance(meters.dtype, pd.CategoricalDtype):
+        codes = meters.cat.codes.to_numpy()[positions]
+        meter_count = np.count_nonzero(np.bincount(codes[codes >= 0], minlength=1))
+    else:
+        meter_count = meters.take(positions).nunique()
+    return {'rows': len(positions), 'meters': int(meter_count)}
+
 
 def filter_data(df, filters):
-    """Применяет все фильтры к данным"""
+    """Применяет все фильтры к данным.
+
+    Фильтры объединяются в один набор строк, и выборка создается один раз;
+    без фильтров возвращается исходный датафрейм без копирования.
+    """
     if df is None:
         return None
 
-    filtered = df.copy()
+    positions = filter_rows(df, filters)
+    if positions is None:
+        print(df)
+        return df
 
-    # Фильтр по дате
-    if filters.get('start_date') or filters.get('end_date'):
-        filtered = filter_by_date(filtered, filters['start_date'], filters['end_date'])
+    filtered = df.take(positions)
+    if 'time' in filtered.columns and not is_utc(filtered['time']):
+        filtered = filtered.assign(time=utc_time(filtered['time']))
+    # По фильтрам выборки отчеты находят ее агрегаты в сводных таблицах (см. rollup_for)
+    filtered.attrs['filters'] = dict(filters)
 
-    # Фильтр по счетчикам
+    # Категории, которых нет в выборке, не должны попадать в отчеты и графики
+    filtered = remove_unused_categories(filtered)
+
+    print(filtered)
+
+    return filtered
+
+
+def rollup_for(df, level='hour'):
+    """Ячейки сводной таблицы уровня level, из которых складывается выборка df (или None).
+
+    Фильтры выборки записывает в df.attrs['filters'] функция filter_data.
+    Ячейки подходят, если фильтры выражаются через ключи сводной таблицы
+    (период - целыми корзинами уровня, счетчики, метаданные счетчиков, typeM),
+    а число строк в выбранных ячейках совпадает с числом строк df
+    (для скетчей квантилей строки считаются по суточным ячейкам).
+    """
+    rollup = rollups.get_active_rollup()
+    filters = df.attrs.get('filters') if df is not None else None
+    if rollup is None or filters is None:
+        return None
+
+    check_level = 'day' if level == rollups.SKETCH_LEVEL else level
+    try:
+        masks = {name: _rollup_mask(rollup, name, filters) for name in {level, check_level}}
+    except Exception as e:
+        print(f"Ошибка выбора из сводных таблиц: {e}")
+        return None
+    if any(mask is None for mask in masks.values()):
+        return None
+    if int(rollup[check_level]['rows'][masks[check_level]].sum()) != len(df):
+        return None
+
+    selected = {field: array[masks[level]] for field, array in rollup[level].items()}
+    if level == rollups.SKETCH_LEVEL:
+        selected['error'] = rollup['sketch_error']
+    return {'labels': rollup['labels'], **selected}
+
+
+def sketch_for(df):
+    """Скетчи квантилей выборки df (или None, если режим приближенных квантилей выключен)"""
+    if not sketches.approximate_quantiles():
+        return None
+    return rollup_for(df, rollups.SKETCH_LEVEL)
+
+
+def _rollup_mask(rollup, level, filters):
+    """Маска ячеек уровня level, подходящих под фильтры (None - период не выражается целыми корзинами)"""
+    cells = rollup[level]
+    mask = np.ones(len(cells['bucket']), dtype=bool)
+    start, end = date_bounds(filters.get('start_date'), filters.get('end_date'))
+    bucket_ns = rollups.level_hours(level) * NS_PER_HOUR
+    for bound in (start, end):
+        if bound is not None and bound.value % bucket_ns:
+            return None
+    if start is not None:
+        mask &= cells['bucket'] >= start.value // bucket_ns
+    if end is not None:
+        mask &= cells['bucket'] < end.value // bucket_ns
+
+    meters = _rollup_meter_labels(filters)
+    if meters is not None:
+        codes = [code for code, label in enumerate(rollup['labels']['meter']) if label in meters]
+        mask &= np.isin(cells['meter'], codes)
+
+    if filters.get('measurement_types'):
+        normalize_value = VALUE_FILTERS['measurement_types'][3]
+        types = {normalize_value(value) for value in filters['measurement_types']}
+        codes = [code for code, label in enumerate(rollup['labels']['typeM']) if label in types]
+        mask &= np.isin(cells['typeM'], codes)
+    return mask
+
+
+def _rollup_meter_labels(filters):
+    """ID счетчиков (строками, как в сводных таблицах), проходящих фильтры по счетчикам и метаданным (None - любые)"""
+    meters = None
     if filters.get('meter_ids'):
-        filtered = filter_by_meters(filtered, filters['meter_ids'])
+        meters = {str(meter_id) for meter_id in filters['meter_ids']}
 
-    # Фильтр по городам
-    if filters.get('cities') and 'suburb' in filtered.columns:
-        filtered = filter_by_city(filtered, filters['cities'])
+    metadata_filters = {key: values for key, values in filters.items() if key != 'meter_ids'}
+    ids = _scan_meter_ids(metadata_filters, metadata.get_active_registry())
+    if ids is not None:
+        ids = {str(meter_id) for meter_id in ids}
+        meters = ids if meters is None else meters & ids
+    return meters
 
-    # Фильтр по типам счетчиков
-    if filters.get('meter_types') and 'meter_type' in filtered.columns:
-        filtered = filter_by_meter_type(filtered, filters['meter_types'])
 
-    # Фильтр по типу использования
-    if filters.get('usage_types') and 'usage_type' in filtered.columns:
-        filtered = filter_by_usage_type(filtered, filters['usage_types'])
+def _meter_index_positions(meter_index, meter_ids, bounds=None):
+    """Номера строк выбранных счетчиков (и периода bounds = (начало, конец)) по индексу (счетчик, время)"""
+    codes = sorted({meter_index['codes'][str(meter_id)] for meter_id in meter_ids
+                    if str(meter_id) in meter_index['codes']})
 
-    print(filtered)
+    times = meter_index['times']
+    ranges = []
+    for code in codes:
+        start, stop = meter_index['offsets'][code], meter_index['offsets'][code + 1]
+        if bounds is not None:
+            # Строки без времени (NaT - минимальное int64) в период не входят
+            start_ns = bounds[0].value if bounds[0] is not None else np.iinfo('i8').min + 1
+            lo = start + np.searchsorted(times[start:stop], start_ns, side='left')
+            if bounds[1] is not None:
+                stop = start + np.searchsorted(times[start:stop], bounds[1].value, side='left')
+            start = lo
+        ranges.append(meter_index['positions'][start:stop])
+
+    if not ranges:
+        return np.array([], dtype=np.intp)
+    return np.sort(np.concatenate(ranges))
+
+
+def _date_mask(df, start_date=None, end_date=None):
+    """Маска строк в диапазоне дат (UTC).
+
+    Если для датафрейма построено разбиение по месяцам, время сравнивается
+    только у строк месяцев, пересекающихся с диапазоном.
+    """
+    start_date, end_date = date_bounds(start_date, end_date)
+
+    partitions = get_time_partitions(df)
+    if partitions is not None:
+        mask = np.zeros(len(df), dtype=bool)
+        mask[_date_range_positions(df, partitions, start_date, end_date)] = True
+        return mask
+
+    times = utc_time(df['time'])
+    mask = times.notna().to_numpy()
+    if start_date is not None:
+        mask &= (times >= start_date).to_numpy()
+    if end_date is not None:
+        mask &= (times < end_date).to_numpy()
+    return mask
+
+
+def _values_bitmap(bitmaps, key, values):
+    """Упакованная маска строк фильтра key: OR битовых индексов выбранных значений.
+
+    Возвращает None, если для колонки фильтра битовый индекс не построен.
+    """
+    column, _, normalize_column, normalize_value = VALUE_FILTERS[key]
+    index = bitmaps['columns'].get(column)
+    if index is None:
+        return None
+
+    values = [normalize_value(value) for value in values]
+    matches = np.asarray(normalize_column(pd.Series(index['categories'])).isin(values), dtype=bool)
+    if not matches.any():
+        return np.zeros(index['bitmaps'].shape[1], dtype=np.uint8)
+    return np.bitwise_or.reduce(index['bitmaps'][matches], axis=0)
 
-    return filtered
+
+def _values_mask(df, key, values, positions=None):
+    """Маска строк (всех или только positions), значения колонки фильтра key которых входят в values"""
+    column, _, normalize_column, normalize_value = VALUE_FILTERS[key]
+    values = [normalize_value(value) for value in values]
+    series = df[column] if positions is None else df[column].take(positions)
+    return isin_mask(series, values, normalize=normalize_column).to_numpy()
 
 
 def filter_by_date(df, start_date=None, end_date=None):
@@ -128,74 +1100,81 @@ def filter_by_date(df, start_date=None, end_date=None):
         return df
 
     try:
-        # Убедимся, что столбец времени в UTC
-        if not pd.api.types.is_datetime64tz_dtype(df['time']):
-            df['time'] = pd.to_datetime(df['time'], utc=True)
+        filtered = df[_date_mask(df, start_date, end_date)]
+        # Время без зоны приводится к UTC только в выборке, исходный датафрейм не изменяется
+        if not is_utc(filtered['time']):
+            filtered = filtered.assign(time=utc_time(filtered['time']))
+        return filtered
+
+    except Exception as e:
+        print(f"Ошибка фильтрации по дате: {e}")
+        return df
 
-        # Преобразуем входные даты в UTC
-        start_date = pd.to_datetime(start_date, utc=True) if start_date else df['time'].min()
-        end_date = pd.to_datetime(end_date, utc=True) if end_date else df['time'].max()
 
-        # Добавляем 1 день к конечной дате для включения всех записей за последний день
+def date_bounds(start_date=None, end_date=None):
+    """Границы периода фильтра в UTC: [начало, конец + 1 день); пустая граница - None"""
+    # Преобразуем входные даты в UTC; пустая граница не ограничивает диапазон
+    start_date = pd.to_datetime(start_date, utc=True) if start_date else None
+    end_date = pd.to_datetime(end_date, utc=True) if end_date else None
+
+    # Добавляем 1 день к конечной дате для включения всех записей за последний день
+    if end_date is not None:
         end_date = end_date + pd.Timedelta(days=1)
+    return start_date, end_date
 
-        # Применяем фильтр
-        mask = (df['time'] >= start_date) & (df['time'] < end_date)
-        return df[mask]
 
-    except Exception as e:
-        print(f"Ошибка фильтрации по дате: {e}")
-        return df
+def _date_range_positions(df, partitions, start_date, end_date):
+    """Номера строк в диапазоне [start_date, end_date) по разбиению на месяцы (в исходном порядке)"""
+    start_ns = start_date.value if start_date is not None else None
+    end_ns = end_date.value if end_date is not None else None
 
-def filter_by_meters(df, meter_ids):
-    """Фильтрация по ID счетчиков"""
-    if df is None or not meter_ids:
+    # Месяцы, пересекающиеся с диапазоном, идут подряд
+    months = partitions['months']
+    first = 0 if start_ns is None else max(np.searchsorted(months, start_ns, side='right') - 1, 0)
+    last = len(months) if end_ns is None else np.searchsorted(months, end_ns, side='left')
+    positions = partitions['positions'][partitions['offsets'][first]:partitions['offsets'][last]]
+
+    # Время сравнивается только у строк выбранных месяцев
+    times = time_epoch(df)[positions]
+    mask = np.ones(len(positions), dtype=bool)
+    if start_ns is not None:
+        mask &= times >= start_ns
+    if end_ns is not None:
+        mask &= times < end_ns
+    return np.sort(positions[mask])
+
+
+def _filter_by_values(df, key, values):
+    """Фильтрация по значениям колонки фильтра key"""
+    column, title, _, _ = VALUE_FILTERS[key]
+    if df is None or not values or column not in df.columns:
         return df
 
     try:
-        return df[df['ManagedObjectid'].astype(str).isin([str(mid) for mid in meter_ids])]
+        return df[_values_mask(df, key, values)]
     except Exception as e:
-        print(f"Ошибка фильтрации по счетчикам: {e}")
+        print(f"Ошибка фильтрации по {title}: {e}")
         return df
 
 
+def filter_by_meters(df, meter_ids):
+    """Фильтрация по ID счетчиков"""
+    return _filter_by_values(df, 'meter_ids', meter_ids)
+
+
 def filter_by_city(df, cities):
     """Фильтрация по городам"""
-    if df is None or not cities or 'suburb' not in df.columns:
-        return df
-
-    try:
-        cities = [city.strip().upper() for city in cities]
-        return df[df['suburb'].str.upper().isin(cities)]
-    except Exception as e:
-        print(f"Ошибка фильтрации по городам: {e}")
-        return df
+    return _filter_by_values(df, 'cities', cities)
 
 
 def filter_by_meter_type(df, meter_types):
     """Фильтрация по типам счетчиков"""
-    if df is None or not meter_types or 'meter_type' not in df.columns:
-        return df
-
-    try:
-        meter_types = [mt.strip().lower() for mt in meter_types]
-        return df[df['meter_type'].str.lower().isin(meter_types)]
-    except Exception as e:
-        print(f"Ошибка фильтрации по типам счетчиков: {e}")
-        return df
+    return _filter_by_values(df, 'meter_types', meter_types)
 
 
 def filter_by_usage_type(df, usage_types):
     """Фильтрация по типу использования (Non-Residential/Residential)"""
-    if df is None or not usage_types or 'usage_type' not in df.columns:
-        return df
-
-    try:
-        usage_types = [ut.strip().lower() for ut in usage_types]
-        return df[df['usage_type'].str.lower().isin(usage_types)]
-    except Exception as e:
-        print(f"Ошибка фильтрации по типу использования: {e}")
-        return df
+    return _filter_by_values(df, 'usage_types', usage_types)
 
 def display_results(df):
     """Отображает результаты фильтрации"""
@@ -0,0 +1,106 @@
+import threading
+import weakref
+from collections import OrderedDict
+
+from core.data_processing import VALUE_FILTERS, date_bounds
+
+# Сколько памяти могут занимать сохраненные выборки (в мегабайтах)
+FILTER_CACHE_LIMIT_MB = 512
+
+# Выборки по фильтрам в порядке использования: ключ -> (weakref на исходные данные или None, выборка, размер в байтах)
+_entries = OrderedDict()
+_state = {'bytes': 0, 'hits': 0, 'misses': 0}
+_lock = threading.Lock()
+
+
+def _normalize_dates(filters):
+    """Границы периода фильтра в UTC (как при фильтрации); нераспознанные строки остаются как есть"""
+    try:
+        start, end = date_bounds(filters.get('start_date'), filters.get('end_date'))
+    except (ValueError, TypeError):
+        return filters.get('start_date') or None, filters.get('end_date') or None
+    return (start.isoformat() if start is not None else None,
+            end.isoformat() if end is not None else None)
+
+
+def filter_key(filters):
+    """Канонический ключ набора фильтров.
+
+    Даты приводятся к границам периода в UTC, выбранные значения нормализуются
+    так же, как при фильтрации, сортируются и избавляются от повторов;
+    пустые фильтры в ключ не входят.
+    """
+    start, end = _normalize_dates(filters)
+    key = [('start_date', start), ('end_date', end)]
+    for name, (_, _, _, normalize_value) in VALUE_FILTERS.items():
+        if filters.get(name):
+            key.append((name, tuple(sorted({normalize_value(value) for value in filters[name]}))))
+    return tuple(item for item in key if item[1])
+
+
+def frame_size(df):
+    """Объем памяти датафрейма в байтах"""
+    return int(df.memory_usage(deep=True).sum()) if df is not None else 0
+
+
+def _is_alive(source_ref):
+    """Проверяет, что данные, по которым построена выборка, еще существуют"""
+    return source_ref is None or source_ref() is not None
+
+
+def _evict(limit_bytes):
+    """Удаляет выборки удаленных данных и давно не использованные выборки, пока кэш не уложится в limit_bytes"""
+    for key in [key for key, entry in _entries.items() if not _is_alive(entry[0])]:
+        _state['bytes'] -= _entries.pop(key)[2]
+    while _entries and _state['bytes'] > limit_bytes:
+        _, (_, _, size) = _entries.popitem(last=False)
+        _state['bytes'] -= size
+
+
+def get_filtered(filters, compute, source=None, limit_mb=FILTER_CACHE_LIMIT_MB):
+    """Возвращает выборку по фильтрам из кэша или вычисляет ее функцией compute().
+
+    source - исходный датафрейм (выборки разных датафреймов не смешиваются);
+    None - данные ленивого режима. Выборки вытесняются в порядке давности
+    использования, когда их общий размер превышает limit_mb. Выборка,
+    совпадающая с исходными данными (фильтры не заданы), не сохраняется.
+    """
+    key = (id(source), filter_key(filters))
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and _is_alive(entry[0]) and (source is None or entry[0]() is source):
+            _entries.move_to_end(key)
+            _state['hits'] += 1
+            return entry[1]
+        _state['misses'] += 1
+
+    result = compute()
+    if result is None or result is source:
+        return result
+
+    size = frame_size(result)
+    limit_bytes = limit_mb * 1024 * 1024
+    if size > limit_bytes:
+        return result
+
+    with _lock:
+        old = _entries.pop(key, None)
+        if old is not None:
+            _state['bytes'] -= old[2]
+        _entries[key] = (weakref.ref(source) if source is not None else None, result, size)
+        _state['bytes'] += size
+        _evict(limit_bytes)
+    return result
+
+
+def clear():
+    """Очищает кэш выборок"""
+    with _lock:
+        _entries.clear()
+        _state['bytes'] = 0
+
+
+def stats():
+    """Количество выборок, занятая память и число попаданий/промахов кэша"""
+    with _lock:
+        return {'entries': len(_entries), **_state}
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+
+# Колонки с ID счетчика в файле метаданных
+ID_COLUMNS = ['managedObjects_id', 'ManagedObjectid']
+# Стандартные названия колонок метаданных
+COLUMN_NAMES = {'Suburb': 'suburb', 'Meter Type': 'meter_type', 'Usage Type': 'usage_type'}
+
+# Реестр, построенный при загрузке данных
+_active_registry = None
+
+
+def build_registry(location_data):
+    """Строит реестр метаданных счетчиков: отсортированные ID и атрибуты в виде массивов.
+
+    Строковые атрибуты хранятся как коды + словарь значений, числовые - как
+    float64. Для повторяющихся ID используется первая строка.
+    """
+    if location_data is None or location_data.empty:
+        return None
+
+    id_col = next((col for col in ID_COLUMNS if col in location_data.columns), None)
+    if id_col is None:
+        print("В метаданных нет колонки с ID счетчика")
+        return None
+
+    data = location_data.rename(columns=COLUMN_NAMES)
+    ids = pd.to_numeric(data[id_col], errors='coerce')
+    data = data[ids.notna()].assign(**{id_col: ids[ids.notna()].astype('int64')})
+    data = data.drop_duplicates(id_col, keep='first').sort_values(id_col, kind='stable')
+
+    registry = {'ids': data[id_col].to_numpy(), 'columns': {}}
+    for col in data.columns:
+        if col == id_col:
+            continue
+        if pd.api.types.is_numeric_dtype(data[col]):
+            registry['columns'][col] = {'values': data[col].to_numpy(dtype='float64')}
+        else:
+            values = pd.Categorical(data[col])
+            registry['columns'][col] = {'codes': values.codes, 'categories': values.categories}
+
+    return registry
+
+
+def set_active_registry(registry):
+    """Делает реестр метаданных доступным для функций анализа"""
+    global _active_registry
+    _active_registry = registry
+
+
+def get_active_registry():
+    """Возвращает текущий реестр метаданных (или None)"""
+    return _active_registry
+
+
+def lookup(registry, meter_ids):
+    """Позиции счетчиков в реестре (-1 для счетчиков без метаданных)"""
+    meter_ids = pd.to_numeric(pd.Series(meter_ids), errors='coerce').to_numpy(dtype='float64')
+    ids = registry['ids']
+    if not len(ids):
+        return np.full(len(meter_ids), -1)
+
+    positions = np.minimum(np.searchsorted(ids, meter_ids), len(ids) - 1)
+    return np.where(ids[positions] == meter_ids, positions, -1)
+
+
+def _meter_positions(registry, meters):
+    """Позиции в реестре для колонки ID счетчиков; для категорий поиск идет по словарю"""
+    if isinstance(meters.dtype, pd.CategoricalDtype):
+        positions = np.append(lookup(registry, meters.cat.categories), -1)  # код -1 (NaN) -> -1
+        return positions[meters.cat.codes.to_numpy()]
+    return lookup(registry, meters)
+
+
+def attribute(registry, name, positions):
+    """Значения атрибута для позиций реестра: категории для строк, float64 для чисел"""
+    column = registry['columns'][name]
+    found = positions >= 0
+    if 'codes' in column:
+        codes = np.where(found, column['codes'][np.where(found, positions, 0)], -1)
+        return pd.Categorical.from_codes(codes, column['categories'])
+
+    return np.where(found, column['values'][np.where(found, positions, 0)], np.nan)
+
+
+def meter_attribute(meter_ids, name, registry=None):
+    """Значение атрибута для каждого из счетчиков meter_ids"""
+    registry = registry or get_active_registry()
+    if registry is None or name not in registry['columns']:
+        return None
+    return attribute(registry, name, lookup(registry, meter_ids))
+
+
+def attach_metadata(df, registry, columns=None):
+    """Добавляет к показаниям колонки метаданных, найденные по ID счетчика.
+
+    Показания хранят только ID; атрибуты подставляются векторным поиском
+    по отсортированным ID реестра, без объединения таблиц.
+    """
+    if df is None or registry is None or 'ManagedObjectid' not in df.columns:
+        return df
+
+    positions = _meter_positions(registry, df['ManagedObjectid'])
+    for name in columns or registry['columns']:
+        values = attribute(registry, name, positions)
+        # В реестре есть значения всех счетчиков; в показаниях оставляем только встречающиеся
+        df[name] = values.remove_unused_categories() if isinstance(values, pd.Categorical) else values
+    return df
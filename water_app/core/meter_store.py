@@ -0,0 +1,255 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from core.timestamps import ensure_time, time_epoch
+
+
+STORE_DIR = 'dataset/.cache/meter_store'
+INDEX_FILE = 'index.json'
+KEY_COLUMNS = ['ManagedObjectid', 'typeM', 'Series']
+
+# Хранилище, открытое при загрузке данных (используется горячими путями анализа)
+_active_store = None
+
+
+def load_or_build(df, rebuild=False, directory=STORE_DIR, signature=None):
+    """Открывает хранилище серий для df (пересобирая его при необходимости) и делает активным.
+
+    signature - сигнатура кэша показаний (storage.cache_signature): хранилище,
+    построенное по другому содержимому кэша, пересобирается, даже если число строк совпадает.
+    """
+    store = None if rebuild else open_meter_store(directory)
+    if store is None or store['source_rows'] != len(df) or store['signature'] != signature:
+        store = build_meter_store(df, directory, signature)
+    set_active_store(store)
+    return store
+
+
+def build_meter_store(df, directory=STORE_DIR, signature=None):
+    """Раскладывает показания по счетчикам и сериям в непрерывные массивы на диске.
+
+    Строки сортируются по (счетчик, typeM, Series, время), дубликаты времени
+    внутри серии удаляются. Время (int64, нс UTC), значения (float64) и номера
+    строк в df (int64, порядок показаний с одинаковым временем) пишутся в
+    отдельные .npy файлы, а таблица смещений каждой серии и сигнатура кэша - в index.json.
+    """
+    if df is None or df.empty or not all(col in df.columns for col in KEY_COLUMNS + ['time', 'Value']):
+        return None
+
+    data = pd.DataFrame({
+        'meter': df['ManagedObjectid'].astype(str).to_numpy(),
+        'typeM': df['typeM'].astype(str).to_numpy(),
+        'Series': df['Series'].astype(str).to_numpy(),
+        'time': time_epoch(df),
+        'value': pd.to_numeric(df['Value'], errors='coerce').to_numpy(dtype='float64'),
+        'row': np.arange(len(df), dtype=np.int64),
+    })
+    data = data[data['time'] != np.iinfo('i8').min]  # NaT
+    data = data.sort_values(['meter', 'typeM', 'Series', 'time'], kind='stable')
+    data = data.drop_duplicates(['meter', 'typeM', 'Series', 'time'], keep='first')
+
+    keys = data[['meter', 'typeM', 'Series']]
+    starts = np.flatnonzero((keys != keys.shift()).any(axis=1).to_numpy())
+    stops = np.append(starts[1:], len(data))
+
+    tmp_directory = directory + '.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    np.save(os.path.join(tmp_directory, 'time.npy'), data['time'].to_numpy())
+    np.save(os.path.join(tmp_directory, 'value.npy'), data['value'].to_numpy())
+    np.save(os.path.join(tmp_directory, 'row.npy'), data['row'].to_numpy())
+
+    first = keys.iloc[starts]
+    index = [[meter, type_m, series, int(start), int(stop)]
+             for meter, type_m, series, start, stop in zip(first['meter'], first['typeM'], first['Series'], starts, stops)]
+    with open(os.path.join(tmp_directory, INDEX_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'rows': len(data), 'source_rows': len(df), 'signature': signature, 'series': index}, f)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+    print(f"Хранилище серий сохранено в {directory}: {len(index)} серий, {len(data)} показаний")
+    return open_meter_store(directory)
+
+
+def open_meter_store(directory=STORE_DIR):
+    """Открывает хранилище серий: массивы отображаются в память без чтения с диска"""
+    index_path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        store = {
+            'time': np.load(os.path.join(directory, 'time.npy'), mmap_mode='r'),
+            'value': np.load(os.path.join(directory, 'value.npy'), mmap_mode='r'),
+            'row': np.load(os.path.join(directory, 'row.npy'), mmap_mode='r'),
+            'source_rows': meta.get('source_rows'),
+            'signature': meta.get('signature'),
+            'index': {},
+            'by_series': {},
+            'by_meter': {},
+        }
+    except (OSError, ValueError) as e:
+        print(f"Не удалось открыть хранилище серий {directory}: {e}")
+        return None
+
+    for meter, type_m, series, start, stop in meta['series']:
+        store['index'][(meter, type_m, series)] = (start, stop)
+        store['by_series'].setdefault((meter, series), []).append(type_m)
+        # Все серии счетчика лежат подряд, поэтому диапазон счетчика тоже непрерывный
+        meter_start, _ = store['by_meter'].get(meter, (start, stop))
+        store['by_meter'][meter] = (meter_start, stop)
+
+    return store
+
+
+def set_active_store(store):
+    """Делает хранилище серий доступным для функций анализа"""
+    global _active_store
+    _active_store = store
+
+
+def get_active_store():
+    """Возвращает текущее хранилище серий (или None)"""
+    return _active_store
+
+
+def series_range(store, meter_id, series, type_m=None):
+    """Возвращает диапазон строк (start, stop) серии счетчика или None.
+
+    Если type_m не указан, серия должна быть единственной с таким Series у счетчика.
+    """
+    meter_id = str(meter_id)
+    if type_m is None:
+        types = store['by_series'].get((meter_id, str(series)))
+        if not types or len(types) > 1:
+            return None
+        type_m = types[0]
+    return store['index'].get((meter_id, str(type_m), str(series)))
+
+
+def _to_series(times, values):
+    """Оборачивает срезы хранилища в pandas.Series с индексом времени UTC"""
+    index = pd.DatetimeIndex(np.asarray(times).view('datetime64[ns]')).tz_localize('UTC')
+    return pd.Series(np.asarray(values), index=index, name='Value')
+
+
+def _store_slices(store, data, series, type_m):
+    """Срезы хранилища для счетчиков из data в пределах ее временного диапазона"""
+    times = data['time']
+    start_ns = times.min().value
+    end_ns = times.max().value
+
+    slices = []
+    meters = data['ManagedObjectid'].unique()
+    for meter_id in sorted(meters):
+        if series is None:
+            bounds = store['by_meter'].get(str(meter_id))
+        else:
+            bounds = series_range(store, meter_id, series, type_m)
+        if bounds is None:
+            return None
+
+        start, stop = bounds
+        meter_times = store['time'][start:stop]
+        if series is None:
+            # Серии счетчика отсортированы по времени каждая отдельно; показания
+            # с одинаковым временем идут в порядке строк исходных данных, как при сортировке data
+            in_range = (meter_times >= start_ns) & (meter_times <= end_ns)
+            order = np.lexsort((store['row'][start:stop][in_range], meter_times[in_range]))
+            slices.append((meter_id, meter_times[in_range][order], store['value'][start:stop][in_range][order]))
+        else:
+            lo = start + np.searchsorted(meter_times, start_ns, side='left')
+            hi = start + np.searchsorted(meter_times, end_ns, side='right')
+            slices.append((meter_id, store['time'][lo:hi], store['value'][lo:hi]))
+
+    return slices
+
+
+def iter_meter_series(data, series=None, type_m=None):
+    """Перебирает ряды показаний счетчиков из data: (meter_id, pandas.Series по времени).
+
+    data - выборка строк одной серии (или всех серий при series=None), полученная
+    фильтрацией по счетчикам и диапазону дат. Если открыто хранилище серий,
+    ряды берутся из него срезами по таблице смещений; количество строк
+    сверяется с data, и при расхождении используется группировка data.
+    """
+    if data is None or data.empty:
+        return
+
+    store = get_active_store()
+    slices = None
+    if store is not None:
+        try:
+            slices = _store_slices(store, data, series, type_m)
+        except Exception as e:
+            print(f"Ошибка чтения хранилища серий: {e}")
+            slices = None
+
+    if slices is not None and sum(len(times) for _, times, _ in slices) == len(data):
+        for meter_id, times, values in slices:
+            yield meter_id, _to_series(times, values)
+        return
+
+    data = ensure_time(data)
+    data = data.sort_values(['ManagedObjectid', 'time'])
+    for meter_id, group in data.groupby('ManagedObjectid', observed=True):
+        if series is not None:
+            group = group.drop_duplicates('time')
+        group = group.set_index('time').sort_index()
+        yield meter_id, pd.to_numeric(group['Value'], errors='coerce').rename('Value')
+
+
+def meter_arrays(data, series=None, type_m=None):
+    """Те же ряды, что перебирает iter_meter_series, плоскими массивами без объектов pandas на каждый счетчик.
+
+    Возвращает (meter_ids, lengths, time, value, tz): ряды идут подряд в порядке
+    meter_ids, lengths - их длины, time - время (нс UTC) по возрастанию внутри
+    ряда, value - показания float64 (нечисловые - NaN).
+    """
+    store = get_active_store()
+    slices = None
+    if store is not None and data is not None and not data.empty:
+        try:
+            slices = _store_slices(store, data, series, type_m)
+        except Exception as e:
+            print(f"Ошибка чтения хранилища серий: {e}")
+            slices = None
+
+    if slices is not None and sum(len(times) for _, times, _ in slices) == len(data):
+        lengths = np.array([len(times) for _, times, _ in slices], dtype=np.int64)
+        time = np.concatenate([times for _, times, _ in slices]).astype(np.int64)
+        value = np.concatenate([values for _, _, values in slices]).astype('float64')
+        return [meter_id for meter_id, _, _ in slices], lengths, time, value, 'UTC'
+
+    if data is None or data.empty:
+        return [], np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), 'UTC'
+
+    data = ensure_time(data)
+    meters = data['ManagedObjectid']
+    if isinstance(meters.dtype, pd.CategoricalDtype):
+        codes, meter_ids = meters.cat.codes.to_numpy(), meters.cat.categories
+    else:
+        codes, meter_ids = pd.factorize(meters, sort=True)
+    time = time_epoch(data)
+    value = pd.to_numeric(data['Value'], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+
+    # Сортировка по (счетчик, время) как у группировки pandas; строки без ID счетчика или времени отбрасываются
+    keep = np.flatnonzero((codes >= 0) & data['time'].notna().to_numpy())
+    order = keep[np.lexsort((time[keep], codes[keep]))]
+    codes, time, value = codes[order], time[order], value[order]
+    if series is not None:
+        # Повторные показания серии за то же время: остается первое
+        first = np.r_[True, (codes[1:] != codes[:-1]) | (time[1:] != time[:-1])]
+        codes, time, value = codes[first], time[first], value[first]
+
+    lengths = np.bincount(codes, minlength=len(meter_ids))
+    present = np.flatnonzero(lengths)
+    return [meter_ids[code] for code in present], lengths[present], time, value, data['time'].dt.tz
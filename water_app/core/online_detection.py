@@ -0,0 +1,421 @@
+import bisect
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from core.aggregation import NS_PER_HOUR
+from core.anomaly_detection import ANOMALY_PARAMS
+from core.anomaly_engine import run_stats
+from core.timestamps import ensure_time, time_epoch
+
+CHECKPOINT_FILE = 'dataset/.cache/online_detector.json'
+CHECKPOINT_VERSION = 2
+# Самое широкое окно правил: контекст ночной протечки и окружение статистической аномалии (часы)
+CONTEXT_HOURS = 6
+# Сколько последних показаний счетчика прогоняется при заполнении детектора (в окнах правила):
+# отклонения от медианы последнего окна считаются по медианам полных окон
+SEED_WINDOWS = 2
+
+
+def create_detector(signature=None):
+    """Новый онлайн-детектор аномалий без накопленного состояния.
+
+    signature - сигнатура кэша показаний (storage.cache_signature), которые детектор уже видел.
+    """
+    return {'version': CHECKPOINT_VERSION, 'signature': signature, 'meters': {}}
+
+
+def meter_type_of(series, type_m):
+    """Тип счетчика для правил ANOMALY_PARAMS по серии и типу измерения (None - серия не проверяется)"""
+    if series == 'P1':
+        return 'P1'
+    if series == '1' and type_m == '/10266/1':
+        return '10266_1'
+    return None
+
+
+def _new_state():
+    """Состояние счетчика: окна последних показаний, кандидаты в аномалии и текущая ночная последовательность"""
+    return {
+        'count': 0,
+        'last_time': None,
+        'last_value': None,
+        # Показания за последние CONTEXT_HOURS часов (время и значение)
+        'history_times': [],
+        'history_values': [],
+        # Окна медианы/перцентиля, медианы 24 показаний и отклонений от медианы (MAD):
+        # показания в порядке поступления и те же значения по возрастанию
+        'window': [], 'window_sorted': [],
+        'short': [], 'short_sorted': [],
+        'deviations': [], 'deviations_sorted': [],
+        # Выполнение условий статистической аномалии в двух последних показаниях
+        'flags': [False, False],
+        'confirmed': False,
+        'previous': None,
+        'extreme': False,
+        # Кандидаты, которым еще нужны показания после них (окна 3 и 6 часов)
+        'pending': [],
+        'run': None,
+    }
+
+
+def _median(values):
+    """Медиана упорядоченного списка теми же операциями, что и rolling().median() в pandas"""
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle] + values[middle - 1]) / 2
+
+
+def _quantile(values, quantile):
+    """Квантиль упорядоченного списка с линейной интерполяцией, как rolling().quantile() в pandas"""
+    position = quantile * (len(values) - 1)
+    index = int(position)
+    if position == index:
+        return values[index]
+    return values[index] + (values[index + 1] - values[index]) * (position - index)
+
+
+def _slide(window, ordered, value, size):
+    """Добавляет значение в окно размера size и его упорядоченную копию (None - пропуск).
+
+    Место значения ищется за O(log size) сравнений, но вставка и удаление
+    сдвигают элементы списков: O(size) на показание. Окна правил не больше
+    144 показаний, и сдвиг (копирование памяти) дешевле структур с логарифмической вставкой.
+    """
+    window.append(value)
+    if value is not None:
+        bisect.insort(ordered, value)
+    if len(window) > size:
+        oldest = window.pop(0)
+        if oldest is not None:
+            del ordered[bisect.bisect_left(ordered, oldest)]
+
+
+def _count_range(state, start, end, above=None):
+    """Количество показаний истории со временем от start до end (больших above, если задано)"""
+    times = state['history_times']
+    lo = bisect.bisect_left(times, start)
+    hi = bisect.bisect_right(times, end)
+    if above is None:
+        return hi - lo
+    return sum(1 for value in state['history_values'][lo:hi] if value > above)
+
+
+def _alert(meter_id, meter_type, time, value, anomaly_type, description, end_time=None):
+    """Аномалия в формате detect_anomalies"""
+    alert = {'meter_id': str(meter_id), 'time': pd.Timestamp(time, tz='UTC')}
+    if end_time is not None:
+        alert['end_time'] = pd.Timestamp(end_time, tz='UTC')
+    alert.update({'value': value, 'anomaly_type': anomaly_type, 'description': description,
+                  'meter_type': meter_type})
+    return alert
+
+
+def _finish(pending, state, params, meter_id, meter_type):
+    """Аномалия по кандидату с заполненным окном после него (или None, если условия не выполнены)"""
+    if pending['kind'] == 'extreme_value':
+        value = pending['value']
+        if state['count'] <= 10 or (pending['count'] > 1 and value - pending['last'] < value * 0.5):
+            return None
+        return _alert(meter_id, meter_type, pending['time'], value, 'extreme_value',
+                      f"Экстремальное значение: {value:.2f} л (порог: {params['extreme_threshold']} л)")
+
+    if pending['kind'] == 'z_score':
+        if state['count'] < params['window'] or pending['count'] < 5 or pending['above'] > 3:
+            return None
+        value = pending['value']
+        return _alert(meter_id, meter_type, pending['time'], value, 'z_score',
+                      f"Стат. аномалия: {value:.2f} л (медиана: {pending['median']:.2f}, MAD: {pending['mad']:.2f})")
+
+    if pending['tail_max'] > params['max_flow'] * 0.8:
+        return None
+    duration = (pd.Timestamp(pending['end_time']) - pd.Timestamp(pending['time'])).total_seconds() / 3600
+    return _alert(meter_id, meter_type, pending['time'], pending['value'], 'night_leak',
+                  f"Ночная протечка: {duration:.2f} ч, средний расход: {pending['value']:.2f} л "
+                  f"(CV: {pending['cv']:.2f})",
+                  end_time=pending['end_time'])
+
+
+def _update_pending(state, params, meter_id, meter_type, time, value):
+    """Передает показание окнам кандидатов; кандидаты с закрывшимся окном проверяются"""
+    alerts = []
+    still_pending = []
+    for pending in state['pending']:
+        if time > pending['until']:
+            alert = _finish(pending, state, params, meter_id, meter_type)
+            if alert is not None:
+                alerts.append(alert)
+            continue
+        if pending['kind'] == 'extreme_value':
+            pending['count'] += 1
+            pending['last'] = value
+        elif pending['kind'] == 'z_score':
+            pending['count'] += 1
+            if time <= pending['time'] + NS_PER_HOUR and value > pending['median']:
+                pending['above'] += 1
+        else:
+            pending['tail_max'] = max(pending['tail_max'], value)
+        still_pending.append(pending)
+    state['pending'] = still_pending
+    return alerts
+
+
+def _z_flag(state, params, value):
+    """Обновляет скользящие окна показанием и проверяет условия статистической аномалии.
+
+    Возвращает (условия выполнены, медиана, MAD) для этого показания.
+    """
+    window = params['window']
+    prev_median = _median(state['short_sorted']) if len(state['short']) == 24 else np.nan
+    diff = value - state['last_value'] if state['last_value'] is not None else np.nan
+
+    _slide(state['window'], state['window_sorted'], value, window)
+    median = _median(state['window_sorted']) if len(state['window']) >= 24 else np.nan
+    upper = _quantile(state['window_sorted'], 0.995) if len(state['window']) == window else np.nan
+
+    _slide(state['deviations'], state['deviations_sorted'], None if np.isnan(median) else abs(value - median), window)
+    mad = _median(state['deviations_sorted']) if len(state['deviations_sorted']) >= 24 else np.nan
+    if mad < 0.1:
+        mad = 0.1
+
+    _slide(state['short'], state['short_sorted'], value, 24)
+
+    flag = (0.6745 * (value - median) / mad > params['z_threshold'] * 1.5 and
+            value > upper * 1.5 and
+            value > prev_median * 3 and diff > prev_median * 2)
+    return bool(flag), median, mad
+
+
+def _leak_candidate(run, params):
+    """Кандидат в ночную протечку по последовательности: длинная, стабильная и с низким расходом до нее (иначе None)"""
+    if run is None or len(run['values']) < params['min_duration'] * 2:
+        return None
+    avg_flow, std = run_stats(np.asarray(run['values']))
+    cv = std / avg_flow
+    if cv > 0.2 or run['prev_max'] > params['max_flow'] * 0.8:
+        return None
+    return {
+        'kind': 'night_leak',
+        'time': run['first'],
+        'end_time': run['last'],
+        'until': run['last'] + CONTEXT_HOURS * NS_PER_HOUR,
+        'value': float(avg_flow),
+        'cv': float(cv),
+        'tail_max': run['tail_max'],
+    }
+
+
+def _close_run(state, params):
+    """Завершает ночную последовательность; подходящая ждет 6 часов показаний после ее конца"""
+    candidate = _leak_candidate(state['run'], params)
+    state['run'] = None
+    if candidate is not None:
+        state['pending'].append(candidate)
+
+
+def _update_night(state, params, time, value):
+    """Продолжает или завершает ночную последовательность стабильного расхода"""
+    run = state['run']
+    if run is not None and time <= run['last'] + CONTEXT_HOURS * NS_PER_HOUR:
+        run['tail_max'] = max(run['tail_max'], value)
+
+    hour = time // NS_PER_HOUR % 24
+    if not (hour in params['night_hours'] and params['min_night_flow'] < value < params['max_flow'] * 0.7):
+        return
+
+    if run is not None:
+        change = abs(value - run['values'][-1])
+        if not (change > params['min_night_flow'] * 0.5 or change / run['values'][-1] > 0.3):
+            run['values'].append(value)
+            run['last'] = time
+            run['tail_max'] = value
+            return
+        _close_run(state, params)
+
+    start = time - CONTEXT_HOURS * NS_PER_HOUR
+    lo = bisect.bisect_left(state['history_times'], start)
+    state['run'] = {'first': time, 'last': time, 'values': [value],
+                    'prev_max': max(state['history_values'][lo:]), 'tail_max': value}
+
+
+def update(detector, meter_id, meter_type, time, value):
+    """Обрабатывает новое показание счетчика и возвращает аномалии, которые по нему стали известны.
+
+    time - время показания (нс UTC), meter_type - ключ ANOMALY_PARAMS. Правила
+    те же, что у detect_anomalies: решение по показанию принимается, когда
+    пришли показания на нужное время после него (3 часа для экстремальных
+    значений, 6 часов для статистических аномалий и ночных протечек), поэтому
+    аномалия сообщается с такой задержкой. Упорядоченные окна поддерживаются
+    вставкой в отсортированные списки (см. _slide). Пропуски и показания не
+    новее последнего обработанного не учитываются. Края выгрузки, которые
+    detect_anomalies отмечает из-за неполных окон, аномалиями не считаются.
+    """
+    params = ANOMALY_PARAMS[meter_type]
+    state = detector['meters'].setdefault(meter_type, {}).setdefault(str(meter_id), _new_state())
+    if value is None or np.isnan(value) or (state['last_time'] is not None and time <= state['last_time']):
+        return []
+
+    time, value = int(time), float(value)
+    state['count'] += 1
+    state['history_times'].append(time)
+    state['history_values'].append(value)
+    alerts = _update_pending(state, params, meter_id, meter_type, time, value)
+
+    # Статистическая аномалия в предыдущем показании подтверждается соседними (окно из 3 показаний)
+    flag, median, mad = _z_flag(state, params, value)
+    previous = state['previous']
+    confirmed = state['flags'][0] and state['flags'][1] and flag
+    if confirmed and not state['confirmed']:
+        center = previous['time']
+        state['pending'].append({
+            'kind': 'z_score',
+            'time': center,
+            'until': center + CONTEXT_HOURS * NS_PER_HOUR,
+            'value': previous['value'],
+            'median': previous['median'],
+            'mad': previous['mad'],
+            'count': _count_range(state, center - CONTEXT_HOURS * NS_PER_HOUR, center + CONTEXT_HOURS * NS_PER_HOUR),
+            'above': _count_range(state, center - NS_PER_HOUR, center + NS_PER_HOUR, above=previous['median']),
+        })
+    state['confirmed'] = confirmed
+    state['flags'] = [state['flags'][1], flag]
+    state['previous'] = {'time': time, 'value': value, 'median': median, 'mad': mad}
+
+    # Экстремальное значение: начало превышения порога, проверяется падение за 3 часа
+    extreme = value > params['extreme_threshold']
+    if extreme and not state['extreme']:
+        state['pending'].append({'kind': 'extreme_value', 'time': time, 'until': time + 3 * NS_PER_HOUR,
+                                 'value': value, 'count': 1, 'last': value})
+    state['extreme'] = extreme
+
+    _update_night(state, params, time, value)
+
+    state['last_time'] = time
+    state['last_value'] = value
+    # История нужна только на CONTEXT_HOURS часов назад от последнего показания
+    keep = bisect.bisect_left(state['history_times'], time - CONTEXT_HOURS * NS_PER_HOUR)
+    if keep:
+        del state['history_times'][:keep]
+        del state['history_values'][:keep]
+    return alerts
+
+
+def _readings(df):
+    """Проверяемые показания df в порядке времени: (тип счетчика, ID счетчика, время в нс UTC, значение) массивами"""
+    df = ensure_time(df)
+    # Тип счетчика определяется один раз для каждой пары значений (Series, typeM);
+    # код пропуска -1 указывает на последнее значение 'nan', как при astype(str)
+    series_codes, series = pd.factorize(df['Series'])
+    if 'typeM' in df.columns:
+        type_codes, type_m = pd.factorize(df['typeM'])
+    else:
+        type_codes, type_m = np.zeros(len(df), dtype=np.int64), ['']
+    type_values = [str(value) for value in type_m] + ['nan']
+    types = np.array([[meter_type_of(series_value, type_value) for type_value in type_values]
+                      for series_value in [str(value) for value in series] + ['nan']], dtype=object)
+    meter_types = types[series_codes, type_codes]
+    rows = np.flatnonzero(pd.notna(meter_types) & df['time'].notna().to_numpy() & df['ManagedObjectid'].notna().to_numpy())
+    epoch = time_epoch(df)
+    order = rows[np.argsort(epoch[rows], kind='stable')]
+
+    values = pd.to_numeric(df['Value'], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    return meter_types[order], df['ManagedObjectid'].to_numpy()[order], epoch[order], values[order]
+
+
+def consume(detector, df):
+    """Передает детектору новые показания df (в порядке времени) и возвращает найденные аномалии DataFrame"""
+    if df is None or df.empty or not all(col in df.columns for col in ['Series', 'Value', 'time', 'ManagedObjectid']):
+        return pd.DataFrame()
+
+    alerts = []
+    for meter_type, meter_id, time, value in zip(*_readings(df)):
+        alerts.extend(update(detector, meter_id, meter_type, time, value))
+    return pd.DataFrame(alerts) if alerts else pd.DataFrame()
+
+
+def seed_detector(df, signature=None):
+    """Новый детектор, окна которого заполнены историей показаний df.
+
+    Для каждого счетчика прогоняются только последние SEED_WINDOWS окон
+    правила: аномалии этой истории не сообщаются (их показывает отчет), а
+    кандидаты у ее конца ждут новых показаний, как если бы детектор видел
+    всю историю. Количество показаний счетчика считается по всей истории.
+    """
+    detector = create_detector(signature)
+    if df is None or df.empty or not all(col in df.columns for col in ['Series', 'Value', 'time', 'ManagedObjectid']):
+        return detector
+
+    meter_types, meter_ids, times, values = _readings(df)
+    readings = pd.DataFrame({'type': meter_types, 'meter': pd.Series(meter_ids).astype(str).to_numpy(),
+                             'time': times, 'value': values})
+    # update пропускает пропуски и показания не новее последнего
+    readings = readings[~np.isnan(values)].drop_duplicates(['type', 'meter', 'time'])
+    groups = readings.groupby(['type', 'meter'], sort=False)
+    limits = readings['type'].map({meter_type: SEED_WINDOWS * params['window']
+                                   for meter_type, params in ANOMALY_PARAMS.items()})
+    for meter_type, meter_id, time, value in readings[groups.cumcount(ascending=False) < limits].itertuples(index=False):
+        update(detector, meter_id, meter_type, time, value)
+
+    for (meter_type, meter_id), count in groups.size().items():
+        detector['meters'][meter_type][meter_id]['count'] = int(count)
+    return detector
+
+
+def sync_detector(signature, readings, path=CHECKPOINT_FILE):
+    """Детектор для кэша показаний с сигнатурой signature.
+
+    Берется из контрольной точки, если она построена по тому же содержимому
+    кэша; иначе (кэш пересобран, контрольной точки нет) детектор заново
+    заполняется историей readings() (функция, возвращающая DataFrame
+    показаний) и сохраняется.
+    """
+    detector = load_detector(path)
+    if signature is not None and detector['signature'] == signature:
+        return detector
+    detector = seed_detector(readings(), signature)
+    save_detector(detector, path)
+    return detector
+
+
+def reset_detector(path=CHECKPOINT_FILE):
+    """Удаляет контрольную точку детектора (кэш показаний пересобирается с нуля)"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def save_detector(detector, path=CHECKPOINT_FILE):
+    """Атомарно сохраняет состояние детектора в JSON"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(detector, f)
+    os.replace(tmp_path, path)
+
+
+def load_detector(path=CHECKPOINT_FILE):
+    """Состояние детектора из контрольной точки (новый детектор, если ее нет или она другой версии)"""
+    if not os.path.exists(path):
+        return create_detector()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            detector = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Не удалось прочитать состояние детектора {path}: {e}")
+        return create_detector()
+    if detector.get('version') != CHECKPOINT_VERSION:
+        return create_detector()
+    return detector
+
+
+def report_alerts(alerts):
+    """Печатает найденные аномалии"""
+    if alerts is None or alerts.empty:
+        return
+    for alert in alerts.to_dict('records'):
+        print(f"Аномалия: счетчик {alert['meter_id']} ({alert['meter_type']}), {alert['time']}: {alert['description']}")
+
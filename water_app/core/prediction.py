@@ -7,6 +7,11 @@ from sklearn.pipeline import Pipeline
 from sklearn.impute import SimpleImputer
 from datetime import timedelta
 
+from core.meter_store import iter_meter_series
+from core.report_context import register_artifact
+from core.report_writer import render, write
+from core.timestamps import valid_time
+
 
 def predict_consumption(df, forecast_hours=24, min_history_days=7):
     """Устойчивая функция прогнозирования с полной обработкой ошибок"""
@@ -21,21 +26,19 @@ def predict_consumption(df, forecast_hours=24, min_history_days=7):
         return pd.DataFrame()
 
     try:
-        # Предобработка данных
-        df = df.copy()
-        df['time'] = pd.to_datetime(df['time'], errors='coerce')
-        df = df.dropna(subset=['time'])
-        df = df.sort_values(['ManagedObjectid', 'time'])
-
-        # Обработка значений
-        df['Value'] = pd.to_numeric(df['Value'], errors='coerce')
-        df = df.dropna(subset=['Value'])
-        df = df[df['Value'].between(0, 1000)]  # Фильтр нереалистичных значений
+        # Предобработка данных: время уже разобрано при загрузке, копия не нужна
+        df = valid_time(df)
 
         predictions = []
 
-        for meter_id, group in df.groupby('ManagedObjectid'):
+        # Ряды счетчиков берутся срезами из хранилища серий (или группировкой df)
+        for meter_id, values in iter_meter_series(df):
             try:
+                # Обработка значений
+                values = pd.to_numeric(values, errors='coerce').dropna()
+                values = values[values.between(0, 1000)]  # Фильтр нереалистичных значений
+                group = pd.DataFrame({'time': values.index, 'Value': values.to_numpy()})
+
                 # Проверка достаточности данных
                 if len(group) < min_history_days * 24:
                     continue
@@ -154,10 +157,23 @@ def predict_consumption(df, forecast_hours=24, min_history_days=7):
 
     return pd.concat(predictions) if predictions else pd.DataFrame()
 
-def format_predictions(predictions_df: pd.DataFrame) -> str:
-    """Форматирование отчета о предсказаниях в строку"""
+
+# Прогноз для отчета - на сутки вперед
+register_artifact('predictions', lambda df: predict_consumption(df, forecast_hours=24))
+
+
+def format_predictions(predictions_df: pd.DataFrame, writer=None) -> str:
+    """Форматирование отчета о предсказаниях в строку.
+
+    Если передан писатель отчета writer, прогнозы передаются ему по счетчику
+    и функция возвращает None.
+    """
+    if writer is None:
+        return render(lambda writer: format_predictions(predictions_df, writer))
+
     if predictions_df.empty:
-        return "\nНет данных для прогнозирования или не удалось сделать прогноз\n"
+        write(writer, "\nНет данных для прогнозирования или не удалось сделать прогноз\n")
+        return None
 
     # Группировка по счетчикам
     meter_counts = predictions_df['meter_id'].value_counts()
@@ -171,11 +187,12 @@ def format_predictions(predictions_df: pd.DataFrame) -> str:
     output.append("\nКоличество прогнозов по счетчикам:")
     for meter_id, count in meter_counts.items():
         output.append(f"- {meter_id}: {count} прогнозов")
+    write(writer, "\n".join(output))
 
     # Добавляем детали по первым нескольким прогнозам для каждого счетчика
-    output.append("\n=== ДЕТАЛИ ПРОГНОЗОВ ===")
+    write(writer, "\n\n=== ДЕТАЛИ ПРОГНОЗОВ ===")
     for meter_id, group in predictions_df.groupby('meter_id'):
-        output.append(f"\nСчетчик: {meter_id}")
+        output = [f"\n\nСчетчик: {meter_id}"]
         output.append(f"Частота данных: {group['freq_minutes'].iloc[0]:.0f} минут")
 
         first_pred = group.iloc[0]
@@ -184,7 +201,6 @@ def format_predictions(predictions_df: pd.DataFrame) -> str:
         output.append(f"Период прогноза: {first_pred['time']} - {last_pred['time']}")
         output.append(f"Среднее прогнозируемое значение: {group['predicted'].mean():.2f} л/ч")
 
-        for _, row in group.iterrows():
-            output.append(f"- {row['time']}: {row['predicted']:.2f} л")
-
-    return "\n".join(output)
\ No newline at end of file
+        output.extend(f"- {time}: {predicted:.2f} л" for time, predicted in zip(group['time'], group['predicted']))
+        write(writer, "\n".join(output))
+    return None
@@ -0,0 +1,128 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.report_writer import create_writer, flush, render, write
+
+
+# Функции вычисления артефактов отчета: имя -> функция от датафрейма выборки.
+# Модули анализа регистрируют свои артефакты через register_artifact
+ARTIFACTS = {}
+
+# Сколько разделов отчета считается одновременно
+REPORT_WORKERS = min(6, os.cpu_count() or 1)
+
+# Контекст последнего отчета: повторный отчет по тем же выборкам берет артефакты из него
+_recent = {'context': None}
+_lock = threading.Lock()
+
+
+def register_artifact(name, compute):
+    """Регистрирует функцию вычисления артефакта отчета"""
+    ARTIFACTS[name] = compute
+
+
+def create_context(df, df2=None):
+    """Новый контекст отчета по выборке df (и второй выборке сравнения df2)"""
+    return {'df': df, 'df2': df2, 'artifacts': {}, 'locks': {}, 'lock': threading.Lock()}
+
+
+def context_for(df, df2=None):
+    """Контекст отчета для выборок df и df2.
+
+    Если выборки те же, что у предыдущего отчета (кэш фильтров возвращает
+    для одинаковых фильтров тот же датафрейм), возвращается его контекст:
+    например, экспорт в PDF после построения отчета ничего не пересчитывает.
+    """
+    with _lock:
+        context = _recent['context']
+        if context is None or context['df'] is not df or context['df2'] is not df2:
+            context = create_context(df, df2)
+            _recent['context'] = context
+        return context
+
+
+def get_artifact(context, name):
+    """Артефакт name выборки контекста: вычисляется при первом обращении, затем берется из контекста.
+
+    Одновременные обращения к одному артефакту из разных потоков вычисляют
+    его один раз; ошибка вычисления не запоминается.
+    """
+    with context['lock']:
+        if name in context['artifacts']:
+            return context['artifacts'][name]
+        lock = context['locks'].setdefault(name, threading.Lock())
+
+    with lock:
+        if name not in context['artifacts']:
+            context['artifacts'][name] = ARTIFACTS[name](context['df'])
+        return context['artifacts'][name]
+
+
+def run_sections(sections, modes, workers=REPORT_WORKERS, writer=None):
+    """Выполняет разделы отчета выбранных режимов и передает их текст в порядке номеров режимов.
+
+    sections - номер режима -> функция section(writer), которая передает текст
+    раздела писателю отчета фрагментами (например, по счетчику), не собирая его целиком.
+    Разделы выполняются одновременно в пуле потоков: общие артефакты они берут
+    из контекста отчета, а тяжелые вычисления (pandas, numpy, sklearn) большую
+    часть времени не держат GIL. Ошибка раздела поднимается, как при
+    последовательном выполнении.
+
+    Если передан писатель отчета writer (см. core.report_writer), текст
+    передается ему по мере готовности, а функция возвращает None; иначе
+    возвращается текст отчета.
+    """
+    if writer is None:
+        return render(lambda writer: run_sections(sections, modes, workers, writer))
+
+    selected = [mode for mode in sorted(sections) if mode in modes]
+    if workers <= 1 or len(selected) <= 1:
+        for mode in selected:
+            sections[mode](writer)
+        return None
+
+    _run_parallel([sections[mode] for mode in selected], workers, writer)
+    return None
+
+
+def _run_parallel(sections, workers, writer):
+    """Выполняет разделы в пуле потоков; текст передается писателю в потоке вызова.
+
+    Каждый раздел пишет в свой писатель, блоки которого попадают в очередь.
+    Блоки текущего (первого незавершенного) раздела сразу передаются writer,
+    блоки следующих разделов ждут своей очереди. Приемник writer вызывается
+    только из потока вызова (виджеты Tk не потокобезопасны).
+    """
+    blocks = queue.Queue()
+
+    def run(position, section):
+        section_writer = create_writer(lambda text: blocks.put((position, text)), writer['chunk_size'])
+        try:
+            section(section_writer)
+            flush(section_writer)
+        finally:
+            blocks.put((position, None))  # Раздел завершен
+
+    waiting = [[] for _ in sections]
+    finished = [False] * len(sections)
+    with ThreadPoolExecutor(max_workers=min(workers, len(sections))) as executor:
+        futures = [executor.submit(run, position, section) for position, section in enumerate(sections)]
+        current = 0
+        while current < len(sections):
+            position, text = blocks.get()
+            if text is None:
+                finished[position] = True
+            elif position == current:
+                write(writer, text)
+            else:
+                waiting[position].append(text)
+
+            while current < len(sections) and finished[current]:
+                futures[current].result()
+                current += 1
+                if current < len(sections):
+                    for text in waiting[current]:
+                        write(writer, text)
+                    waiting[current] = []
@@ -0,0 +1,47 @@
+# Сколько символов текста копится перед передачей приемнику
+CHUNK_SIZE = 16 * 1024
+
+
+def create_writer(sink, chunk_size=CHUNK_SIZE):
+    """Писатель отчета: копит фрагменты текста и передает их приемнику sink(text) блоками.
+
+    Приемник - любая функция от строки: вставка в виджет, добавление в PDF.
+    В памяти держится не больше chunk_size символов (плюс последний фрагмент).
+    """
+    return {'sink': sink, 'parts': [], 'size': 0, 'chunk_size': chunk_size}
+
+
+def write(writer, text):
+    """Добавляет текст в отчет; накопленный блок передается приемнику"""
+    if not text:
+        return
+    writer['parts'].append(text)
+    writer['size'] += len(text)
+    if writer['size'] >= writer['chunk_size']:
+        flush(writer)
+
+
+def flush(writer):
+    """Передает приемнику накопленный текст"""
+    if writer['parts']:
+        text = "".join(writer['parts'])
+        writer['parts'] = []
+        writer['size'] = 0
+        writer['sink'](text)
+
+
+def emit(writer, text):
+    """Текст отчета без писателя (writer=None) или передача его писателю (тогда None)"""
+    if writer is None:
+        return text
+    write(writer, text)
+    return None
+
+
+def render(produce, chunk_size=CHUNK_SIZE):
+    """Текст, который produce(writer) передает писателю, одной строкой (для вызовов без писателя)"""
+    parts = []
+    writer = create_writer(parts.append, chunk_size)
+    produce(writer)
+    flush(writer)
+    return "".join(parts)
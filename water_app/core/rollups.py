@@ -0,0 +1,235 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from core import sketches
+from core.aggregation import NS_PER_HOUR, group_moments
+from core.timestamps import time_epoch
+
+
+ROLLUP_DIR = 'dataset/.cache/rollups'
+INDEX_FILE = 'index.json'
+ROLLUP_VERSION = 2
+# Уровни сводных таблиц: размер корзины времени в часах
+LEVELS = {'hour': 1, 'day': 24}
+# Ключ ячейки: коды счетчика, typeM и Series в словарях labels и номер корзины времени (UTC)
+KEY_FIELDS = ['meter', 'typeM', 'Series', 'bucket']
+# Агрегаты ячейки: строки, показания (без пропусков), сумма, центральная сумма квадратов, минимум, максимум, нули
+STAT_FIELDS = ['rows', 'count', 'sum', 'm2', 'min', 'max', 'zeros']
+LABEL_COLUMNS = {'meter': 'ManagedObjectid', 'typeM': 'typeM', 'Series': 'Series'}
+# Скетчи квантилей: количество показаний по корзинам скетча в ячейках (счетчик, typeM, Series, день)
+SKETCH_LEVEL = 'sketch'
+SKETCH_HOURS = 24
+SKETCH_KEY_FIELDS = KEY_FIELDS + ['key']
+SKETCH_FIELDS = SKETCH_KEY_FIELDS + ['count']
+
+# Сводная таблица, открытая при загрузке данных
+_active_rollup = None
+
+
+def _labels(series):
+    """Коды строк и строковые значения колонки; пустое значение - 'nan', как при astype(str)"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = [str(value) for value in series.cat.categories]
+        codes = series.cat.codes.to_numpy().astype(np.int64)
+        if (codes < 0).any():
+            codes = np.where(codes < 0, len(categories), codes)
+            categories.append('nan')
+        return codes, categories
+
+    codes, uniques = pd.factorize(series.astype(str))
+    return codes.astype(np.int64), list(uniques)
+
+
+def level_hours(level):
+    """Размер корзины времени уровня в часах"""
+    return SKETCH_HOURS if level == SKETCH_LEVEL else LEVELS[level]
+
+
+def _level_fields(level):
+    """Поля ключа и все поля ячеек уровня"""
+    if level == SKETCH_LEVEL:
+        return SKETCH_KEY_FIELDS, SKETCH_FIELDS
+    return KEY_FIELDS, KEY_FIELDS + STAT_FIELDS
+
+
+def _group(cells, key_fields=KEY_FIELDS):
+    """Объединяет ячейки с одинаковым ключом: минимумы и максимумы сравниваются, остальные поля складываются.
+
+    Центральные суммы квадратов m2 объединяются по формуле Чана (aggregation.group_moments).
+    """
+    if not len(cells['bucket']):
+        return cells
+
+    order = np.lexsort([cells[field] for field in reversed(key_fields)])
+    keys = [cells[field][order] for field in key_fields]
+    changed = np.zeros(len(order), dtype=bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(changed)
+
+    grouped = {field: key[starts] for field, key in zip(key_fields, keys)}
+    for field in cells:
+        if field in key_fields or field == 'm2':
+            continue
+        reduce = {'min': np.fmin, 'max': np.fmax}.get(field, np.add)
+        grouped[field] = reduce.reduceat(cells[field][order], starts)
+    if 'm2' in cells:
+        groups = np.cumsum(changed) - 1
+        grouped['m2'] = group_moments(groups, len(starts), cells['count'][order], cells['sum'][order],
+                                      cells['m2'][order])[2]
+    return grouped
+
+
+def _levels(hour_cells):
+    """Ячейки всех уровней из часовых ячеек"""
+    levels = {'hour': _group(hour_cells)}
+    for level, hours in LEVELS.items():
+        if hours != 1:
+            levels[level] = _group({**levels['hour'], 'bucket': levels['hour']['bucket'] // hours})
+    return levels
+
+
+def _sketch_cells(cells, values, error):
+    """Скетчи квантилей по суткам из часовых ячеек отдельных показаний (пропуски Value не учитываются)"""
+    valid = cells['count'] > 0
+    sketch = {field: cells[field][valid] for field in LABEL_COLUMNS}
+    sketch['bucket'] = cells['bucket'][valid] // SKETCH_HOURS
+    sketch['key'] = sketches.sketch_keys(values[valid], error)
+    sketch['count'] = np.ones(int(valid.sum()), dtype=np.int64)
+    return _group(sketch, SKETCH_KEY_FIELDS)
+
+
+def build_rollup(df):
+    """Строит сводные таблицы показаний: (счетчик, typeM, Series, час/день) -> агрегаты.
+
+    Рядом строятся скетчи квантилей с относительной ошибкой из настроек
+    (см. core.sketches). Строки без времени в сводные таблицы не попадают.
+    Возвращает None, если в данных нет нужных колонок.
+    """
+    if df is None or not all(col in df.columns for col in list(LABEL_COLUMNS.values()) + ['time', 'Value']):
+        return None
+
+    epoch = time_epoch(df)
+    timed = epoch != np.iinfo('i8').min
+    values = pd.to_numeric(df['Value'], errors='coerce').to_numpy(dtype='float64')
+    valid = ~np.isnan(values)
+
+    labels = {}
+    cells = {}
+    for field, column in LABEL_COLUMNS.items():
+        cells[field], labels[field] = _labels(df[column])
+    cells['bucket'] = epoch // NS_PER_HOUR
+    cells.update({
+        'rows': np.ones(len(df), dtype=np.int64),
+        'count': valid.astype(np.int64),
+        'sum': np.where(valid, values, 0),
+        'm2': np.zeros(len(df)),
+        'min': values,
+        'max': values,
+        'zeros': (values == 0).astype(np.int64),
+    })
+    cells = {field: array[timed] for field, array in cells.items()}
+
+    error = sketches.sketch_error()
+    return {'source_rows': len(df), 'labels': labels, 'sketch_error': error,
+            **_levels(cells), SKETCH_LEVEL: _sketch_cells(cells, values[timed], error)}
+
+
+def merge_rollups(rollup, update):
+    """Добавляет к сводным таблицам rollup таблицы новых показаний update"""
+    if update is None:
+        return rollup
+
+    labels = {}
+    remap = {}
+    for field in LABEL_COLUMNS:
+        labels[field] = list(rollup['labels'][field])
+        positions = {label: code for code, label in enumerate(labels[field])}
+        for label in update['labels'][field]:
+            if label not in positions:
+                positions[label] = len(labels[field])
+                labels[field].append(label)
+        remap[field] = np.array([positions[label] for label in update['labels'][field]], dtype=np.int64)
+
+    merged = {'source_rows': rollup['source_rows'] + update['source_rows'], 'labels': labels,
+              'sketch_error': rollup['sketch_error'], 'signature': rollup.get('signature')}
+    for level in list(LEVELS) + [SKETCH_LEVEL]:
+        new_cells = dict(update[level])
+        for field in LABEL_COLUMNS:
+            new_cells[field] = remap[field][new_cells[field]] if len(new_cells[field]) else new_cells[field]
+        key_fields, fields = _level_fields(level)
+        merged[level] = _group({field: np.concatenate([rollup[level][field], new_cells[field]])
+                                for field in fields}, key_fields)
+    return merged
+
+
+def save_rollup(rollup, directory=ROLLUP_DIR):
+    """Сохраняет сводные таблицы: массивы уровней в .npz, словари, число строк и сигнатуру кэша в index.json"""
+    tmp_directory = directory + '.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    for level in list(LEVELS) + [SKETCH_LEVEL]:
+        np.savez(os.path.join(tmp_directory, f'{level}.npz'), **rollup[level])
+    with open(os.path.join(tmp_directory, INDEX_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'version': ROLLUP_VERSION, 'source_rows': rollup['source_rows'], 'labels': rollup['labels'],
+                   'sketch_error': rollup['sketch_error'], 'signature': rollup.get('signature')}, f)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+    print(f"Сводные таблицы сохранены в {directory}: {len(rollup['hour']['bucket'])} часовых ячеек")
+
+
+def open_rollup(directory=ROLLUP_DIR):
+    """Открывает сохраненные сводные таблицы (или None, если их нет, они другой версии или скетчи построены с другой ошибкой)"""
+    index_path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != ROLLUP_VERSION or meta.get('sketch_error') != sketches.sketch_error():
+            return None
+        rollup = {'source_rows': meta['source_rows'], 'labels': meta['labels'], 'sketch_error': meta['sketch_error'],
+                  'signature': meta.get('signature')}
+        for level in list(LEVELS) + [SKETCH_LEVEL]:
+            with np.load(os.path.join(directory, f'{level}.npz')) as arrays:
+                rollup[level] = {field: arrays[field] for field in _level_fields(level)[1]}
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Не удалось открыть сводные таблицы {directory}: {e}")
+        return None
+    return rollup
+
+
+def load_or_build(df, rebuild=False, persist=True, directory=ROLLUP_DIR, signature=None):
+    """Открывает сводные таблицы для df (пересобирая их при необходимости) и делает активными.
+
+    signature - сигнатура кэша показаний (storage.cache_signature): таблицы,
+    построенные по другому содержимому кэша, пересобираются, даже если число строк совпадает.
+    """
+    rollup = None if rebuild or not persist else open_rollup(directory)
+    if rollup is None or rollup['source_rows'] != len(df) or rollup['signature'] != signature:
+        rollup = build_rollup(df)
+        if rollup is not None:
+            rollup['signature'] = signature
+            if persist:
+                save_rollup(rollup, directory)
+    set_active_rollup(rollup)
+    return rollup
+
+
+def set_active_rollup(rollup):
+    """Делает сводные таблицы доступными для функций анализа"""
+    global _active_rollup
+    _active_rollup = rollup
+
+
+def get_active_rollup():
+    """Возвращает текущие сводные таблицы (или None)"""
+    return _active_rollup
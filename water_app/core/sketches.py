@@ -0,0 +1,99 @@
+import numpy as np
+
+
+# Относительная ошибка приближенных квантилей по умолчанию (1%)
+SKETCH_ERROR = 0.01
+# Значения меньше по модулю попадают в корзину нуля
+MIN_VALUE = 1e-9
+
+# Режим квантилей: точные (по показаниям) или приближенные (по скетчам сводных таблиц)
+_settings = {'approximate': False, 'error': SKETCH_ERROR}
+
+
+def set_quantile_mode(approximate, error=None):
+    """Включает или выключает приближенные квантили; error - допустимая относительная ошибка (0 < error < 1)"""
+    if error is not None:
+        if not 0 < error < 1:
+            print(f"Некорректная ошибка квантилей {error}: используется {_settings['error']}")
+        else:
+            _settings['error'] = float(error)
+    _settings['approximate'] = bool(approximate)
+
+
+def approximate_quantiles():
+    """Проверяет, включен ли режим приближенных квантилей"""
+    return _settings['approximate']
+
+
+def sketch_error():
+    """Относительная ошибка, с которой строятся скетчи"""
+    return _settings['error']
+
+
+def _gamma(error):
+    """Отношение границ соседних корзин"""
+    return (1 + error) / (1 - error)
+
+
+def _bias(error):
+    """Сдвиг ключей, при котором ключи всех ненулевых значений положительны"""
+    return int(-np.floor(np.log(MIN_VALUE) / np.log(_gamma(error)))) + 1
+
+
+def sketch_keys(values, error=None):
+    """Ключи корзин скетча для показаний без пропусков.
+
+    Корзина k содержит значения из (gamma^(k-1), gamma^k], поэтому значение
+    корзины отличается от любого ее показания не больше чем на error.
+    Ключ 0 - ноль, знак ключа - знак показания: порядок ключей совпадает
+    с порядком показаний.
+    """
+    error = error or sketch_error()
+    values = np.asarray(values, dtype='float64')
+    magnitude = np.abs(values)
+    nonzero = magnitude >= MIN_VALUE
+
+    keys = np.zeros(len(values), dtype=np.int64)
+    keys[nonzero] = np.ceil(np.log(magnitude[nonzero]) / np.log(_gamma(error))).astype(np.int64) + _bias(error)
+    return np.where(values < 0, -keys, keys)
+
+
+def key_values(keys, error=None, integer=False):
+    """Значения корзин по ключам; для целых показаний малые значения округляются до точного целого"""
+    error = error or sketch_error()
+    gamma = _gamma(error)
+    magnitude = np.abs(keys)
+    values = np.where(magnitude > 0, 2 * gamma ** (magnitude - _bias(error)) / (gamma + 1), 0.0)
+    if integer:
+        # Пока error * значение < 0.5, в корзине не больше одного целого, и округление его восстанавливает
+        values = np.where(values < 0.5 / error, np.round(values), values)
+    return np.where(keys < 0, -values, values)
+
+
+def merge_sketches(*sketches):
+    """Объединяет скетчи (ключи, количества) в один: количества одинаковых ключей складываются"""
+    keys = np.concatenate([sketch[0] for sketch in sketches])
+    counts = np.concatenate([sketch[1] for sketch in sketches])
+    keys, positions = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(positions, weights=counts, minlength=len(keys)).astype(np.int64)
+
+
+def sketch_quantiles(keys, counts, quantiles, error=None, integer=False):
+    """Квантили по скетчу с линейной интерполяцией между соседними порядковыми статистиками (как np.quantile).
+
+    Каждая порядковая статистика оценивается значением своей корзины,
+    поэтому относительная ошибка результата не превышает error.
+    """
+    order = np.argsort(keys, kind='stable')
+    keys, counts = keys[order], counts[order]
+    total = int(counts.sum())
+    if not total:
+        return np.full(len(quantiles), np.nan)
+
+    cumulative = np.cumsum(counts)
+    positions = np.asarray(quantiles, dtype='float64') * (total - 1)
+    lower = np.floor(positions)
+    upper = np.minimum(lower + 1, total - 1)
+    lower_values = key_values(keys[np.searchsorted(cumulative, lower, side='right')], error, integer)
+    upper_values = key_values(keys[np.searchsorted(cumulative, upper, side='right')], error, integer)
+    return lower_values + (upper_values - lower_values) * (positions - lower)
@@ -0,0 +1,471 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # Кэш работает только при установленном pyarrow
+    pa = None
+    ds = None
+    pq = None
+
+
+CACHE_DIR = 'dataset/.cache'
+CACHE_VERSION = 4
+MANIFEST_FILE = 'manifest.json'
+READINGS_DIR = 'readings'
+PARTITION_KEY = 'month'  # Части кэша разбиты по месяцам: readings/month=YYYY-MM/part-NNNNN.parquet
+STAGED_SUFFIX = '.staged'  # Дописанные части до записи манифеста: при чтении кэша не видны
+HASH_BLOCK_SIZE = 1 << 20  # 1 МБ
+ROW_GROUP_SIZE = 128 * 1024  # Строк в группе: группы, не подходящие под условие чтения, пропускаются по статистикам
+
+
+def is_available():
+    """Проверяет, доступен ли pyarrow для работы с кэшем"""
+    return pq is not None
+
+
+def file_signature(file_path, with_hash=True):
+    """Возвращает размер, время изменения и (опционально) хэш содержимого файла"""
+    stat = os.stat(file_path)
+    signature = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+    }
+    if with_hash:
+        signature['sha256'] = file_hash(file_path)
+    return signature
+
+
+def file_hash(file_path, limit=None):
+    """Считает SHA-256 файла блоками, не загружая его целиком в память"""
+    digest = hashlib.sha256()
+    remaining = limit
+    with open(file_path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            size = HASH_BLOCK_SIZE if remaining is None else min(HASH_BLOCK_SIZE, remaining)
+            block = f.read(size)
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+
+def read_manifest(cache_dir=CACHE_DIR):
+    """Читает манифест кэша (или возвращает None, если его нет)"""
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Не удалось прочитать манифест кэша: {e}")
+        return None
+
+    if manifest.get('version') != CACHE_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(manifest, cache_dir=CACHE_DIR):
+    """Атомарно записывает манифест кэша"""
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest['version'] = CACHE_VERSION
+    path = os.path.join(cache_dir, MANIFEST_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def cache_signature(manifest):
+    """Сигнатура содержимого кэша: версия кэша, число строк и размеры с хэшами файлов-источников.
+
+    Производные данные кэша (хранилище серий, сводные таблицы) запоминают ее
+    при сборке и пересобираются, если она изменилась. None, если манифеста нет.
+    """
+    if manifest is None:
+        return None
+    sources = {name: [signature.get('size'), signature.get('sha256')]
+               for name, signature in manifest.get('sources', {}).items()}
+    content = json.dumps({'version': CACHE_VERSION, 'rows': manifest.get('rows'), 'sources': sources}, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _signature_matches(saved, current, file_path):
+    """Сравнивает файл с сохраненной сигнатурой: сначала размер и mtime, затем хэш"""
+    if current['size'] == saved.get('size') and current['mtime'] == saved.get('mtime'):
+        return True
+    if current['size'] != saved.get('size') or file_hash(file_path) != saved.get('sha256'):
+        return False
+
+    # Содержимое не изменилось, обновляем только время модификации
+    saved['mtime'] = current['mtime']
+    return True
+
+
+def _appended_offset(saved, current, file_path):
+    """Возвращает смещение дописанной части файла или None, если файл изменен иначе.
+
+    Файл считается дописанным, если он вырос, его начало совпадает по хэшу
+    с сохраненной версией и сохраненная версия заканчивалась переводом строки.
+    """
+    offset = saved.get('size')
+    if not offset or current['size'] <= offset:
+        return None
+    if file_hash(file_path, limit=offset) != saved.get('sha256'):
+        return None
+
+    with open(file_path, 'rb') as f:
+        f.seek(offset - 1)
+        if f.read(1) != b'\n':
+            return None
+    return offset
+
+
+def plan_update(manifest, sources):
+    """Определяет, как привести кэш в соответствие с источниками.
+
+    Возвращает None, если кэш нужно пересобрать целиком (нет манифеста,
+    файл удален или переписан), иначе словарь:
+    new - новые файлы, appended - {файл: смещение дописанной части}.
+    """
+    if manifest is None:
+        return None
+
+    recorded = manifest.get('sources', {})
+    if not set(recorded) <= set(sources):
+        return None
+
+    plan = {'new': [], 'appended': {}}
+    for name, file_path in sources.items():
+        if not os.path.exists(file_path):
+            return None
+
+        current = file_signature(file_path, with_hash=False)
+        saved = recorded.get(name)
+        if saved is None:
+            plan['new'].append(file_path)
+        elif not _signature_matches(saved, current, file_path):
+            offset = _appended_offset(saved, current, file_path)
+            if offset is None:
+                return None
+            plan['appended'][file_path] = offset
+
+    return plan
+
+
+def readings_schema(df):
+    """Строит схему Arrow для частей кэша по образцу датафрейма.
+
+    Строковые (и пустые) колонки хранятся как string, а целочисленные колонки
+    (кроме ID счетчика) - как float64, потому что в других частях в них
+    могут быть пропуски. Категории хранятся как обычные значения
+    (словари частей независимы). Так все части кэша имеют одну схему.
+    """
+    fields = []
+    for field in pa.Schema.from_pandas(df, preserve_index=False):
+        if pa.types.is_dictionary(field.type):
+            field = field.with_type(field.type.value_type)
+        if field.name == 'ManagedObjectid' and pa.types.is_integer(field.type):
+            field = field.with_type(pa.int64())
+        elif pa.types.is_integer(field.type):
+            field = field.with_type(pa.float64())
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def new_readings_dir(cache_dir=CACHE_DIR):
+    """Создает пустой временный каталог для новых частей кэша"""
+    tmp_target = os.path.join(cache_dir, READINGS_DIR) + '.tmp'
+    shutil.rmtree(tmp_target, ignore_errors=True)
+    os.makedirs(tmp_target)
+    return tmp_target
+
+
+def commit_readings_dir(tmp_target, cache_dir=CACHE_DIR):
+    """Заменяет каталог кэша подготовленным временным каталогом"""
+    target = os.path.join(cache_dir, READINGS_DIR)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp_target, target)
+
+
+def _partition_name(month):
+    """Имя каталога раздела для месяца (numpy datetime64[M]); строки без времени - в month=none"""
+    if np.isnat(month):
+        return f'{PARTITION_KEY}=none'
+    return f'{PARTITION_KEY}={np.datetime_as_string(month, unit="M")}'
+
+
+def _split_by_month(chunk):
+    """Делит блок показаний на части по месяцам (UTC): {имя раздела: блок}"""
+    if 'time' not in chunk.columns:
+        return {f'{PARTITION_KEY}=none': chunk}
+
+    months = chunk['time'].to_numpy(dtype='datetime64[ns]').astype('datetime64[M]')
+    unique = np.unique(months)
+    if len(unique) == 1:
+        return {_partition_name(unique[0]): chunk}
+
+    parts = {}
+    for month in unique:
+        mask = np.isnat(months) if np.isnat(month) else months == month
+        parts[_partition_name(month)] = chunk[mask]
+    return parts
+
+
+def write_part(chunks, directory, name, schema=None):
+    """Записывает датафрейм или итератор блоков частью кэша, разбитой по месяцам.
+
+    Строки каждого месяца попадают в файл directory/month=YYYY-MM/name
+    (блок = группа строк), поэтому фильтр по датам открывает только
+    пересекающиеся разделы. Файлы появляются под итоговыми именами
+    только после успешной записи. Возвращает количество записанных строк.
+    """
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+
+    writers = {}
+    rows = 0
+    try:
+        for chunk in chunks:
+            if chunk is None or chunk.empty:
+                continue
+
+            if schema is None:
+                schema = readings_schema(chunk)
+            for partition, part in _split_by_month(chunk).items():
+                if partition not in writers:
+                    os.makedirs(os.path.join(directory, partition), exist_ok=True)
+                    writers[partition] = pq.ParquetWriter(os.path.join(directory, partition, name + '.tmp'), schema)
+                writers[partition].write_table(pa.Table.from_pandas(part, schema=schema, preserve_index=False),
+                                               row_group_size=ROW_GROUP_SIZE)
+            rows += len(chunk)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    for partition in writers:
+        path = os.path.join(directory, partition, name)
+        os.replace(path + '.tmp', path)
+    return rows
+
+
+def write_readings(chunks, cache_dir=CACHE_DIR):
+    """Сохраняет объединенные данные в кэш Parquet.
+
+    chunks - датафрейм или итератор датафреймов (каждый блок записывается
+    отдельной группой строк, поэтому весь набор данных в памяти не держится).
+    Возвращает количество записанных строк.
+    """
+    tmp_target = new_readings_dir(cache_dir)
+    rows = write_part(chunks, tmp_target, 'part-00000.parquet')
+    commit_readings_dir(tmp_target, cache_dir)
+    return rows
+
+
+def read_readings(cache_dir=CACHE_DIR, columns=None, categorical=None, start=None, end=None, values=None):
+    """Читает объединенный датафрейм из кэша Parquet.
+
+    Строковые колонки из categorical читаются сразу как словарь + коды
+    (pandas.Categorical), без построчного создания Python-строк.
+    start/end (UTC, конец не включается) ограничивают период: открываются
+    только разделы-месяцы, пересекающиеся с ним. values - допустимые значения
+    колонок {колонка: значения}. Период и значения передаются в чтение как
+    условие, поэтому группы строк, которые по статистикам ему не соответствуют,
+    не распаковываются.
+    """
+    files = _part_files(os.path.join(cache_dir, READINGS_DIR), start, end)
+    if not files:
+        return pd.DataFrame(columns=columns) if columns else pd.DataFrame()
+
+    schema = pq.read_schema(files[0])
+    read_dictionary = None
+    if categorical:
+        read_dictionary = [name for name in categorical
+                           if name in schema.names and pa.types.is_string(schema.field(name).type)]
+
+    predicate = scan_predicate(schema, start, end, values)
+    table = pq.ParquetDataset(files, partitioning=None, read_dictionary=read_dictionary,
+                              filters=predicate).read(columns=columns)
+    return table.to_pandas()
+
+
+def scan_predicate(schema, start=None, end=None, values=None):
+    """Условие чтения частей кэша: время в [start, end) и значения колонок из values (None - без условия)"""
+    conditions = []
+    if 'time' in schema.names:
+        time_type = schema.field('time').type
+        if start is not None:
+            conditions.append(ds.field('time') >= pa.scalar(start, type=time_type))
+        if end is not None:
+            conditions.append(ds.field('time') < pa.scalar(end, type=time_type))
+
+    for column, allowed in (values or {}).items():
+        if column in schema.names:
+            conditions.append(ds.field(column).isin(pa.array(list(allowed), type=schema.field(column).type)))
+
+    predicate = None
+    for condition in conditions:
+        predicate = condition if predicate is None else predicate & condition
+    return predicate
+
+
+def _partition_overlaps(partition, start, end):
+    """Проверяет, пересекается ли раздел-месяц с периодом [start, end)"""
+    value = partition.split('=', 1)[1]
+    if value == 'none':
+        return start is None and end is None
+
+    month_start = pd.Timestamp(value, tz='UTC')
+    month_end = month_start + pd.DateOffset(months=1)
+    return (start is None or month_end > start) and (end is None or month_start < end)
+
+
+def _part_files(path, start=None, end=None):
+    """Возвращает отсортированный список файлов-частей кэша из разделов, пересекающихся с периодом"""
+    files = []
+    for partition in sorted(os.listdir(path)):
+        partition_path = os.path.join(path, partition)
+        if not os.path.isdir(partition_path) or not partition.startswith(PARTITION_KEY + '='):
+            continue
+        if not _partition_overlaps(partition, start, end):
+            continue
+        files.extend(os.path.join(partition_path, name)
+                     for name in sorted(os.listdir(partition_path)) if name.endswith('.parquet'))
+    return files
+
+
+def recent_start(months=2, cache_dir=CACHE_DIR):
+    """Начало последних months разделов-месяцев кэша (UTC) или None, если разделов с временем нет"""
+    path = os.path.join(cache_dir, READINGS_DIR)
+    present = [partition.split('=', 1)[1] for partition in (os.listdir(path) if os.path.isdir(path) else [])
+               if partition.startswith(PARTITION_KEY + '=') and partition != f'{PARTITION_KEY}=none']
+    if not present:
+        return None
+    return pd.Timestamp(max(present), tz='UTC') - pd.DateOffset(months=months - 1)
+
+
+def _partition_files(path, suffix):
+    """Пути файлов всех разделов каталога кэша, имена которых заканчиваются на suffix"""
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, partition, name)
+            for partition in sorted(os.listdir(path)) if os.path.isdir(os.path.join(path, partition))
+            for name in sorted(os.listdir(os.path.join(path, partition))) if name.endswith(suffix)]
+
+
+def stage_part(df, cache_dir=CACHE_DIR):
+    """Пишет датафрейм новой частью кэша со схемой существующих частей.
+
+    Часть остается невидимой при чтении, пока commit_staged не примет ее
+    вместе с манифестом. Возвращает количество записанных строк.
+    """
+    path = os.path.join(cache_dir, READINGS_DIR)
+    parts = _part_files(path)
+    schema = pq.read_schema(parts[0]).remove_metadata() if parts else None
+
+    # Номер новой части больше номеров всех существующих и подготовленных частей во всех разделах
+    names = [os.path.basename(part) for part in parts + _partition_files(path, STAGED_SUFFIX)]
+    numbers = [int(name[len('part-'):name.index('.parquet')]) for name in names]
+    name = f'part-{max(numbers, default=-1) + 1:05d}.parquet'
+    return write_part(df, path, name + STAGED_SUFFIX, schema)
+
+
+def commit_staged(manifest, cache_dir=CACHE_DIR):
+    """Делает подготовленные части видимыми и записывает манифест, который их учитывает.
+
+    Если манифест записать не удалось, принятые части удаляются и кэш остается прежним.
+    """
+    committed = []
+    try:
+        for staged in _partition_files(os.path.join(cache_dir, READINGS_DIR), STAGED_SUFFIX):
+            os.replace(staged, staged[:-len(STAGED_SUFFIX)])
+            committed.append(staged[:-len(STAGED_SUFFIX)])
+        write_manifest(manifest, cache_dir)
+    except Exception:
+        for part in committed:
+            os.remove(part)
+        discard_staged(cache_dir)
+        raise
+
+
+def discard_staged(cache_dir=CACHE_DIR):
+    """Удаляет подготовленные, но не принятые части (прерванная дозагрузка)"""
+    for staged in _partition_files(os.path.join(cache_dir, READINGS_DIR), STAGED_SUFFIX):
+        os.remove(staged)
+
+
+def save_cached(data, sources, cache_dir=CACHE_DIR, details=None):
+    """Сохраняет данные (датафрейм или итератор блоков) в кэш вместе с сигнатурами источников"""
+    if not is_available() or data is None:
+        return False
+
+    try:
+        rows = write_readings(data, cache_dir)
+        save_manifest(sources, rows, cache_dir, details)
+        return True
+    except Exception as e:
+        print(f"Ошибка записи кэша {cache_dir}: {e}")
+        return False
+
+
+def save_manifest(sources, rows, cache_dir=CACHE_DIR, details=None):
+    """Записывает манифест с сигнатурами источников, из которых построен кэш.
+
+    details - {файл: {'time_format': формат времени}}.
+    """
+    manifest = {'sources': {}, 'rows': 0}
+    update_manifest(manifest, sources, rows, details)
+    write_manifest(manifest, cache_dir)
+
+
+def record_details(details, cache_dir=CACHE_DIR):
+    """Записывает в манифест сведения о файлах показаний (формат времени)"""
+    manifest = read_manifest(cache_dir)
+    if manifest is None:
+        return
+    for name, file_details in details.items():
+        if name in manifest['sources']:
+            _apply_details(manifest['sources'][name], file_details)
+    write_manifest(manifest, cache_dir)
+
+
+def _apply_details(signature, details):
+    """Добавляет сведения о файле (формат времени) к его сигнатуре"""
+    if details.get('time_format'):
+        signature['time_format'] = details['time_format']
+
+
+def update_manifest(manifest, sources, rows, details=None):
+    """Обновляет сигнатуры и форматы времени указанных источников после дозагрузки"""
+    recorded = manifest.setdefault('sources', {})
+    for name, file_path in sources.items():
+        signature = file_signature(file_path)
+        previous = recorded.get(name, {})
+        if 'time_format' in previous:
+            signature['time_format'] = previous['time_format']
+        _apply_details(signature, (details or {}).get(name, {}))
+        recorded[name] = signature
+    manifest['rows'] = manifest.get('rows', 0) + rows
+    return manifest
+
+
+def time_formats(manifest):
+    """Форматы времени файлов показаний, сохраненные в манифесте: {файл: формат}"""
+    if manifest is None:
+        return {}
+    return {name: signature['time_format']
+            for name, signature in manifest.get('sources', {}).items() if signature.get('time_format')}
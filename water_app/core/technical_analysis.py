@@ -1,5 +1,8 @@
 import pandas as pd
 import core.anomaly_detection
+from core.data_processing import startswith_mask
+from core.report_context import create_context, get_artifact, register_artifact, run_sections
+from core.report_writer import emit, render, write
 from typing import Dict, Any, List, Optional, Union
 
 
@@ -11,8 +14,9 @@ def analyze_meter_health(df: pd.DataFrame) -> Dict[str, Any]:
         return health_stats
 
     # Разделение данных по типам счетчиков
-    digital_meters = df[~df['typeM'].str.startswith('/')]
-    integrated_meters = df[df['typeM'].str.startswith('/')]
+    integrated_mask = startswith_mask(df['typeM'], '/')
+    digital_meters = df[~integrated_mask]
+    integrated_meters = df[integrated_mask]
 
     # Анализ Digital Meters
     if not digital_meters.empty:
@@ -35,6 +39,9 @@ def analyze_meter_health(df: pd.DataFrame) -> Dict[str, Any]:
     return health_stats
 
 
+register_artifact('health', analyze_meter_health)
+
+
 def _analyze_flow(df: pd.DataFrame) -> Dict[str, Any]:
     """Анализ показаний расхода воды"""
     stats = {}
@@ -42,7 +49,7 @@ def _analyze_flow(df: pd.DataFrame) -> Dict[str, Any]:
 
     if not flow_data.empty:
         # Анализ интервальных показаний (P1)
-        p1_stats = flow_data[flow_data['Series'] == 'P1'].groupby('ManagedObjectid')['Value'].agg(
+        p1_stats = flow_data[flow_data['Series'] == 'P1'].groupby('ManagedObjectid', observed=True)['Value'].agg(
             ['sum', 'mean', 'max', 'count'])
         stats['interval'] = {
             'stats': p1_stats.describe().to_dict(),
@@ -51,7 +58,7 @@ def _analyze_flow(df: pd.DataFrame) -> Dict[str, Any]:
         }
 
         # Анализ суммарных показаний (T1)
-        t1_stats = flow_data[flow_data['Series'] == 'T1'].groupby('ManagedObjectid')['Value'].agg(
+        t1_stats = flow_data[flow_data['Series'] == 'T1'].groupby('ManagedObjectid', observed=True)['Value'].agg(
             ['min', 'max', 'last'])
         stats['total'] = {
             'stats': t1_stats.describe().to_dict(),
@@ -67,7 +74,7 @@ def _analyze_switches(df: pd.DataFrame) -> Dict[str, Any]:
     switch_data = df[df['Series'] == 'SW2']
 
     if not switch_data.empty:
-        switch_stats = switch_data.groupby('ManagedObjectid')['Value'].agg(['count', 'mean'])
+        switch_stats = switch_data.groupby('ManagedObjectid', observed=True)['Value'].agg(['count', 'mean'])
         stats['status'] = {
             'active': switch_stats[switch_stats['mean'] > 0].index.tolist(),
             'inactive': switch_stats[switch_stats['mean'] == 0].index.tolist()
@@ -82,7 +89,8 @@ def _analyze_temperature(df: pd.DataFrame) -> Dict[str, Any]:
     temp_data = df[df['Series'].isin(['T', 'Median', 'Min', 'Max'])]
 
     if not temp_data.empty:
-        temp_stats = temp_data.pivot_table(index='ManagedObjectid', columns='Series', values='Value', aggfunc='mean')
+        temp_stats = temp_data.pivot_table(index='ManagedObjectid', columns='Series', values='Value', aggfunc='mean',
+                                          observed=True)
         stats['readings'] = {
             'stats': temp_stats.describe().to_dict(),
             'high_temp': temp_stats[temp_stats['Max'] > 50].index.tolist(),
@@ -98,7 +106,7 @@ def _analyze_battery(df: pd.DataFrame) -> Dict[str, Any]:
     battery_data = df[df['Series'] == 'V']
 
     if not battery_data.empty:
-        battery_stats = battery_data.groupby('ManagedObjectid')['Value'].agg(['min', 'mean', 'max'])
+        battery_stats = battery_data.groupby('ManagedObjectid', observed=True)['Value'].agg(['min', 'mean', 'max'])
         stats['readings'] = {
             'stats': battery_stats.describe().to_dict(),
             'low_battery': battery_stats[battery_stats['min'] < 3.0].index.tolist()  # <3V
@@ -114,7 +122,7 @@ def _analyze_signal(df: pd.DataFrame) -> Dict[str, Any]:
 
     if not signal_data.empty:
         signal_stats = signal_data.pivot_table(index='ManagedObjectid', columns='Series', values='Value',
-                                               aggfunc='mean')
+                                               aggfunc='mean', observed=True)
         stats['readings'] = {
             'stats': signal_stats.describe().to_dict(),
             'poor_signal': signal_stats[signal_stats['RSRP'] < -100].index.tolist()  # Плохой сигнал
@@ -126,10 +134,10 @@ def _analyze_signal(df: pd.DataFrame) -> Dict[str, Any]:
 def _analyze_integrated_flow(df: pd.DataFrame) -> Dict[str, Any]:
     """Анализ расхода для Integrated Meters"""
     stats = {}
-    flow_data = df[df['typeM'].str.startswith('/10266')]
+    flow_data = df[startswith_mask(df['typeM'], '/10266')]
 
     if not flow_data.empty:
-        flow_stats = flow_data.groupby(['ManagedObjectid', 'Series'])['Value'].agg(['sum', 'mean', 'max'])
+        flow_stats = flow_data.groupby(['ManagedObjectid', 'Series'], observed=True)['Value'].agg(['sum', 'mean', 'max'])
         stats['readings'] = {
             'stats': flow_stats.describe().to_dict(),
             'high_flow': flow_stats[flow_stats['max'] > 100].index.tolist()  # >100 л/интервал
@@ -141,10 +149,10 @@ def _analyze_integrated_flow(df: pd.DataFrame) -> Dict[str, Any]:
 def _analyze_integrated_temp(df: pd.DataFrame) -> Dict[str, Any]:
     """Анализ температуры для Integrated Meters"""
     stats = {}
-    temp_data = df[df['typeM'].str.startswith('/10268')]
+    temp_data = df[startswith_mask(df['typeM'], '/10268')]
 
     if not temp_data.empty:
-        temp_stats = temp_data.groupby('ManagedObjectid')['Value'].agg(['min', 'mean', 'max'])
+        temp_stats = temp_data.groupby('ManagedObjectid', observed=True)['Value'].agg(['min', 'mean', 'max'])
         stats['readings'] = {
             'stats': temp_stats.describe().to_dict(),
             'high_temp': temp_stats[temp_stats['max'] > 30].index.tolist(),  # >30°C
@@ -157,10 +165,10 @@ def _analyze_integrated_temp(df: pd.DataFrame) -> Dict[str, Any]:
 def _analyze_pressure(df: pd.DataFrame) -> Dict[str, Any]:
     """Анализ давления для Integrated Meters"""
     stats = {}
-    pressure_data = df[df['typeM'].str.startswith('/10269')]
+    pressure_data = df[startswith_mask(df['typeM'], '/10269')]
 
     if not pressure_data.empty:
-        pressure_stats = pressure_data.groupby('ManagedObjectid')['Value'].agg(['min', 'mean', 'max'])
+        pressure_stats = pressure_data.groupby('ManagedObjectid', observed=True)['Value'].agg(['min', 'mean', 'max'])
         stats['readings'] = {
             'stats': pressure_stats.describe().to_dict(),
             'high_pressure': pressure_stats[pressure_stats['max'] > 10].index.tolist(),  # >10 бар
@@ -179,7 +187,7 @@ def detect_leaks(df: pd.DataFrame) -> pd.DataFrame:
                     (df['Series'] == 'P1') & (df['Value'] > 0)]
 
     if not night_flow.empty:
-        continuous_flow = night_flow.groupby('ManagedObjectid').filter(
+        continuous_flow = night_flow.groupby('ManagedObjectid', observed=True).filter(
             lambda x: x['Value'].sum() > 50)  # Более 50 литров за ночь
 
         if not continuous_flow.empty:
@@ -193,7 +201,7 @@ def detect_leaks(df: pd.DataFrame) -> pd.DataFrame:
 
     # Анализ расхождения между P1 и T1
     flow_comparison = df[df['Series'].isin(['P1', 'T1'])].pivot_table(
-        index=['ManagedObjectid', 'time'], columns='Series', values='Value')
+        index=['ManagedObjectid', 'time'], columns='Series', values='Value', observed=True)
 
     if not flow_comparison.empty:
         flow_comparison['diff'] = flow_comparison['T1'] - flow_comparison['P1']
@@ -208,22 +216,37 @@ def detect_leaks(df: pd.DataFrame) -> pd.DataFrame:
     return pd.DataFrame()
 
 
-def print_leaks(leaks: pd.DataFrame) -> str:
-    """Форматирование информации о протечках для вывода"""
-    output = ""
+def detect_flow_leaks(df: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """Обнаружение протечек по строкам расхода (P1 и T1); None, если таких строк нет"""
+    flow_data = df[df['Series'].isin(['P1', 'T1'])]
+    if flow_data.empty:
+        return None
+    return detect_leaks(flow_data)
+
+
+register_artifact('leaks', detect_flow_leaks)
+
+
+def print_leaks(leaks: pd.DataFrame, writer=None) -> str:
+    """Форматирование информации о протечках для вывода.
+
+    Если передан писатель отчета writer, строки счетчиков передаются ему по одной
+    и функция возвращает None, иначе возвращается текст.
+    """
+    if writer is None:
+        return render(lambda writer: print_leaks(leaks, writer))
 
     if 'P1' in leaks.columns:  # Для данных о расходе
-        leak_stats = leaks.groupby('ManagedObjectid')['P1'].agg(['sum', 'count'])
-        output += "Протечки по расходу воды:\n"
+        leak_stats = leaks.groupby('ManagedObjectid', observed=True)['P1'].agg(['sum', 'count'])
+        write(writer, "Протечки по расходу воды:\n")
         for meter_id, row in leak_stats.iterrows():
-            output += f"Счетчик {meter_id}: {row['sum']} литров за {row['count']} интервалов\n"
+            write(writer, f"Счетчик {meter_id}: {row['sum']} литров за {row['count']} интервалов\n")
 
     elif 'diff' in leaks.columns:  # Для расхождений между P1 и T1
-        output += "\nРасхождения в показаниях:\n"
-        for meter_id, group in leaks.groupby('ManagedObjectid'):
-            output += f"Счетчик {meter_id}: среднее расхождение {group['diff'].mean():.2f} литров\n"
-
-    return output
+        write(writer, "\nРасхождения в показаниях:\n")
+        for meter_id, group in leaks.groupby('ManagedObjectid', observed=True):
+            write(writer, f"Счетчик {meter_id}: среднее расхождение {group['diff'].mean():.2f} литров\n")
+    return None
 
 
 def generate_recommendations(health_stats: Dict[str, Any]) -> List[Dict[str, str]]:
@@ -347,127 +370,140 @@ def generate_recommendations(health_stats: Dict[str, Any]) -> List[Dict[str, str
     return recommendations
 
 
-def perform_technical_analysis(df, modes=None):
-    """Основная функция анализа данных"""
+def perform_technical_analysis(df, modes=None, context=None, writer=None):
+    """Основная функция анализа данных; context - контекст отчета с уже вычисленными артефактами.
+
+    Если передан писатель отчета writer, разделы передаются ему по мере
+    готовности и функция возвращает None, иначе возвращается текст отчета.
+    """
     if df is None or df.empty:
-        return "Нет данных для анализа\n"
+        return emit(writer, "Нет данных для анализа\n")
 
     if not modes:
-        return "Не выбраны режимы анализа\n"
+        return emit(writer, "Не выбраны режимы анализа\n")
 
-    output = ""
-    health_stats = analyze_meter_health(df)
+    context = context or create_context(df)
+
+    # Разделы выбранных режимов считаются параллельно (см. run_sections)
 
     # 1. Поиск протечек
-    if 1 in modes:
-        output += "\n=== РЕЗУЛЬТАТЫ ПОИСКА ПРОТЕЧЕК ===\n"
-        flow_data = df[df['Series'].isin(['P1', 'T1'])]
-        if not flow_data.empty:
-            leaks = detect_leaks(flow_data)
+    def section_1(out):
+        write(out, "\n=== РЕЗУЛЬТАТЫ ПОИСКА ПРОТЕЧЕК ===\n")
+        leaks = get_artifact(context, 'leaks')
+        if leaks is not None:
             if not leaks.empty:
-                output += f"Найдено {len(leaks.groupby('ManagedObjectid'))} потенциальных протечек:\n"
-                output += print_leaks(leaks)
+                write(out, f"Найдено {len(leaks.groupby('ManagedObjectid', observed=True))} потенциальных протечек:\n")
+                print_leaks(leaks, out)
             else:
-                output += "Протечки не обнаружены\n"
+                write(out, "Протечки не обнаружены\n")
         else:
-            output += "Нет данных о расходе воды для анализа протечек\n"
+            write(out, "Нет данных о расходе воды для анализа протечек\n")
 
     # 2. Анализ температуры
-    if 2 in modes:
-        output += _format_temperature_analysis(health_stats)
+    def section_2(out):
+        write(out, _format_temperature_analysis(get_artifact(context, 'health')))
 
     # 3. Анализ переключателей
-    if 3 in modes:
-        output += "\n=== АНАЛИЗ ПЕРЕКЛЮЧАТЕЛЕЙ ===\n"
+    def section_3(out):
+        health_stats = get_artifact(context, 'health')
+        write(out, "\n=== АНАЛИЗ ПЕРЕКЛЮЧАТЕЛЕЙ ===\n")
         if 'digital' in health_stats and 'switches' in health_stats['digital']:
             switches = health_stats['digital']['switches']
-            output += f"Активных переключателей: {len(switches.get('status', {}).get('active', []))}\n"
-            output += f"Неактивных переключателей: {len(switches.get('status', {}).get('inactive', []))}\n"
+            write(out, f"Активных переключателей: {len(switches.get('status', {}).get('active', []))}\n")
+            write(out, f"Неактивных переключателей: {len(switches.get('status', {}).get('inactive', []))}\n")
         else:
-            output += "Данные о переключателях отсутствуют\n"
+            write(out, "Данные о переключателях отсутствуют\n")
 
     # 4. Статистика неисправностей
-    if 4 in modes:
-        output += "\n=== СТАТИСТИКА НЕИСПРАВНОСТЕЙ ===\n"
+    def section_4(out):
+        health_stats = get_artifact(context, 'health')
+        write(out, "\n=== СТАТИСТИКА НЕИСПРАВНОСТЕЙ ===\n")
 
         # Анализ батареи
         if 'digital' in health_stats and 'battery' in health_stats['digital']:
             battery = health_stats['digital']['battery']
-            output += "\nСостояние батарей:\n"
-            output += f"Средний заряд: {battery['readings']['stats']['mean']['mean']:.2f} V\n"
-            output += f"Минимальный заряд: {battery['readings']['stats']['min']['min']:.2f} V\n"
+            write(out, "\nСостояние батарей:\n")
+            write(out, f"Средний заряд: {battery['readings']['stats']['mean']['mean']:.2f} V\n")
+            write(out, f"Минимальный заряд: {battery['readings']['stats']['min']['min']:.2f} V\n")
             if battery['readings'].get('low_battery'):
-                output += f"Счетчиков с низким зарядом (<3V): {len(battery['readings']['low_battery'])}\n"
-                output += "ID проблемных счетчиков: " + ", ".join(map(str, battery['readings']['low_battery'])) + "\n"
+                write(out, f"Счетчиков с низким зарядом (<3V): {len(battery['readings']['low_battery'])}\n")
+                write(out, "ID проблемных счетчиков: " + ", ".join(map(str, battery['readings']['low_battery'])) + "\n")
             else:
-                output += "Проблем с батареями не обнаружено\n"
+                write(out, "Проблем с батареями не обнаружено\n")
         else:
-            output += "\nДанные о батареях отсутствуют\n"
+            write(out, "\nДанные о батареях отсутствуют\n")
 
         # Анализ сигнала
         if 'digital' in health_stats and 'signal' in health_stats['digital']:
             signal = health_stats['digital']['signal']
-            output += "\nКачество сигнала:\n"
-            output += f"Средний уровень сигнала (RSRP): {signal['readings']['stats']['mean']['RSRP']:.2f} dB\n"
+            write(out, "\nКачество сигнала:\n")
+            write(out, f"Средний уровень сигнала (RSRP): {signal['readings']['stats']['mean']['RSRP']:.2f} dB\n")
             if signal['readings'].get('poor_signal'):
-                output += f"Счетчиков с плохим сигналом (<-100 dB): {len(signal['readings']['poor_signal'])}\n"
-                output += "ID проблемных счетчиков: " + ", ".join(map(str, signal['readings']['poor_signal'])) + "\n"
+                write(out, f"Счетчиков с плохим сигналом (<-100 dB): {len(signal['readings']['poor_signal'])}\n")
+                write(out, "ID проблемных счетчиков: " + ", ".join(map(str, signal['readings']['poor_signal'])) + "\n")
             else:
-                output += "Проблем с сигналом не обнаружено\n"
+                write(out, "Проблем с сигналом не обнаружено\n")
         else:
-            output += "\nДанные о сигнале отсутствуют\n"
+            write(out, "\nДанные о сигнале отсутствуют\n")
 
         # Анализ передачи данных
         log_data = df[df['Series'].isin(['Stored', 'Sent'])]
         if not log_data.empty:
-            log_stats = log_data.pivot_table(index='ManagedObjectid', columns='Series', values='Value', aggfunc='max')
+            log_stats = log_data.pivot_table(index='ManagedObjectid', columns='Series', values='Value', aggfunc='max',
+                                             observed=True)
             transmission_issues = log_stats[log_stats['Stored'] - log_stats['Sent'] > 10]
 
-            output += "\nПередача данных:\n"
-            output += f"Всего счетчиков с данными: {len(log_stats)}\n"
-            output += f"Счетчиков с проблемами передачи: {len(transmission_issues)}\n"
+            write(out, "\nПередача данных:\n")
+            write(out, f"Всего счетчиков с данными: {len(log_stats)}\n")
+            write(out, f"Счетчиков с проблемами передачи: {len(transmission_issues)}\n")
             if not transmission_issues.empty:
-                output += "ID проблемных счетчиков: " + ", ".join(map(str, transmission_issues.index)) + "\n"
+                write(out, "ID проблемных счетчиков: " + ", ".join(map(str, transmission_issues.index)) + "\n")
         else:
-            output += "\nДанные о передаче данных отсутствуют\n"
+            write(out, "\nДанные о передаче данных отсутствуют\n")
 
     # 5. Рекомендации по замене
-    if 5 in modes:
+    def section_5(out):
+        health_stats = get_artifact(context, 'health')
         recommendations = generate_recommendations(health_stats)
-        output += "\n=== РЕКОМЕНДАЦИИ ПО ОБСЛУЖИВАНИЮ ===\n"
+        write(out, "\n=== РЕКОМЕНДАЦИИ ПО ОБСЛУЖИВАНИЮ ===\n")
         if recommendations:
             for rec in recommendations:
-                output += f"[{rec['type']}] Счетчик {rec['meter_id']}: {rec['issue']}\n"
-                output += f"Рекомендация: {rec['recommendation']}\n\n"
+                write(out, f"[{rec['type']}] Счетчик {rec['meter_id']}: {rec['issue']}\n")
+                write(out, f"Рекомендация: {rec['recommendation']}\n\n")
         else:
-            output += "Критических проблем не обнаружено\n"
+            write(out, "Критических проблем не обнаружено\n")
+
+    sections = {1: section_1, 2: section_2, 3: section_3, 4: section_4, 5: section_5}
+    if writer is not None:
+        return run_sections(sections, modes, writer=writer)
 
+    output = run_sections(sections, modes)
     print(output)
     return output
 
 
 def _format_temperature_analysis(health_stats: Dict[str, Any]) -> str:
     """Форматирование анализа температуры"""
-    output = "\n=== АНАЛИЗ ТЕМПЕРАТУРЫ ===\n"
+    output = ["\n=== АНАЛИЗ ТЕМПЕРАТУРЫ ===\n"]
     has_data = False
 
     # Digital Meters
     if 'digital' in health_stats and 'temperature' in health_stats['digital']:
         temp_stats = health_stats['digital']['temperature'].get('readings', {})
         if temp_stats:
-            output += "\nDigital Meters:\n"
+            output.append("\nDigital Meters:\n")
             stats = temp_stats.get('stats', {})
-            output += f"Средняя температура: {stats.get('mean', {}).get('Mean', 'N/A')} °C\n"
-            output += f"Минимальная температура: {stats.get('min', {}).get('Min', 'N/A')} °C\n"
-            output += f"Максимальная температура: {stats.get('max', {}).get('Max', 'N/A')} °C\n"
+            output.append(f"Средняя температура: {stats.get('mean', {}).get('Mean', 'N/A')} °C\n")
+            output.append(f"Минимальная температура: {stats.get('min', {}).get('Min', 'N/A')} °C\n")
+            output.append(f"Максимальная температура: {stats.get('max', {}).get('Max', 'N/A')} °C\n")
 
             if temp_stats.get('high_temp'):
-                output += f"\nСчетчики с высокой температурой (>50°C):\n"
-                output += ", ".join(str(x) for x in temp_stats['high_temp']) + "\n"
+                output.append(f"\nСчетчики с высокой температурой (>50°C):\n")
+                output.append(", ".join(str(x) for x in temp_stats['high_temp']) + "\n")
 
             if temp_stats.get('low_temp'):
-                output += f"\nСчетчики с низкой температурой (<-10°C):\n"
-                output += ", ".join(str(x) for x in temp_stats['low_temp']) + "\n"
+                output.append(f"\nСчетчики с низкой температурой (<-10°C):\n")
+                output.append(", ".join(str(x) for x in temp_stats['low_temp']) + "\n")
 
             has_data = True
 
@@ -475,26 +511,26 @@ def _format_temperature_analysis(health_stats: Dict[str, Any]) -> str:
     if 'integrated' in health_stats and 'temperature' in health_stats['integrated']:
         temp_stats = health_stats['integrated']['temperature'].get('readings', {})
         if temp_stats:
-            output += "\nIntegrated Meters:\n"
+            output.append("\nIntegrated Meters:\n")
             stats = temp_stats.get('stats', {})
-            output += f"Средняя температура: {stats.get('mean', {}).get('mean', 'N/A')} °C\n"
-            output += f"Минимальная температура: {stats.get('min', {}).get('min', 'N/A')} °C\n"
-            output += f"Максимальная температура: {stats.get('max', {}).get('max', 'N/A')} °C\n"
+            output.append(f"Средняя температура: {stats.get('mean', {}).get('mean', 'N/A')} °C\n")
+            output.append(f"Минимальная температура: {stats.get('min', {}).get('min', 'N/A')} °C\n")
+            output.append(f"Максимальная температура: {stats.get('max', {}).get('max', 'N/A')} °C\n")
 
             if temp_stats.get('high_temp'):
-                output += f"\nСчетчики с высокой температурой (>30°C):\n"
-                output += ", ".join(str(x) for x in temp_stats['high_temp']) + "\n"
+                output.append(f"\nСчетчики с высокой температурой (>30°C):\n")
+                output.append(", ".join(str(x) for x in temp_stats['high_temp']) + "\n")
 
             if temp_stats.get('low_temp'):
-                output += f"\nСчетчики с низкой температурой (<5°C):\n"
-                output += ", ".join(str(x) for x in temp_stats['low_temp']) + "\n"
+                output.append(f"\nСчетчики с низкой температурой (<5°C):\n")
+                output.append(", ".join(str(x) for x in temp_stats['low_temp']) + "\n")
 
             has_data = True
 
     if not has_data:
-        output += "Данные о температуре отсутствуют\n"
+        output.append("Данные о температуре отсутствуют\n")
 
-    return output
+    return "".join(output)
 
 
 def print_health_stats(health_stats: Dict[str, Any]) -> None:
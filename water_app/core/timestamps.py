@@ -0,0 +1,95 @@
+import pandas as pd
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:  # В старых версиях pandas формат определяется при каждом разборе
+    guess_datetime_format = None
+
+
+# Сколько строк проверяется при определении формата времени
+FORMAT_SAMPLE_ROWS = 1000
+
+
+def infer_time_format(values):
+    """Определяет формат строк времени по первому значению и проверяет его на образце.
+
+    Возвращает строку формата strftime или None, если формат определить не удалось.
+    """
+    if guess_datetime_format is None:
+        return None
+
+    sample = pd.Series(values[:FORMAT_SAMPLE_ROWS]).dropna().astype(str)
+    if sample.empty:
+        return None
+
+    time_format = guess_datetime_format(sample.iloc[0])
+    if time_format is None:
+        return None
+
+    try:
+        pd.to_datetime(sample, format=time_format, utc=True)
+    except (ValueError, TypeError):
+        return None
+    return time_format
+
+
+def parse_time(values, time_format=None):
+    """Разбирает колонку времени в datetime64[ns, UTC] один раз для всего набора.
+
+    time_format - известный формат (например, сохраненный в манифесте кэша);
+    если он не задан, определяется по образцу. Значения, не подходящие под
+    формат, разбираются повторно без формата. Возвращает (время, формат).
+    """
+    values = pd.Series(values)
+    if isinstance(values.dtype, pd.DatetimeTZDtype) or pd.api.types.is_datetime64_dtype(values):
+        return pd.to_datetime(values, utc=True), time_format
+
+    time_format = time_format or infer_time_format(values)
+    if time_format is None:
+        return pd.to_datetime(values, errors='coerce', utc=True), None
+
+    times = pd.to_datetime(values, format=time_format, errors='coerce', utc=True)
+    failed = times.isna() & values.notna()
+    if failed.any():
+        times[failed] = pd.to_datetime(values[failed], errors='coerce', utc=True)
+    return times, time_format
+
+
+def normalize_time(df, time_format=None):
+    """Приводит колонку time загруженных данных к UTC (на месте); возвращает использованный формат"""
+    if df is None or 'time' not in df.columns:
+        return time_format
+
+    df['time'], time_format = parse_time(df['time'], time_format)
+    return time_format
+
+
+def is_utc(times):
+    """Проверяет, что колонка времени уже нормализована (datetime64 с зоной UTC)"""
+    return isinstance(times.dtype, pd.DatetimeTZDtype) and str(times.dtype.tz) == 'UTC'
+
+
+def utc_time(times):
+    """Колонка времени в UTC; нормализованная колонка возвращается как есть"""
+    return times if is_utc(times) else parse_time(times)[0]
+
+
+def ensure_time(df):
+    """Возвращает df с временем в UTC; уже нормализованные данные возвращаются без копирования"""
+    if df is None or 'time' not in df.columns or is_utc(df['time']):
+        return df
+    return df.assign(time=parse_time(df['time'])[0])
+
+
+def time_epoch(df):
+    """Время строк как int64 (нс от начала эпохи, UTC) без копирования; NaT - минимальное int64"""
+    return ensure_time(df)['time'].to_numpy(dtype='datetime64[ns]').view('i8')
+
+
+def valid_time(df):
+    """Строки df с корректным временем (без копирования, если пропусков нет)"""
+    df = ensure_time(df)
+    if df is None or 'time' not in df.columns:
+        return df
+    missing = df['time'].isna().to_numpy()
+    return df[~missing] if missing.any() else df
@@ -0,0 +1,126 @@
+import time
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Сколько окон сортируется за один шаг (матрица окон CHUNK_ROWS x window)
+CHUNK_ROWS = 4096
+
+
+def rolling_order_stats(values, positions, window, stats, chunk_rows=CHUNK_ROWS):
+    """Скользящие порядковые статистики по окнам из window последних показаний ряда.
+
+    values - ряды нескольких счетчиков подряд, positions - номер строки в ряду
+    ее счетчика (0 - начало ряда; окно не заходит в предыдущий ряд). stats - список
+    (статистика, min_periods), где статистика - 'median' или квантиль от 0 до 1.
+    Окна сортируются пакетами по chunk_rows строк, и все статистики берутся из
+    одной сортировки. Пропуски (NaN) в окне не учитываются; если показаний
+    меньше min_periods, результат - NaN. Значения совпадают с
+    rolling(window, min_periods).median() / .quantile(q) pandas для каждого ряда.
+    """
+    values = np.asarray(values, dtype='float64')
+    results = [np.full(len(values), np.nan) for _ in stats]
+    if not len(values):
+        return results
+
+    # Перед каждым рядом - window - 1 пропусков: окно не заходит в предыдущий ряд
+    series = np.cumsum(np.asarray(positions) == 0) - 1
+    padded_rows = np.arange(len(values)) + series * (window - 1)
+    padded = np.full(len(values) + (series[-1] + 1) * (window - 1), np.nan)
+    padded[padded_rows + window - 1] = values
+    windows = sliding_window_view(padded, window)
+    present = np.r_[0, np.cumsum(~np.isnan(padded))]
+    observations = present[padded_rows + window] - present[padded_rows]
+
+    for begin in range(0, len(values), chunk_rows):
+        end = min(begin + chunk_rows, len(values))
+        matrix = windows[padded_rows[begin:end]]
+        matrix.sort(axis=1)
+        chunk_observations = observations[begin:end]
+        for result, (statistic, min_periods) in zip(results, stats):
+            block = _order_statistic(matrix, chunk_observations, statistic)
+            result[begin:end] = np.where(chunk_observations >= max(min_periods or window, 1), block, np.nan)
+    return results
+
+
+def _order_statistic(matrix, observations, statistic):
+    """Статистика каждой строки отсортированной матрицы окон теми же операциями, что и в pandas"""
+    rows = np.arange(len(matrix))
+    if statistic == 'median':
+        middle = observations // 2
+        upper = matrix[rows, np.minimum(middle, matrix.shape[1] - 1)]
+        lower = matrix[rows, np.maximum(middle - 1, 0)]
+        return np.where(observations % 2 == 1, upper, (upper + lower) / 2)
+
+    position = statistic * (observations - 1)
+    index = np.maximum(position.astype(np.int64), 0)
+    low = matrix[rows, np.minimum(index, matrix.shape[1] - 1)]
+    high = matrix[rows, np.minimum(index + 1, matrix.shape[1] - 1)]
+    return np.where(position == index, low, low + (high - low) * (position - index))
+
+
+def benchmark(meters=2000, readings=400, window=144, repeat=3, seed=0):
+    """Сравнивает ядра с путями pandas на синтетическом парке счетчиков: время и совпадение результатов.
+
+    Считается набор статистик правила модифицированной Z-оценки: медиана и
+    квантиль 0.995 по окну window, медиана отклонений (MAD) и медиана по 24
+    показаниям. Возвращает словарь с лучшим из repeat временем каждого пути (с).
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.gamma(2, 3, meters * readings)
+    values[rng.random(len(values)) < 0.002] *= 400
+    group = np.repeat(np.arange(meters), readings)
+    positions = np.tile(np.arange(readings), meters)
+
+    def kernels():
+        median, upper = rolling_order_stats(values, positions, window, [('median', 24), (0.995, window)])
+        mad, = rolling_order_stats(np.abs(values - median), positions, window, [('median', 24)])
+        prev_median, = rolling_order_stats(values, positions, 24, [('median', 24)])
+        return median, upper, mad, prev_median
+
+    def grouped():
+        series = pd.Series(values).groupby(group, sort=False)
+        median = series.rolling(window, min_periods=24).median().to_numpy()
+        upper = series.rolling(window).quantile(0.995).to_numpy()
+        mad = pd.Series(np.abs(values - median)).groupby(group, sort=False).rolling(
+            window, min_periods=24).median().to_numpy()
+        prev_median = series.rolling(24).median().to_numpy()
+        return median, upper, mad, prev_median
+
+    def per_meter():
+        results = [[], [], [], []]
+        for meter in range(meters):
+            series = pd.Series(values[meter * readings:(meter + 1) * readings])
+            median = series.rolling(window, min_periods=24).median()
+            results[0].append(median.to_numpy())
+            results[1].append(series.rolling(window).quantile(0.995).to_numpy())
+            results[2].append((series - median).abs().rolling(window, min_periods=24).median().to_numpy())
+            results[3].append(series.rolling(24).median().to_numpy())
+        return [np.concatenate(result) for result in results]
+
+    timings = {}
+    outputs = {}
+    for name, path in [('kernels', kernels), ('pandas_grouped', grouped), ('pandas_per_meter', per_meter)]:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs[name] = path()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+
+    timings['identical'] = all(
+        np.array_equal(kernel, reference, equal_nan=True)
+        for other in ['pandas_grouped', 'pandas_per_meter']
+        for kernel, reference in zip(outputs['kernels'], outputs[other])
+    )
+    return timings
+
+
+if __name__ == '__main__':
+    for meters, readings in [(2000, 400), (60, 4800)]:
+        result = benchmark(meters, readings)
+        print(f"{meters} счетчиков x {readings} показаний: " +
+              ", ".join(f"{name}: {value:.3f} с" if isinstance(value, float) else f"{name}: {value}"
+                        for name, value in result.items()))
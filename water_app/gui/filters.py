@@ -3,6 +3,11 @@ from tkinter import ttk
 
 from tkinter import Listbox, MULTIPLE, END  # Добавлен импорт
 
+from core.data_processing import filter_counts
+
+import gui
+import gui.run_button
+
 
 
 def create_filters_frame(parent, title, filter_options):
@@ -48,6 +53,10 @@ def create_filters_frame(parent, title, filter_options):
 
         filter_widgets[key] = listbox
 
+    counts_label = ttk.Label(frame, text="")
+    counts_label.grid(row=len(filters) + 1, column=0, columnspan=4, padx=5, pady=5, sticky="w")
+    bind_filter_counts(counts_label, filter_widgets)
+
     return filter_widgets
 
 
@@ -102,6 +111,25 @@ def create_comparison_filters(parent, filter_options):
 
             filter_widgets[key] = listbox
 
+        counts_label = ttk.Label(subframe, text="")
+        counts_label.pack(anchor="w")
+        bind_filter_counts(counts_label, filter_widgets)
+
         comparison_filters.append(filter_widgets)
 
     return comparison_filters
+
+
+def bind_filter_counts(label, filter_widgets):
+    """Показывает количество строк и счетчиков, подходящих под фильтры, и обновляет его при изменении выбора"""
+    def update(event=None):
+        # В ленивом режиме показания еще не загружены
+        if gui.df is None:
+            label.config(text="")
+            return
+        counts = filter_counts(gui.df, gui.run_button.get_selected_values(filter_widgets))
+        label.config(text=f"Найдено строк: {counts['rows']}, счетчиков: {counts['meters']}")
+
+    for widget in filter_widgets.values():
+        widget.bind('<<ListboxSelect>>' if isinstance(widget, Listbox) else '<FocusOut>', update)
+    update()
@@ -10,14 +10,15 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import matplotlib.pyplot as plt
 from visualization import plots
 import core.technical_analysis
+from core.report_context import create_context, get_artifact
 import gui
 import gui.utils
 import gui.run_button
 import gui.filters
 
 
-def update_graphs(filtered_data, selected_graphs, tab_name, save_format="PNG"):
-    """Обновление графиков с исправлением ошибок"""
+def update_graphs(filtered_data, selected_graphs, tab_name, save_format="PNG", context=None):
+    """Обновление графиков с исправлением ошибок; context - контекст отчета с уже вычисленными артефактами"""
 
     # Очистка предыдущих графиков
     for widget in gui.graph_container.winfo_children():
@@ -57,12 +58,15 @@ def update_graphs(filtered_data, selected_graphs, tab_name, save_format="PNG"):
     GRAPH_WIDTH = 800
     GRAPH_HEIGHT = 400
 
-    # Для технического анализа получаем данные заранее
+    # Для технического анализа берем данные из контекста отчета
+    context = context or create_context(filtered_data)
     health_stats = {}
     leaks = pd.DataFrame()
     if tab_name == "Технический анализ":
-        health_stats = core.technical_analysis.analyze_meter_health(filtered_data)
-        leaks = core.technical_analysis.detect_leaks(filtered_data)
+        health_stats = get_artifact(context, 'health')
+        leaks = get_artifact(context, 'leaks')
+        if leaks is None:
+            leaks = pd.DataFrame()
 
     for graph_id in selected_graphs:
         frame = ttk.Frame(scroll_frame,
@@ -86,9 +90,9 @@ def update_graphs(filtered_data, selected_graphs, tab_name, save_format="PNG"):
                 elif graph_id == 3:
                     fig = visualization.plots.plot_НЕт_ЕЩЕ_ТАКОГО(filtered_data, save=False)
                 elif graph_id == 4:
-                    fig = visualization.plots.plot_predictions(filtered_data, save=False)
+                    fig = visualization.plots.plot_predictions(filtered_data, get_artifact(context, 'predictions'), save=False)
                 elif graph_id == 5:
-                    fig = visualization.plots.plot_anomalies(filtered_data, save=False)
+                    fig = visualization.plots.plot_anomalies(filtered_data, get_artifact(context, 'anomalies'), save=False)
 
             elif tab_name == "Сравнение":
                 if graph_id == 1:
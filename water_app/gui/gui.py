@@ -3,7 +3,7 @@ from tkinter import ttk, scrolledtext
 
 import threading
 
-from core.data_processing import initialization_data, filter_data
+from core.data_processing import initialization_data, initialization_options, filter_data
 
 import gui
 import gui.utils
@@ -77,20 +77,25 @@ def create_main_interface(filter_options, filters):
 
     tab_control.pack(fill="x", padx=10, pady=5)
 
-def load_data():
-    """Загрузка данных"""
+def load_data(meter_source=None, lazy=False):
+    """Загрузка данных (в ленивом режиме - только метаданных для фильтров)"""
     gui.utils.show_loading_screen()
-    gui.df, filter_options, filters = initialization_data()
+    if lazy:
+        # Показания загружаются при построении отчета, кэш готовится в фоне
+        gui.df = None
+        filter_options, filters = initialization_options(meter_source)
+    else:
+        gui.df, filter_options, filters = initialization_data(meter_source)
     gui.utils.hide_loading_screen()
     create_main_interface(filter_options, filters)
 
 
-def grafic():
+def grafic(meter_source=None, lazy=False):
     gui.root = tk.Tk()
     gui.root.title("Анализ данных счетчиков")
     gui.root.geometry("1200x800")
 
     # Запуск загрузки данных в отдельном потоке
-    threading.Thread(target=load_data, daemon=True).start()
+    threading.Thread(target=load_data, args=(meter_source, lazy), daemon=True).start()
 
     gui.root.mainloop()
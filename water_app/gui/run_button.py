@@ -4,7 +4,10 @@ from tkinter import ttk, scrolledtext
 
 
 import visualization.pdf_report
-from core.data_processing import filter_data
+from core.data_processing import filter_data, load_readings
+from core.filter_cache import get_filtered
+from core.report_context import context_for
+from core.report_writer import create_writer, flush
 from core.analysis import perform_analysis
 from core.technical_analysis import perform_technical_analysis
 import core.comparison
@@ -16,47 +19,62 @@ import gui.graps
 
 def run_analysis(tab_name, filtered_data, selected_modes=None, selected_graphs=None, save_format=None, filtered_data2=None):  # Добавляем параметр filtered_data
     """Функция для выполнения анализа с учётом отфильтрованных данных"""
+    # Текст, графики и PDF по тем же выборкам используют общий контекст: каждый артефакт считается один раз
+    context = context_for(filtered_data, filtered_data2)
 
     print(f"Режимы для анализа: {selected_modes}")  # Проверка
     print(f"Выбранные графики: {selected_graphs}")  # Логируем выбор графиков
 
-    # Вывод результатов
+    # Вывод результатов: разделы отчета появляются в окне по мере готовности
     gui.result_text.config(state='normal')
     gui.result_text.insert(tk.END, f"\n=== Результаты анализа ({tab_name}) ===\n")
+    writer = create_writer(gui.utils.text_sink(gui.result_text))
 
     if tab_name == "Сравнение":
-        stats = core.comparison.perform_comparison(filtered_data, selected_modes, df2=filtered_data2)
-        gui.result_text.insert(tk.END, stats)
+        core.comparison.perform_comparison(filtered_data, selected_modes, df2=filtered_data2, writer=writer)
 
     elif tab_name == "Анализ данных":
-        stats = perform_analysis(filtered_data, selected_modes)
-        gui.result_text.insert(tk.END, stats)
+        perform_analysis(filtered_data, selected_modes, context, writer)
     else:
-        stats = perform_technical_analysis(filtered_data, selected_modes)
-        gui.result_text.insert(tk.END, stats)
+        perform_technical_analysis(filtered_data, selected_modes, context, writer)
 
+    flush(writer)
     gui.result_text.config(state='disabled')
 
-    gui.graps.update_graphs(filtered_data, selected_graphs, tab_name, save_format)
+    gui.graps.update_graphs(filtered_data, selected_graphs, tab_name, save_format, context)
+
+
+def get_report_data(filters=None):
+    """Данные для отчета: загруженный датафрейм или (в ленивом режиме) показания за период фильтров"""
+    if gui.df is not None:
+        return gui.df
+    return load_readings(filters)
+
+
+def select_data(widgets):
+    """Применяет фильтры из виджетов к данным отчета; повторный выбор тех же фильтров берется из кэша"""
+    values = get_selected_values(widgets)
+    return get_filtered(values, lambda: filter_data(get_report_data(values), values), source=gui.df)
+
+
+def get_selected_values(widgets):
+    """Получает выбранные значения из виджетов"""
+    values = {
+        'start_date': widgets['date_from'].get(),
+        'end_date': widgets['date_to'].get(),
+        'cities': [widgets['city'].get(i) for i in widgets['city'].curselection()],
+        'usage_types': [widgets['usage_type'].get(i) for i in widgets['usage_type'].curselection()],
+        'meter_ids': [widgets['meter_id'].get(i) for i in widgets['meter_id'].curselection()],
+        'meter_types': [widgets['meter_type'].get(i) for i in widgets['meter_type'].curselection()]
+    }
+    print(values)
+    return values
 
 
 def create_action_buttons(parent, tab_name, filters, filter_widgets=None, comparison_filters=None):
     frame = ttk.Frame(parent)
     frame.pack(padx=10, pady=10, fill="x")
 
-    def get_selected_values(widgets):
-        """Получает выбранные значения из виджетов"""
-        values = {
-            'start_date': widgets['date_from'].get(),
-            'end_date': widgets['date_to'].get(),
-            'cities': [widgets['city'].get(i) for i in widgets['city'].curselection()],
-            'usage_types': [widgets['usage_type'].get(i) for i in widgets['usage_type'].curselection()],
-            'meter_ids': [widgets['meter_id'].get(i) for i in widgets['meter_id'].curselection()],
-            'meter_types': [widgets['meter_type'].get(i) for i in widgets['meter_type'].curselection()]
-        }
-        print(values)
-        return values
-
     def generate_report():
         selected_modes = []
         selected_graphs = []
@@ -77,19 +95,19 @@ def create_action_buttons(parent, tab_name, filters, filter_widgets=None, compar
         print(f"Формат сохранения: {save_format}")
 
         if filter_widgets:
-            filtered_data = filter_data(gui.df, get_selected_values(filter_widgets))
+            filtered_data = select_data(filter_widgets)
             run_analysis(tab_name, filtered_data, selected_modes, selected_graphs, save_format)
         elif comparison_filters:
             print(comparison_filters)
-            filtered_data2 = filter_data(gui.df, get_selected_values(comparison_filters[1]))
-            filtered_data = filter_data(gui.df, get_selected_values(comparison_filters[0]))
+            filtered_data2 = select_data(comparison_filters[1])
+            filtered_data = select_data(comparison_filters[0])
             run_analysis(tab_name, filtered_data, selected_modes, selected_graphs, save_format, filtered_data2)
         elif tab_name == "Сравнение данных":
-            filtered_data2 = gui.df
-            filtered_data = gui.df
+            filtered_data2 = get_report_data()
+            filtered_data = get_report_data()
             run_analysis(tab_name, filtered_data, selected_modes, selected_graphs, save_format, filtered_data2)
         else:
-            filtered_data = gui.df
+            filtered_data = get_report_data()
             run_analysis(tab_name, filtered_data, selected_modes, selected_graphs, save_format)
 
 
@@ -109,20 +127,24 @@ def create_action_buttons(parent, tab_name, filters, filter_widgets=None, compar
         print(f"Выбранные графики: {selected_graphs}")
 
         if filter_widgets:
-            filtered_data = filter_data(gui.df, get_selected_values(filter_widgets))
-            visualization.pdf_report.perform_analysis_with_pdf(filtered_data,"report.pdf", selected_modes, selected_graphs, tab_name)
+            filtered_data = select_data(filter_widgets)
+            visualization.pdf_report.perform_analysis_with_pdf(filtered_data,"report.pdf", selected_modes, selected_graphs, tab_name,
+                                                               context=context_for(filtered_data))
         elif comparison_filters:
             print(comparison_filters)
-            filtered_data2 = filter_data(gui.df, get_selected_values(comparison_filters[1]))
-            filtered_data = filter_data(gui.df, get_selected_values(comparison_filters[0]))
-            visualization.pdf_report.perform_analysis_with_pdf(filtered_data,"report.pdf", selected_modes, selected_graphs, tab_name, filtered_data2)
+            filtered_data2 = select_data(comparison_filters[1])
+            filtered_data = select_data(comparison_filters[0])
+            visualization.pdf_report.perform_analysis_with_pdf(filtered_data,"report.pdf", selected_modes, selected_graphs, tab_name, filtered_data2,
+                                                               context_for(filtered_data, filtered_data2))
         elif tab_name == "Сравнение данных":
-            filtered_data2 = gui.df
-            filtered_data = gui.df
-            visualization.pdf_report.perform_analysis_with_pdf(filtered_data,"report.pdf", selected_modes, selected_graphs, tab_name, filtered_data2)
+            filtered_data2 = get_report_data()
+            filtered_data = get_report_data()
+            visualization.pdf_report.perform_analysis_with_pdf(filtered_data,"report.pdf", selected_modes, selected_graphs, tab_name, filtered_data2,
+                                                               context_for(filtered_data, filtered_data2))
         else:
-            filtered_data = gui.df
-            visualization.pdf_report.perform_analysis_with_pdf(filtered_data,"report.pdf", selected_modes, selected_graphs, tab_name)
+            filtered_data = get_report_data()
+            visualization.pdf_report.perform_analysis_with_pdf(filtered_data,"report.pdf", selected_modes, selected_graphs, tab_name,
+                                                               context=context_for(filtered_data))
 
 
     ttk.Button(
@@ -1,3 +1,4 @@
+import tkinter as tk
 from tkinter import ttk
 import gui
 
@@ -14,4 +15,12 @@ def show_loading_screen():
 
 
 def hide_loading_screen():
-    gui.loading_frame.pack_forget()
\ No newline at end of file
+    gui.loading_frame.pack_forget()
+
+
+def text_sink(widget):
+    """Приемник отчета: дописывает блок текста в виджет и сразу перерисовывает его"""
+    def sink(text):
+        widget.insert(tk.END, text)
+        widget.update_idletasks()
+    return sink
@@ -1,10 +1,31 @@
 from gui.gui import grafic
+from core import sketches
+from core import anomaly_detection
+import sys
 import warnings
 
 warnings.filterwarnings('ignore')
 
 def main():
-    grafic()
+    # Необязательный аргумент: файл, каталог или glob-шаблон с выгрузками показаний
+    # --lazy: интерфейс открывается сразу, показания загружаются при построении отчета
+    # --approx-quantiles[=ошибка]: медиана и перцентили по скетчам сводных таблиц (ошибка по умолчанию 0.01)
+    # --anomaly-workers[=N]: поиск аномалий в N процессах (по умолчанию по числу ядер)
+    lazy = '--lazy' in sys.argv[1:]
+    for arg in sys.argv[1:]:
+        name, _, error = arg.partition('=')
+        if name == '--approx-quantiles':
+            try:
+                sketches.set_quantile_mode(True, float(error) if error else None)
+            except ValueError:
+                print(f"Некорректная ошибка квантилей: {error}")
+        elif name == '--anomaly-workers':
+            try:
+                anomaly_detection.set_anomaly_workers(int(error) if error else None)
+            except ValueError:
+                print(f"Некорректное число процессов: {error}")
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    grafic(args[0] if args else None, lazy)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -7,11 +7,15 @@ from reportlab.lib.units import inch
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase import pdfmetrics
 import tempfile
+from xml.sax.saxutils import escape
 import os
 import matplotlib.pyplot as plt
 import core
 import visualization.plots
 from core import anomaly_detection, technical_analysis, analysis
+from core.report_context import create_context, get_artifact
+from core.report_writer import create_writer, flush
+import core.comparison
 
 pdfmetrics.registerFont(TTFont('DejaVu', 'visualization/DejaVuSans.ttf'))
 
@@ -39,6 +43,12 @@ style_body = ParagraphStyle(
     fontSize=10,
     spaceAfter=12
 )
+style_report_line = ParagraphStyle(
+    'ReportLine',
+    parent=style_body,
+    fontSize=9,
+    spaceAfter=2
+)
 
 def generate_pdf_report(report_data, filename="water_consumption_report.pdf"):
     """Генерация PDF отчета с данными анализа"""
@@ -80,6 +90,17 @@ def generate_pdf_report(report_data, filename="water_consumption_report.pdf"):
     elements.append(stats_table)
     elements.append(Spacer(1, 24))
 
+    # Текст отчета по выбранным режимам
+    if report_data.get('report_text'):
+        elements.append(Paragraph("Результаты анализа", style_heading))
+        for line in "".join(report_data['report_text']).splitlines():
+            if line.startswith("==="):
+                elements.append(Paragraph(escape(line.strip("= ")), style_heading))
+            elif line.strip():
+                indent = len(line) - len(line.lstrip())
+                elements.append(Paragraph("&nbsp;" * indent + escape(line.strip()), style_report_line))
+        elements.append(Spacer(1, 24))
+
     temp_files = []
     print("444444")
 
@@ -174,19 +195,26 @@ def generate_pdf_report(report_data, filename="water_consumption_report.pdf"):
             print(f"Не удалось удалить {filepath}: {e}")
 
 
-def perform_analysis_with_pdf(df, filename="report.pdf", modes=None, visualizations=None, tab=None, df2=None):
-    """Выполняет анализ и генерирует PDF отчет"""
+def perform_analysis_with_pdf(df, filename="report.pdf", modes=None, visualizations=None, tab=None, df2=None, context=None):
+    """Выполняет анализ и генерирует PDF отчет; context - контекст отчета с уже вычисленными артефактами"""
     if df is None or df.empty:
         print("Нет данных для анализа")
         return
-    if tab == "Анализ данных":
-        if modes:
-            if 1 in modes:
-                #здесь код чтобы при выбранном режиме 1 то что выводится на экран в графическом интерфейсе записывалось в пдф красиво
-                print("режим 1")
-            if 2 in modes:
-                print("режим 2")
+    context = context or create_context(df, df2)
+
+    # Текст выбранных режимов (тот же, что выводится в окне) попадает в PDF блоками через писатель отчета
+    report_text = []
+    writer = create_writer(report_text.append)
+    if modes:
+        if tab == "Анализ данных":
+            core.analysis.perform_analysis(df, modes, context, writer)
+        elif tab == "Сравнение":
+            core.comparison.perform_comparison(df, modes, df2, writer=writer)
+        elif tab == "Технический анализ":
+            technical_analysis.perform_technical_analysis(df, modes, context, writer)
+    flush(writer)
 
+    if tab == "Анализ данных":
         if visualizations:
             if 1 in visualizations:
                 #Здесь код чтобы график созданный ранее (ну или создавался заного) и тоже отправлялся в пдфку
@@ -201,13 +229,6 @@ def perform_analysis_with_pdf(df, filename="report.pdf", modes=None, visualizati
 
 
     if tab == "Сравнение":
-        if modes:
-            if 1 in modes:
-                #здесь код чтобы при выбранном режиме 1 то что выводится на экран в графическом интерфейсе записывалось в пдф красиво
-                print("режим 1")
-            if 2 in modes:
-                print("режим 2")
-
         if visualizations:
             if 1 in visualizations:
                 #Здесь код чтобы график созданный ранее (ну или создавался заного) и тоже отправлялся в пдфку
@@ -217,13 +238,13 @@ def perform_analysis_with_pdf(df, filename="report.pdf", modes=None, visualizati
     #то что написано ниже это просто общее сохдание пдф, это надо будет убрать
 
     # Выполняем анализ
-    analysis = core.analysis.analyze_consumption(df)
+    analysis = get_artifact(context, 'consumption')
     print("11111111")
-    anomalies = core.anomaly_detection.detect_anomalies(df)
+    anomalies = get_artifact(context, 'anomalies')
     print("22222")
-    leaks = core.technical_analysis.detect_leaks(df)
+    leaks = get_artifact(context, 'leaks')
     print("333333")
-    health_stats = core.technical_analysis.analyze_meter_health(df)
+    health_stats = get_artifact(context, 'health')
     print("444444")
 
     # Собираем данные для отчета
@@ -237,6 +258,7 @@ def perform_analysis_with_pdf(df, filename="report.pdf", modes=None, visualizati
         'total_consumption': analysis.get('total_consumption', 0),
         'anomalies': anomalies,
         'health_stats': health_stats,
+        'report_text': report_text,
         'graphs': []
     }
 
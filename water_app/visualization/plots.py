@@ -3,6 +3,9 @@ import seaborn as sns
 import os
 from pathlib import Path
 
+from core.data_processing import remove_unused_categories
+from core.meter_store import iter_meter_series
+
 # Поддерживаемые форматы изображений
 SUPPORTED_FORMATS = ['png', 'jpg', 'jpeg', 'svg', 'pdf']
 
@@ -100,8 +103,8 @@ def plot_anomalies(df, anomalies, save=False, format='png'):
     fig = plt.figure(figsize=(15, 8))
 
     # График потребления
-    for meter_id, group in flow_data.groupby('ManagedObjectid'):
-        plt.plot(group['time'], group['Value'], alpha=0.3, label=f'Счетчик {meter_id}')
+    for meter_id, values in iter_meter_series(flow_data, 'P1'):
+        plt.plot(values.index, values.to_numpy(), alpha=0.3, label=f'Счетчик {meter_id}')
 
     # Аномалии
     for _, row in anomalies.iterrows():
@@ -133,7 +136,7 @@ def plot_leaks(df, leaks, save=False, format='png'):
     fig = plt.figure(figsize=(15, 8))
 
     # График потребления
-    for meter_id, group in flow_data.groupby('ManagedObjectid'):
+    for meter_id, group in flow_data.groupby('ManagedObjectid', observed=True):
         plt.plot(group['time'], group['Value'], alpha=0.3, label=f'Счетчик {meter_id}')
 
     # Протечки
@@ -163,7 +166,7 @@ def plot_meter_health_sw(df, health_stats, save=False, format='png'):
 
     # График состояния переключателей
     if 'switches' in health_stats and 'stats' in health_stats['switches']:
-        switch_data = df[df['Series'] == 'SW2'].copy()
+        switch_data = remove_unused_categories(df[df['Series'] == 'SW2'].copy())
         if not switch_data.empty:
             fig = plt.figure(figsize=(12, 6))
             sns.countplot(data=switch_data, x='ManagedObjectid', hue='Value')
@@ -187,7 +190,7 @@ def plot_meter_health_temp(df, health_stats, save=False, format='png'):
 
     # График температуры
     if 'temperature' in health_stats and 'stats' in health_stats['temperature']:
-        temp_data = df[df['Series'] == 'Max'].copy()
+        temp_data = remove_unused_categories(df[df['Series'] == 'Max'].copy())
         if not temp_data.empty:
             fig = plt.figure(figsize=(12, 6))
             sns.boxplot(data=temp_data, x='ManagedObjectid', y='Value')
@@ -214,7 +217,7 @@ def plot_meter_type_comparison(df, save=False, format='png'):
     if df is None or df.empty or 'typeM' not in df.columns:
         return
 
-    flow_data = df[(df['Series'] == 'P1') | (df['typeM'] == '/10266/1')].copy()
+    flow_data = remove_unused_categories(df[(df['Series'] == 'P1') | (df['typeM'] == '/10266/1')].copy())
     if flow_data.empty:
         return
 
@@ -244,8 +247,8 @@ def plot_predictions(df, predictions, save=False, format='png'):
     fig = plt.figure(figsize=(15, 6))
 
     # Исторические данные
-    for meter_id, group in flow_data.groupby('ManagedObjectid'):
-        plt.plot(group['time'], group['Value'], label=f'Счетчик {meter_id} (история)')
+    for meter_id, values in iter_meter_series(flow_data, 'P1'):
+        plt.plot(values.index, values.to_numpy(), label=f'Счетчик {meter_id} (история)')
 
     # Прогноз
     for meter_id, group in predictions.groupby('meter_id'):
@@ -270,7 +273,7 @@ def plot_city_comparison(df, save=False, format='png'):
     if df is None or df.empty or 'suburb' not in df.columns:
         return
 
-    flow_data = df[df['Series'] == 'P1'].copy()
+    flow_data = remove_unused_categories(df[df['Series'] == 'P1'].copy())
     if flow_data.empty:
         return
 